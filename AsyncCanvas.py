@@ -0,0 +1,626 @@
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from pathlib import Path
+from urllib.parse import urlparse
+import asyncio
+import io
+import os
+import time
+import aiohttp
+import pandas as pd
+
+from Canvas import (
+    PER_PAGE,
+    RETRY_STATUSES,
+    best_recipient,
+    recipient_context,
+    unique_names,
+)
+from instrumentation import count, recorder
+from quiz_reports import (
+    FETCHING,
+    GENERATING,
+    REPORT_TYPE,
+    QuizReportJob,
+    report_file_url,
+    report_version,
+)
+from report_cache import ReportCache, make_key
+from uploads import content_type
+
+
+class HostRateLimiter:
+    """Token bucket rate limiter, one bucket per host.
+
+    Each host gets `burst` requests up front, then `rate` requests per second.
+    """
+
+    def __init__(self, rate: float, burst: int = 1) -> None:
+        """Create the rate limiter.
+
+        :param rate: Sustained requests per second allowed for each host.
+        :param burst: Number of requests a host may receive back-to-back.
+        :return: None
+        """
+        self.rate = rate
+        self.burst = burst
+        self._buckets = {}
+        self._locks = {}
+
+    async def acquire(self, host: str) -> None:
+        """Wait until a request to this host is allowed.
+
+        :param host: Hostname the request is going to.
+        :return: None
+        """
+        lock = self._locks.setdefault(host, asyncio.Lock())
+        async with lock:
+            loop = asyncio.get_event_loop()
+            tokens, last = self._buckets.get(host, (self.burst, loop.time()))
+            now = loop.time()
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            if tokens < 1:
+                await asyncio.sleep((1 - tokens) / self.rate)
+                now = loop.time()
+                tokens = 1
+            self._buckets[host] = (tokens - 1, now)
+
+
+class AsyncCanvas:
+    """asyncio Canvas API wrapper.
+
+    Offers the same public surface as Canvas, but every method is a coroutine so
+    that many courses and quizzes can be fetched concurrently. Use it as an async
+    context manager so the underlying connection pool is opened and closed.
+    """
+
+    def __init__(
+            self,
+            install_url: str,
+            api_version: str,
+            access_token: str,
+            concurrency: int = 10,
+            requests_per_second: float = 10.0,
+            max_retries: int = 3,
+            backoff_factor: float = 1.0,
+            rate_limit_threshold: float = 100.0,
+            cache: ReportCache = None,
+            offline: bool = False,
+    ) -> None:
+        """Create the async Canvas API object.
+
+        :param install_url: Provided by your institution, e.g. "asu.instructure.edu".
+        :param api_version: Version of Canvas API, almost certainly "v1".
+        :param access_token: Generate at Canvas > Profile > Approved Integrations.
+        :param concurrency: Maximum number of requests in flight across all hosts.
+        :param requests_per_second: Sustained request rate allowed per host.
+        :param max_retries: How many times to retry throttled or 5xx responses,
+            and requests whose connection failed.
+        :param backoff_factor: Base delay in seconds for exponential backoff.
+        :param rate_limit_threshold: Slow down below this X-Rate-Limit-Remaining.
+        :param cache: Optional on-disk cache for reports and ID lookups.
+        :param offline: Serve everything from the cache, never touch the network.
+        :return: None
+        """
+        self.install_url = install_url
+        self.api_version = api_version
+        self.access_token = access_token.strip()
+        self.api_base = f"https://{install_url}/api/{api_version}"
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.rate_limit_threshold = rate_limit_threshold
+        self.cache = cache
+        self.offline = offline
+        self.rate_limiter = HostRateLimiter(requests_per_second, burst=concurrency)
+        self._semaphore = None
+        self.session = None
+
+    async def __aenter__(self) -> "AsyncCanvas":
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.concurrency),
+            headers={"Authorization": f"Bearer {self.access_token}"},
+        )
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.close()
+
+    async def close(self) -> None:
+        """Close every pooled connection held by the session.
+
+        :return: None
+        """
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    def _rate_limit_delay(self, response: aiohttp.ClientResponse) -> float:
+        """Seconds to wait before the next request, as Canvas._rate_limit_delay.
+
+        :param response: The most recent HTTP Response.
+        :return: Delay in seconds, 0 when the bucket is comfortably full.
+        """
+        remaining = response.headers.get("X-Rate-Limit-Remaining")
+        if remaining is None:
+            return 0.0
+        try:
+            remaining = float(remaining)
+        except ValueError:
+            return 0.0
+        if remaining >= self.rate_limit_threshold:
+            return 0.0
+        return self.backoff_factor * (1 - remaining / self.rate_limit_threshold)
+
+    def _retry_delay(self, response: aiohttp.ClientResponse, attempt: int) -> float:
+        """Seconds to wait before retrying a failed request.
+
+        :param response: The HTTP Response that failed, None if the connection did.
+        :param attempt: Zero-based number of the attempt that failed.
+        :return: Delay in seconds.
+        """
+        delay = self.backoff_factor * (2 ** attempt)
+        if response is None:
+            return delay
+        retry_after = response.headers.get("Retry-After", "")
+        if retry_after.isdigit():
+            return float(retry_after)
+        return max(delay, self._rate_limit_delay(response))
+
+    async def _request(
+            self, method: str, url: str, **kwargs
+    ) -> aiohttp.ClientResponse:
+        """Make a rate-limited HTTP request, retrying with backoff.
+
+        Retries throttled and 5xx responses, and requests whose connection
+        failed or timed out, as Canvas._request does. Once done, waits longer
+        the less of its rate limit Canvas says is left.
+
+        The body is read in full, which hands the connection back to the pool, so
+        the returned response can still be decoded with .read(), .json() or .text().
+
+        :param method: HTTP method, e.g. "GET".
+        :param url: The URL of a canvas API endpoint.
+        :return: The HTTP Response for this request.
+        """
+        host = urlparse(url).netloc
+        attempt = 0
+        # Requests interleave on one thread, so they are not nested in a span
+        # but recorded once they are done.
+        start = time.perf_counter()
+        while True:
+            await self.rate_limiter.acquire(host)
+            try:
+                async with self._semaphore:
+                    response = await self.session.request(method, url, **kwargs)
+                    body = await response.read()
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if attempt >= self.max_retries:
+                    raise
+                delay = self._retry_delay(None, attempt)
+                print(f"Request to Canvas failed ({e!r}), retrying in {delay:.1f}s.")
+                await asyncio.sleep(delay)
+                attempt = attempt + 1
+                continue
+            count("canvas.requests")
+            count("canvas.bytes_received", len(body))
+            throttled = response.status == 403 and "Rate Limit Exceeded" in (
+                await response.text()
+            )
+            retry = response.status in RETRY_STATUSES or throttled
+            if not retry or attempt >= self.max_retries:
+                break
+            delay = self._retry_delay(response, attempt)
+            print(f"Canvas returned {response.status}, retrying in {delay:.1f}s.")
+            await asyncio.sleep(delay)
+            attempt = attempt + 1
+
+        recorder().add(
+            "canvas.request",
+            time.perf_counter() - start,
+            start=start,
+            method=method,
+            url=url.split("?")[0],
+            status=response.status,
+            retries=attempt,
+        )
+        delay = self._rate_limit_delay(response)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        return response
+
+    async def _get_with_token(
+            self, url: str, params: Dict = None
+    ) -> aiohttp.ClientResponse:
+        """Make HTTP GET request using the generated access token.
+
+        :param url: The URL of a canvas API endpoint.
+        :return: The HTTP Response for this request.
+        """
+        return await self._request("GET", url, params=params)
+
+    async def _post_with_token(
+            self, url: str, data=None
+    ) -> aiohttp.ClientResponse:
+        """Make HTTP POST request using the generated access token.
+
+        :param url: The URL of a canvas API endpoint.
+        :return: The HTTP Response for this request.
+        """
+        return await self._request("POST", url, data=data)
+
+    async def paginate(self, url: str, params: Dict = None):
+        """Lazily yield every item of a paginated list endpoint.
+
+        :param url: The URL of a canvas API list endpoint.
+        :param params: Query parameters for the first page, per_page defaults to 100.
+        :return: Async iterator over the deserialized items of every page.
+        """
+        payload = {"per_page": PER_PAGE}
+        if params:
+            payload.update(params)
+
+        while url:
+            response = await self._get_with_token(url, payload)
+            response.raise_for_status()
+            for item in await response.json():
+                yield item
+            next_link = response.links.get("next")
+            url = str(next_link.get("url")) if next_link else None
+            payload = None
+
+    async def find_first(
+            self, url: str, predicate, params: Dict = None
+    ) -> Optional[Dict]:
+        """Return the first item of a paginated endpoint matching a predicate.
+
+        :param url: The URL of a canvas API list endpoint.
+        :param predicate: Function returning True for the wanted item.
+        :param params: Query parameters for the first page.
+        :return: The first matching item, or None if nothing matched.
+        """
+        async for item in self.paginate(url, params):
+            if predicate(item):
+                return item
+        return None
+
+    async def _cached_lookup(self, key: str, lookup) -> Any:
+        """Return a cached ID lookup, or await the lookup and cache its result.
+
+        :param key: Cache key from report_cache.make_key.
+        :param lookup: Function returning an awaitable that asks Canvas.
+        :return: The looked up value.
+        """
+        value = None
+        if self.cache is not None:
+            value = self.cache.get_id(key, allow_expired=self.offline)
+        if value is not None:
+            return value
+        assert not self.offline, f"{key} is not cached, cannot look it up offline"
+        value = await lookup()
+        if self.cache is not None and value is not None:
+            self.cache.put_id(key, value)
+        return value
+
+    async def _get_course_id(self, course_name: str) -> str:
+        """Get Canvas course ID corresponding to course name.
+
+        :param course_name: Partial or complete name of the course, e.g. "CHE 334"
+        :return: The course ID.
+        """
+        key = make_key(self.install_url, "course", course_name)
+        return await self._cached_lookup(
+            key, lambda: self._find_course_id(course_name)
+        )
+
+    async def _find_course_id(self, course_name: str) -> str:
+        """Ask Canvas for the course ID corresponding to course name.
+
+        :param course_name: Partial or complete name of the course, e.g. "CHE 334"
+        :return: The course ID.
+        """
+        course = await self.find_first(
+            self.api_base + "/courses",
+            lambda x: course_name in (x.get("name") or ""),
+            params={"search_term": course_name},
+        )
+        assert course is not None, f"No {course_name} course in Canvas"
+        return course.get("id")
+
+    async def _get_muddy_points_id(self, course_id: str, number: int) -> str:
+        """Get the quiz ID for a numbered Muddy Points survey.
+
+        :param course_id: The ID of the course to look in.
+        :param number: Which Muddy Points survey to check, e.g. 1
+        :return: The quiz ID.
+        """
+        key = make_key(self.install_url, "quiz", course_id, number)
+        return await self._cached_lookup(
+            key, lambda: self._find_muddy_points_id(course_id, number)
+        )
+
+    async def _find_muddy_points_id(self, course_id: str, number: int) -> str:
+        """Ask Canvas for the quiz ID of a numbered Muddy Points survey.
+
+        :param course_id: The ID of the course to look in.
+        :param number: Which Muddy Points survey to check, e.g. 1
+        :return: The quiz ID.
+        """
+        url = self.api_base + f"/courses/{course_id}/quizzes"
+        title = f"Muddy and Interesting Points #{number}"
+        muddy_points = await self.find_first(
+            url, lambda x: x.get("title") == title, params={"search_term": title}
+        )
+        assert muddy_points is not None, f"No quiz matching {title}"
+        return muddy_points.get("id")
+
+    def _reports_url(self, course_id: str, quiz_id: str) -> str:
+        """Get the URL of a quiz's reports endpoint.
+
+        :param course_id: The ID of the course to look in.
+        :param quiz_id: The ID of the desired quiz.
+        :return: The URL.
+        """
+        return self.api_base + f"/courses/{course_id}/quizzes/{quiz_id}/reports"
+
+    async def _list_quiz_reports(self, course_id: str, quiz_id: str) -> List[Dict]:
+        """List the reports Canvas already holds for a quiz.
+
+        :param course_id: The ID of the course to look in.
+        :param quiz_id: The ID of the desired quiz.
+        :return: Deserialized JSON data of every report.
+        """
+        params = [("include[]", "file"), ("include[]", "progress")]
+        url = self._reports_url(course_id, quiz_id)
+        return await (await self._get_with_token(url, params)).json()
+
+    async def start_quiz_report(
+            self,
+            course_id: str,
+            quiz_id: str,
+            timeout: float = 300.0,
+            callback: Callable[[QuizReportJob], None] = None,
+            reuse_existing: bool = True,
+    ) -> QuizReportJob:
+        """Kick off acquisition of a quiz report without waiting for it.
+
+        Behaves like Canvas.start_quiz_report.
+
+        :param course_id: The ID of the course to look in.
+        :param quiz_id: The ID of the desired quiz.
+        :param timeout: Seconds to wait for Canvas before giving up.
+        :param callback: Called with the job once it completes, fails or times out.
+        :param reuse_existing: Look for an already generated report first.
+        :return: The job, to be passed to wait_for_reports.
+        """
+        job = QuizReportJob(course_id, quiz_id, timeout=timeout, callback=callback)
+
+        if reuse_existing:
+            reports = await self._list_quiz_reports(course_id, quiz_id)
+            existing = job.reusable_report(reports)
+            if existing is not None:
+                response = await self._request("HEAD", report_file_url(existing))
+                if response.status == 200:
+                    job.on_report(existing)
+                    return job
+
+        data = [
+            ("quiz_report[report_type]", REPORT_TYPE),
+            ("include[]", "file"),
+            ("include[]", "progress"),
+        ]
+        url = self._reports_url(course_id, quiz_id)
+        response = await self._post_with_token(url, data=data)
+        if response.status == 200:
+            job.on_report(await response.json())
+        elif response.status == 409:
+            print("Report is already being generated, waiting for it.")
+            job.on_conflict(await self._list_quiz_reports(course_id, quiz_id))
+        else:
+            job.fail(f"Report could not be fetched: {await response.text()}")
+        return job
+
+    async def _drive_quiz_report(self, job: QuizReportJob) -> QuizReportJob:
+        """Poll one job on its backoff schedule until it is finished.
+
+        :param job: A job from start_quiz_report.
+        :return: The finished job.
+        """
+        while not job.done:
+            await asyncio.sleep(job.seconds_until_poll())
+            if job.check_timeout():
+                break
+            if job.state == GENERATING:
+                response = await self._get_with_token(job.progress_url)
+                job.on_progress(await response.json())
+            if job.state == FETCHING:
+                url = self._reports_url(job.course_id, job.quiz_id)
+                params = [("include[]", "file"), ("include[]", "progress")]
+                response = await self._get_with_token(f"{url}/{job.report_id}", params)
+                job.on_report(await response.json())
+        return job
+
+    async def wait_for_reports(
+            self, jobs: List[QuizReportJob]
+    ) -> List[QuizReportJob]:
+        """Poll every job concurrently until each one is finished.
+
+        :param jobs: Jobs from start_quiz_report.
+        :return: The same jobs, all finished.
+        """
+        return list(await asyncio.gather(*(self._drive_quiz_report(j) for j in jobs)))
+
+    async def _get_quiz_report(
+            self, course_id: str, quiz_id: str, timeout: float = 300.0
+    ) -> Dict:
+        """Creates and returns a quiz report.
+
+        :param course_id: The ID of the course to look in.
+        :param quiz_id: The ID of the desired quiz.
+        :param timeout: Seconds to wait for Canvas before giving up.
+        :return: Deserialized JSON data of the report.
+        """
+        job = await self.start_quiz_report(course_id, quiz_id, timeout=timeout)
+        return (await self.wait_for_reports([job]))[0].result()
+
+    async def get_quiz_report(
+            self,
+            course_name: str,
+            quiz_number: int,
+            usecols: Callable[[str], bool] = None,
+            dtype=None,
+    ) -> pd.DataFrame:
+        """Fetch the student analysis report for a numbered Muddy Points survey.
+
+        Unlike Canvas.get_quiz_report, the download is read into memory in full
+        before it is parsed, so a large report briefly takes its size in memory
+        on top of the DataFrame; see benchmarks/memory.py.
+
+        :param course_name: Partial or complete name of the course, e.g. "CHE 334"
+        :param quiz_number: Which Muddy Points survey to check, e.g. 1
+        :param usecols: Passed to pandas.read_csv, e.g. report_schema.report_usecols
+        :param dtype: Passed to pandas.read_csv.
+        :return: DataFrame of quiz report data.
+        """
+        key = make_key(self.install_url, "report", course_name, quiz_number)
+        if self.offline:
+            cached = self.cache.get_report(key) if self.cache is not None else None
+            message = f"No cached report for {course_name} #{quiz_number}"
+            assert cached is not None, message
+            return pd.read_csv(str(cached), usecols=usecols, dtype=dtype)
+
+        course_id = await self._get_course_id(course_name)
+        quiz_id = await self._get_muddy_points_id(course_id, quiz_number)
+        report = await self._get_quiz_report(course_id, quiz_id)
+
+        version = report_version(report)
+        if self.cache is not None:
+            cached = self.cache.get_report(key, version)
+            if cached is not None:
+                return pd.read_csv(str(cached), usecols=usecols, dtype=dtype)
+
+        response = await self._get_with_token(report_file_url(report))
+        content = await response.read()
+        if self.cache is not None:
+            self.cache.put_report(key, version, content)
+        return pd.read_csv(io.BytesIO(content), usecols=usecols, dtype=dtype)
+
+    async def get_quiz_reports(
+            self, pairs: List[Tuple[str, int]], **read_csv_kwargs
+    ) -> List[pd.DataFrame]:
+        """Fetch the reports for many (course, quiz number) pairs concurrently.
+
+        :param pairs: (course_name, quiz_number) for every report wanted.
+        :param read_csv_kwargs: usecols and dtype, as for get_quiz_report.
+        :return: DataFrames of quiz report data, in the same order as pairs.
+        """
+        return await asyncio.gather(
+            *(
+                self.get_quiz_report(course, quiz, **read_csv_kwargs)
+                for course, quiz in pairs
+            )
+        )
+
+    async def _get_recipient(self, name: str, context: Optional[str] = None) -> Dict:
+        """Get the person a name refers to, from the cache if possible.
+
+        :param name: Full name of the intended recipient, from unique_names.
+        :param context: Search context from Canvas.recipient_context.
+        :return: The matching recipient, or {}.
+        """
+        key = make_key(self.install_url, "recipient", context, name.casefold())
+        return await self._cached_lookup(
+            key, lambda: self._find_recipient(name, context)
+        )
+
+    async def _find_recipient(self, name: str, context: Optional[str] = None) -> Dict:
+        """Ask Canvas for the person a name refers to.
+
+        :param name: Full name of the intended recipient.
+        :param context: Search context from Canvas.recipient_context.
+        :return: The matching recipient, or {}.
+        """
+        url = self.api_base + "/search/recipients"
+        params = {"search": name, "type": "user"}
+        if context is not None:
+            params["context"] = context
+        people = [person async for person in self.paginate(url, params)]
+        return best_recipient(name, people) or {}
+
+    async def get_recipient_ids(
+            self, recipient_names: List[str], course_name: str = None
+    ) -> Dict:
+        """Get matching Canvas IDs for a list of recipient names.
+
+        Each distinct name is looked up once; the searches share the
+        client's concurrency limit.
+
+        :param recipient_names: Full names of the intended recipients.
+        :param course_name: Only search the people in this course, if given.
+        :return: Canvas full names and IDs for the recipients.
+        """
+        context = None
+        if course_name is not None:
+            context = recipient_context(await self._get_course_id(course_name))
+        people = await asyncio.gather(
+            *(
+                self._get_recipient(name, context)
+                for name in unique_names(recipient_names)
+            )
+        )
+        return {p.get("full_name"): p.get("id") for p in people if p}
+
+    async def upload_file(self, file_to_upload: Path, parent_folder: str) -> bool:
+        """Upload a file to the user's Canvas account.
+
+        Follows the same 3-step process as Canvas.upload_file.
+
+        :param file_to_upload: Path to file intended for upload.
+        :param parent_folder: Canvas-side file tree destination.
+        :return: True if the upload was confirmed.
+        """
+        # Step 1
+        # Tell Canvas we want to upload a file.
+        url = self.api_base + "/users/self/files"
+
+        name = file_to_upload.name
+        fsize = os.path.getsize(str(file_to_upload))
+
+        response = await self._post_with_token(
+            url,
+            data={
+                "name": name,
+                "size": str(fsize),
+                "content_type": content_type(file_to_upload),
+                "parent_folder_path": parent_folder,
+                "on_duplicate": "overwrite",
+            },
+        )
+        if response.status != 200:
+            return False
+
+        # Step 2
+        # Upload the file to the AWS/cloud storage link we just received.
+        response_data = await response.json()
+        upload_url = response_data.get("upload_url")
+        form = aiohttp.FormData()
+        for key, value in (response_data.get("upload_params") or {}).items():
+            form.add_field(key, str(value))
+        with file_to_upload.open("rb") as f:
+            form.add_field("file", f, filename=name)
+            async with self._semaphore:
+                # The storage backend must not receive our Canvas token.
+                async with aiohttp.ClientSession() as storage:
+                    async with storage.post(
+                        upload_url, data=form, allow_redirects=False
+                    ) as response:
+                        await response.read()
+        if response.status >= 400:
+            return False
+
+        # Step 3
+        # Confirm the upload: a redirect or 201 Created points at the new file.
+        location = response.headers.get("Location")
+        if location:
+            response = await self._get_with_token(location)
+        return response.status < 300
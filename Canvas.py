@@ -1,10 +1,121 @@
-from typing import Dict, List
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, BinaryIO, Callable, Dict, Iterator, List, Optional, Union
 from pathlib import Path
-import io
 import os
+import time
 import requests
+from requests.adapters import HTTPAdapter
 import pandas as pd
 
+from instrumentation import count, span
+from quiz_reports import (
+    FETCHING,
+    GENERATING,
+    REPORT_TYPE,
+    QuizReportJob,
+    report_file_url,
+    report_version,
+)
+from report_cache import ReportCache, make_key
+from uploads import MultipartStream, UploadLedger, content_type
+
+# Largest page size Canvas will honour; fewer pages means fewer round trips.
+PER_PAGE = 100
+
+# Bytes read from the socket at a time when streaming report downloads.
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+# Responses worth retrying: throttling and transient server-side failures.
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# Recipient searches in flight at once.
+RECIPIENT_WORKERS = 4
+
+
+def read_csv_chunks(
+        stream: BinaryIO, chunksize: int, **kwargs
+) -> Iterator[pd.DataFrame]:
+    """Parse a CSV stream in chunks, closing the stream once it is exhausted.
+
+    :param stream: Binary stream of CSV data.
+    :param chunksize: Rows per DataFrame.
+    :return: Iterator of DataFrames.
+    """
+    with stream:
+        yield from pd.read_csv(stream, chunksize=chunksize, **kwargs)
+
+
+def counted(chunks: Iterator[bytes], counter: str) -> Iterator[bytes]:
+    """Pass chunks of a download through, adding their sizes to a counter.
+
+    :param chunks: The download, in chunks.
+    :param counter: Name of the instrumentation counter.
+    :return: The same chunks.
+    """
+    for chunk in chunks:
+        count(counter, len(chunk))
+        yield chunk
+
+
+def body_size(body: Any) -> int:
+    """Count the bytes of a request or response body.
+
+    :param body: bytes, str, a MultipartStream or None.
+    :return: Its length, 0 if it has none.
+    """
+    try:
+        return len(body)
+    except TypeError:
+        return 0
+
+
+def unique_names(names: List[str]) -> List[str]:
+    """Clean up a list of recipient names, dropping blanks and repeats.
+
+    :param names: Names as read from a recipients file.
+    :return: Names with whitespace collapsed, each once regardless of case,
+        in their first order.
+    """
+    unique = {}
+    for name in (" ".join(name.split()) for name in names):
+        if name:
+            unique.setdefault(name.casefold(), name)
+    return list(unique.values())
+
+
+def best_recipient(name: str, people: List[Dict]) -> Optional[Dict]:
+    """Pick the person a name refers to from recipient search results.
+
+    A search matches substrings, so "Ann Lee" also finds "Joann Leeds". A
+    result whose name is exactly the one given wins; failing that, a lone
+    result is taken, since the name can only mean that person.
+
+    :param name: Name searched for.
+    :param people: Results of /search/recipients.
+    :return: The person, or None if there is no match or several.
+    """
+    wanted = name.casefold()
+    for person in people:
+        names = (person.get(k) for k in ("full_name", "name", "sortable_name"))
+        if any(" ".join(str(n).split()).casefold() == wanted for n in names if n):
+            return person
+    if len(people) == 1:
+        return people[0]
+    if people:
+        print(f"{len(people)} recipients match {name}, none exactly; skipping.")
+    else:
+        print(f"No recipient matches {name}; skipping.")
+    return None
+
+
+def recipient_context(course_id: Optional[str]) -> Optional[str]:
+    """Get the search context that limits recipients to a course.
+
+    :param course_id: Canvas course ID, or None to search everyone.
+    :return: e.g. "course_1234", or None.
+    """
+    return f"course_{course_id}" if course_id is not None else None
+
 
 class Canvas:
     """Canvas API wrapper.
@@ -14,18 +125,158 @@ class Canvas:
     which looks for a specific type of quiz used in ChemE courses.
     """
 
-    def __init__(self, install_url: str, api_version: str, access_token: str) -> None:
+    def __init__(
+            self,
+            install_url: str,
+            api_version: str,
+            access_token: str,
+            pool_size: int = 10,
+            max_retries: int = 3,
+            backoff_factor: float = 1.0,
+            rate_limit_threshold: float = 100.0,
+            cache: ReportCache = None,
+            offline: bool = False,
+    ) -> None:
         """Create the Canvas API object.
 
+        All requests share one pooled, keep-alive session, so repeated calls reuse
+        the same TLS connections instead of handshaking every time.
+
         :param install_url: Provided by your institution, e.g. "asu.instructure.edu".
         :param api_version: Version of Canvas API, almost certainly "v1".
         :param access_token: Generate at Canvas > Profile > Approved Integrations.
+        :param pool_size: Maximum number of connections kept open per host.
+        :param max_retries: How many times to retry throttled or 5xx responses.
+        :param backoff_factor: Base delay in seconds for exponential backoff.
+        :param rate_limit_threshold: Slow down below this X-Rate-Limit-Remaining.
+        :param cache: Optional on-disk cache for reports and ID lookups.
+        :param offline: Serve everything from the cache, never touch the network.
         :return: None
         """
         self.install_url = install_url
         self.api_version = api_version
-        self.access_token = access_token
+        self.access_token = access_token.strip()
         self.api_base = f"https://{install_url}/api/{api_version}"
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.rate_limit_threshold = rate_limit_threshold
+        self.cache = cache
+        self.offline = offline
+        self.session = self._make_session(pool_size)
+
+    def __enter__(self) -> "Canvas":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """Close every pooled connection held by the session.
+
+        :return: None
+        """
+        self.session.close()
+
+    def _make_session(self, pool_size: int) -> requests.Session:
+        """Create a pooled session that sends the token as an Authorization header.
+
+        :param pool_size: Maximum number of connections kept open per host.
+        :return: The configured session.
+        """
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        session.headers.update(
+            {
+                "Authorization": f"Bearer {self.access_token}",
+                "Connection": "keep-alive",
+            }
+        )
+        return session
+
+    def _rate_limit_delay(self, response: requests.Response) -> float:
+        """Seconds to wait before the next request, based on Canvas throttling headers.
+
+        Canvas uses a leaky bucket and reports what is left of it in
+        X-Rate-Limit-Remaining. The emptier the bucket, the longer we wait.
+
+        :param response: The most recent HTTP Response.
+        :return: Delay in seconds, 0 when the bucket is comfortably full.
+        """
+        remaining = response.headers.get("X-Rate-Limit-Remaining")
+        if remaining is None:
+            return 0.0
+        try:
+            remaining = float(remaining)
+        except ValueError:
+            return 0.0
+        if remaining >= self.rate_limit_threshold:
+            return 0.0
+        return self.backoff_factor * (1 - remaining / self.rate_limit_threshold)
+
+    def _retry_delay(self, response: requests.Response, attempt: int) -> float:
+        """Seconds to wait before retrying a failed request.
+
+        :param response: The HTTP Response that failed.
+        :param attempt: Zero-based number of the attempt that failed.
+        :return: Delay in seconds.
+        """
+        retry_after = response.headers.get("Retry-After")
+        if retry_after is not None and retry_after.isdigit():
+            return float(retry_after)
+        delay = self.backoff_factor * (2 ** attempt)
+        return max(delay, self._rate_limit_delay(response))
+
+    @staticmethod
+    def _should_retry(response: requests.Response) -> bool:
+        """Check whether a response is throttled or a transient server error.
+
+        Canvas signals throttling with 403 "Rate Limit Exceeded" as well as 429.
+
+        :param response: The HTTP Response to check.
+        :return: True if the request should be retried.
+        """
+        if response.status_code in RETRY_STATUSES:
+            return True
+        return response.status_code == 403 and "Rate Limit Exceeded" in response.text
+
+    def _request(self, method: str, url: str, **kwargs) -> requests.Response:
+        """Make an HTTP request on the pooled session, retrying with backoff.
+
+        :param method: HTTP method, e.g. "GET".
+        :param url: The URL of a canvas API endpoint.
+        :return: The HTTP Response for this request.
+        """
+        attempt = 0
+        # The query string of a download URL is a credential, leave it out.
+        with span("canvas.request", method=method, url=url.split("?")[0]) as attrs:
+            while True:
+                response = self.session.request(method, url, **kwargs)
+                count("canvas.requests")
+                count("canvas.bytes_sent", body_size(response.request.body))
+                if not self._should_retry(response) or attempt >= self.max_retries:
+                    break
+                delay = self._retry_delay(response, attempt)
+                print(
+                    f"Canvas returned {response.status_code}, "
+                    f"retrying in {delay:.1f}s."
+                )
+                response.close()
+                time.sleep(delay)
+                attempt = attempt + 1
+            attrs["status"] = response.status_code
+            attrs["retries"] = attempt
+
+            delay = self._rate_limit_delay(response)
+            if delay > 0:
+                time.sleep(delay)
+
+        if kwargs.get("stream"):
+            # Not downloaded yet; _open_quiz_report counts it as it streams.
+            return response
+        count("canvas.bytes_received", body_size(response.content))
+        return response
 
     def _get_with_token(self, url: str, params: Dict = None) -> requests.Response:
         """Make HTTP GET request using the generated access token.
@@ -33,10 +284,7 @@ class Canvas:
         :param url: The URL of a canvas API endpoint.
         :return: The HTTP Response for this request.
         """
-        payload = {"access_token": self.access_token}
-        if params:
-            payload.update(params)
-        return requests.get(url, params=payload)
+        return self._request("GET", url, params=params)
 
     def _post_with_token(self, url: str, data: Dict = None) -> requests.Response:
         """Make HTTP POST request using the generated access token.
@@ -44,10 +292,61 @@ class Canvas:
         :param url: The URL of a canvas API endpoint.
         :return: The HTTP Response for this request.
         """
-        payload = {"access_token": self.access_token}
-        if data:
-            payload.update(data)
-        return requests.post(url, data=payload)
+        return self._request("POST", url, data=data)
+
+    def paginate(self, url: str, params: Dict = None) -> Iterator[Dict]:
+        """Lazily yield every item of a paginated list endpoint.
+
+        Pages are requested only as the caller consumes items, by following the
+        Link: rel="next" header. Stop iterating to stop fetching.
+
+        :param url: The URL of a canvas API list endpoint.
+        :param params: Query parameters for the first page, per_page defaults to 100.
+        :return: Iterator over the deserialized items of every page.
+        """
+        payload = {"per_page": PER_PAGE}
+        if params:
+            payload.update(params)
+
+        while url:
+            response = self._get_with_token(url, payload)
+            response.raise_for_status()
+            yield from response.json()
+            # The next link already carries every query parameter.
+            url = response.links.get("next", {}).get("url")
+            payload = None
+
+    def find_first(
+            self, url: str, predicate: Callable[[Dict], bool], params: Dict = None
+    ) -> Optional[Dict]:
+        """Return the first item of a paginated endpoint matching a predicate.
+
+        No further pages are requested once a match is found.
+
+        :param url: The URL of a canvas API list endpoint.
+        :param predicate: Function returning True for the wanted item.
+        :param params: Query parameters for the first page.
+        :return: The first matching item, or None if nothing matched.
+        """
+        return next(filter(predicate, self.paginate(url, params)), None)
+
+    def _cached_lookup(self, key: str, lookup: Callable[[], Any]) -> Any:
+        """Return a cached ID lookup, or run the lookup and cache its result.
+
+        :param key: Cache key from report_cache.make_key.
+        :param lookup: Function that asks Canvas for the value.
+        :return: The looked up value.
+        """
+        value = None
+        if self.cache is not None:
+            value = self.cache.get_id(key, allow_expired=self.offline)
+        if value is not None:
+            return value
+        assert not self.offline, f"{key} is not cached, cannot look it up offline"
+        value = lookup()
+        if self.cache is not None and value is not None:
+            self.cache.put_id(key, value)
+        return value
 
     def _get_course_id(self, course_name: str) -> str:
         """Get Canvas course ID corresponding to course name.
@@ -55,24 +354,49 @@ class Canvas:
         :param course_name: Partial or complete name of the course, e.g. "CHE 334"
         :return: The course ID.
         """
-        response = self._get_with_token(self.api_base + "/courses")
-        course = list(filter(lambda x: course_name in x.get("name"), response.json()))
-        assert len(course) == 1, f"Multiple {course_name} courses in Canvas"
-        return course[0].get("id")
+        key = make_key(self.install_url, "course", course_name)
+        return self._cached_lookup(key, lambda: self._find_course_id(course_name))
+
+    def _find_course_id(self, course_name: str) -> str:
+        """Ask Canvas for the course ID corresponding to course name.
+
+        :param course_name: Partial or complete name of the course, e.g. "CHE 334"
+        :return: The course ID.
+        """
+        course = self.find_first(
+            self.api_base + "/courses",
+            lambda x: course_name in (x.get("name") or ""),
+            params={"search_term": course_name},
+        )
+        assert course is not None, f"No {course_name} course in Canvas"
+        return course.get("id")
 
     def _get_muddy_points_id(self, course_id: str, number: int) -> str:
         """Get the quiz ID for a numbered Muddy Points survey.
 
+        :param course_id: The ID of the course to look in.
+        :param number: Which Muddy Points survey to check, e.g. 1
+        :return: The quiz ID.
+        """
+        key = make_key(self.install_url, "quiz", course_id, number)
+        return self._cached_lookup(
+            key, lambda: self._find_muddy_points_id(course_id, number)
+        )
+
+    def _find_muddy_points_id(self, course_id: str, number: int) -> str:
+        """Ask Canvas for the quiz ID of a numbered Muddy Points survey.
+
         :param course_id: The ID of the course to look in.
         :param number: Which Muddy Points survey to check, e.g. 1
         :return: The quiz ID.
         """
         url = self.api_base + f"/courses/{course_id}/quizzes"
-        quizzes = self._get_with_token(url).json()
         title = f"Muddy and Interesting Points #{number}"
-        muddy_points = list(filter(lambda x: x.get("title") == title, quizzes))
-        assert len(muddy_points) == 1, f"Multiple quizzes matching {title}"
-        return muddy_points[0].get("id")
+        muddy_points = self.find_first(
+            url, lambda x: x.get("title") == title, params={"search_term": title}
+        )
+        assert muddy_points is not None, f"No quiz matching {title}"
+        return muddy_points.get("id")
 
     def _post_fetch_quiz_report(
             self, course_id: str, quiz_id: str
@@ -80,7 +404,7 @@ class Canvas:
         """Send POST request to create and download a quiz report.
 
         This POST request can return 200 (OK), 400 (Error), or 409 (In Progress). These
-        status codes are handled in _get_quiz_report.
+        status codes are handled in start_quiz_report.
 
         :param course_id: The ID of the course to look in.
         :param quiz_id: The ID of the desired quiz.
@@ -90,125 +414,359 @@ class Canvas:
         return self._post_with_token(
             url,
             data={
-                "quiz_report[report_type]": "student_analysis",
-                "include": ["file", "progress"],
+                "quiz_report[report_type]": REPORT_TYPE,
+                "include[]": ["file", "progress"],
             },
         )
 
-    def _get_quiz_report(self, course_id: str, quiz_id: str) -> Dict:
-        """Creates and returns a quiz report.
+    def _list_quiz_reports(self, course_id: str, quiz_id: str) -> List[Dict]:
+        """List the reports Canvas already holds for a quiz.
 
         :param course_id: The ID of the course to look in.
         :param quiz_id: The ID of the desired quiz.
-        :return: Deserialized JSON data of the report.
+        :return: Deserialized JSON data of every report.
         """
-        wait_seconds = 10
-        num_attempts = 3
-        response = self._post_fetch_quiz_report(course_id, quiz_id)
+        url = self.api_base + f"/courses/{course_id}/quizzes/{quiz_id}/reports"
+        return self._get_with_token(url, {"include[]": ["file", "progress"]}).json()
+
+    def _file_url_valid(self, url: str) -> bool:
+        """Check that a report file can still be downloaded.
+
+        :param url: The report's file URL.
+        :return: True if a HEAD request for the file succeeds.
+        """
+        response = self._request("HEAD", url, allow_redirects=True)
+        return response.status_code == 200
+
+    def start_quiz_report(
+            self,
+            course_id: str,
+            quiz_id: str,
+            timeout: float = 300.0,
+            callback: Callable[[QuizReportJob], None] = None,
+            reuse_existing: bool = True,
+    ) -> QuizReportJob:
+        """Kick off acquisition of a quiz report without waiting for it.
+
+        An existing generated report is reused when its file can still be
+        downloaded. Otherwise a new report is requested, or, if Canvas is
+        already generating one (409), the job attaches to that one.
+
+        :param course_id: The ID of the course to look in.
+        :param quiz_id: The ID of the desired quiz.
+        :param timeout: Seconds to wait for Canvas before giving up.
+        :param callback: Called with the job once it completes, fails or times out.
+        :param reuse_existing: Look for an already generated report first.
+        :return: The job, to be passed to wait_for_reports.
+        """
+        job = QuizReportJob(course_id, quiz_id, timeout=timeout, callback=callback)
+
+        if reuse_existing:
+            existing = job.reusable_report(self._list_quiz_reports(course_id, quiz_id))
+            if existing is not None and self._file_url_valid(report_file_url(existing)):
+                job.on_report(existing)
+                return job
 
+        response = self._post_fetch_quiz_report(course_id, quiz_id)
         if response.status_code == 200:
-            return response.json()
+            job.on_report(response.json())
         elif response.status_code == 409:
-            num_attempts = num_attempts - 1
-            while response.status_code == 409 and num_attempts > 0:
-                print(f"Report is already being generated: {response}")
-                print(f"{num_attempts} attempts remaining, waiting {wait_seconds}s.")
-                response = self._post_fetch_quiz_report(course_id, quiz_id)
+            print("Report is already being generated, waiting for it.")
+            job.on_conflict(self._list_quiz_reports(course_id, quiz_id))
         else:
-            print(f"Report could not be fetched: {response.text}")
+            job.fail(f"Report could not be fetched: {response.text}")
+        return job
 
-        return response.json()
+    def _poll_quiz_report(self, job: QuizReportJob) -> None:
+        """Make the one request a job is currently waiting on.
 
-    def get_recipient_ids(self, recipient_names: List[str]) -> Dict:
-        """Get matching Canvas IDs for a list of recipient names.
+        :param job: A job that is generating or fetching.
+        :return: None
+        """
+        if job.state == GENERATING:
+            job.on_progress(self._get_with_token(job.progress_url).json())
+        if job.state == FETCHING:
+            url = (
+                self.api_base + f"/courses/{job.course_id}/quizzes/{job.quiz_id}"
+                f"/reports/{job.report_id}"
+            )
+            params = {"include[]": ["file", "progress"]}
+            job.on_report(self._get_with_token(url, params).json())
+
+    def wait_for_reports(self, jobs: List[QuizReportJob]) -> List[QuizReportJob]:
+        """Poll every job until each one has completed, failed or timed out.
+
+        Jobs are polled in whatever order their backoff schedules come due, so
+        many reports can be generated by Canvas at once.
+
+        :param jobs: Jobs from start_quiz_report.
+        :return: The same jobs, all finished.
+        """
+        pending = [job for job in jobs if not job.done]
+        while pending:
+            for job in pending:
+                if not job.check_timeout() and job.seconds_until_poll() == 0:
+                    self._poll_quiz_report(job)
+            pending = [job for job in pending if not job.done]
+            if pending:
+                time.sleep(min(job.seconds_until_poll() for job in pending))
+        return jobs
+
+    def _get_quiz_report(
+            self, course_id: str, quiz_id: str, timeout: float = 300.0
+    ) -> Dict:
+        """Creates and returns a quiz report.
 
-        :param recipient_names: Full names of the intended recipients.
-        :return: Canvas full names and IDs for the recipients.
+        :param course_id: The ID of the course to look in.
+        :param quiz_id: The ID of the desired quiz.
+        :param timeout: Seconds to wait for Canvas before giving up.
+        :return: Deserialized JSON data of the report.
         """
-        recipients = {}
+        job = self.start_quiz_report(course_id, quiz_id, timeout=timeout)
+        return self.wait_for_reports([job])[0].result()
 
-        for name in recipient_names:
-            url = self.api_base + f"/search/recipients?search={name.strip()}&type=user"
-            response = self._get_with_token(url)
-            if response.status_code == 200:
-                person = response.json()[0]
-                recipients[person.get("full_name")] = person.get("id")
+    def _get_recipient(self, name: str, context: Optional[str] = None) -> Dict:
+        """Get the person a name refers to, from the cache if possible.
 
-        return recipients
+        Names without a match are cached too, as {}, so a steady-state run
+        makes no recipient searches at all.
 
-    def upload_file(self, file_to_upload: Path, parent_folder: str) -> bool:
-        """Upload a file to the user's Canvas account.
+        :param name: Full name of the intended recipient, from unique_names.
+        :param context: Search context from recipient_context.
+        :return: The matching recipient, or {}.
+        """
+        key = make_key(self.install_url, "recipient", context, name.casefold())
+        return self._cached_lookup(key, lambda: self._find_recipient(name, context))
 
-        This is a bit of a dance, and the current function only handles the happy path. That
-        path involves following the 3-step process described by the Canvas API documentation:
-        https://canvascoach.instructure.com/doc/api/file.file_uploads.html
+    def _find_recipient(self, name: str, context: Optional[str] = None) -> Dict:
+        """Ask Canvas for the person a name refers to.
 
-        :param file_to_upload: Path to file intended for upload.
-        :param parent_folder: Canvas-side file tree destination.
-        :return: True if the final POST request returned 200.
+        :param name: Full name of the intended recipient.
+        :param context: Search context from recipient_context.
+        :return: The matching recipient, or {}.
         """
+        params = {"search": name, "type": "user"}
+        if context is not None:
+            params["context"] = context
+        people = list(self.paginate(self.api_base + "/search/recipients", params))
+        return best_recipient(name, people) or {}
+
+    def get_recipient_ids(
+            self,
+            recipient_names: List[str],
+            course_name: str = None,
+            max_workers: int = RECIPIENT_WORKERS,
+    ) -> Dict:
+        """Get matching Canvas IDs for a list of recipient names.
 
-        # Step 1
-        # Tell Canvas we want to upload a file.
-        url = self.api_base + "/users/self/files"
+        Each distinct name is looked up once, the ones not yet cached
+        concurrently.
 
-        name = file_to_upload.name
-        fsize = os.path.getsize(str(file_to_upload))
+        :param recipient_names: Full names of the intended recipients.
+        :param course_name: Only search the people in this course, if given.
+        :param max_workers: Most searches in flight at once.
+        :return: Canvas full names and IDs for the recipients.
+        """
+        names = unique_names(recipient_names)
+        context = None
+        if course_name is not None:
+            context = recipient_context(self._get_course_id(course_name))
 
-        content_type = None
-        if file_to_upload.suffix == ".png":
-            content_type = "image/png"
-        elif file_to_upload.suffix == ".zip":
-            content_type = "application/zip"
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            people = list(pool.map(lambda n: self._get_recipient(n, context), names))
+        return {p.get("full_name"): p.get("id") for p in people if p}
 
-        parent_folder_path = parent_folder
+    def _upload(self, file_to_upload: Path, parent_folder: str) -> Dict:
+        """Make one attempt at uploading a file, following all three steps of
+        https://canvas.instructure.com/doc/api/file.file_uploads.html
 
+        :param file_to_upload: Path to file intended for upload.
+        :param parent_folder: Canvas-side file tree destination.
+        :return: Canvas' JSON representation of the uploaded file.
+        """
+        # Step 1
+        # Tell Canvas we want to upload a file.
         response = self._post_with_token(
-            url,
+            self.api_base + "/users/self/files",
             data={
-                "name": name,
-                "size": fsize,
-                "content_type": content_type,
-                "parent_folder_path": parent_folder_path,
+                "name": file_to_upload.name,
+                "size": os.path.getsize(str(file_to_upload)),
+                "content_type": content_type(file_to_upload),
+                "parent_folder_path": parent_folder,
+                "on_duplicate": "overwrite",
             },
         )
+        response.raise_for_status()
+        ticket = response.json()
 
         # Step 2
-        # Upload the file to the AWS/cloud storage link we just received.
-        print(response.status_code)
-        print(response.text)
-        if response.status_code != 200:
-            return False
-
-        response_data = response.json()
-        upload_url = response_data.get("upload_url")
-        upload_params = response_data.get("upload_params") or {}
-        with file_to_upload.open("rb") as f:
-            print("Upload params: ", upload_params)
-            response = requests.post(upload_url, data=upload_params, files={name: f})
+        # Stream the file to the cloud storage link we just received. The
+        # storage backend must not receive our Canvas token, and its redirect
+        # has to be followed with the token, so it is not followed here.
+        with MultipartStream(
+                ticket.get("upload_params") or {}, "file", file_to_upload
+        ) as body, span("canvas.upload", file=file_to_upload.name) as attrs:
+            response = self.session.post(
+                ticket["upload_url"],
+                data=body,
+                headers={"Authorization": None, "Content-Type": body.content_type},
+                allow_redirects=False,
+            )
+            attrs["status"] = response.status_code
+            count("canvas.requests")
+            count("canvas.bytes_sent", len(body))
+        if response.status_code >= 400:
+            response.raise_for_status()
 
         # Step 3
+        # Confirm the upload: a redirect or 201 Created points at the new file.
+        location = response.headers.get("Location")
+        if location:
+            response = self._get_with_token(location)
+            response.raise_for_status()
+        return response.json()
 
-        # Need to confirm upload, not handled yet because not encountered yet.
-        if response.status_code == 301:
-            print(response.text)
-            return False
+    @staticmethod
+    def _should_retry_upload(error: Exception) -> bool:
+        """Decide whether a failed upload is worth another attempt.
 
+        :param error: What the upload raised.
+        :return: True for network errors and transient server errors.
+        """
+        if isinstance(error, requests.HTTPError):
+            return error.response is not None and (
+                error.response.status_code in RETRY_STATUSES
+            )
+        return isinstance(error, requests.RequestException)
+
+    def upload_file(
+            self, file_to_upload: Path, parent_folder: str, ledger: UploadLedger = None
+    ) -> bool:
+        """Upload a file to the user's Canvas account.
+
+        Upload tickets are single use, so a failed transfer is retried with
+        backoff from step 1. With a ledger, a file that was already uploaded
+        and has not changed since is skipped, which resumes interrupted batches.
+
+        :param file_to_upload: Path to file intended for upload.
+        :param parent_folder: Canvas-side file tree destination.
+        :param ledger: Record of finished uploads to check and update.
+        :return: True if the file was uploaded and confirmed, or already was.
+        """
+        if ledger is not None and ledger.is_uploaded(file_to_upload, parent_folder):
+            print(f"Already uploaded {file_to_upload.name}.")
+            return True
+
+        attempt = 0
+        while True:
+            try:
+                canvas_file = self._upload(file_to_upload, parent_folder)
+                break
+            except (requests.RequestException, ValueError, KeyError) as e:
+                if attempt >= self.max_retries or not self._should_retry_upload(e):
+                    print(f"Could not upload {file_to_upload.name}: {e}")
+                    return False
+                delay = self.backoff_factor * (2 ** attempt)
+                print(f"Uploading {file_to_upload.name} failed, retry in {delay:.1f}s.")
+                time.sleep(delay)
+                attempt = attempt + 1
+
+        if ledger is not None:
+            ledger.record(file_to_upload, parent_folder, canvas_file)
+        print(f"Uploaded {file_to_upload.name}.")
         return True
 
-    def get_quiz_report(self, course_name: str, number: int) -> pd.DataFrame:
-        """Get a quiz report DataFrame for a specific course and quiz number.
+    def upload_files(
+            self,
+            files: List[Path],
+            parent_folder: str,
+            max_workers: int = 4,
+            ledger_file: Path = None,
+    ) -> Dict[Path, bool]:
+        """Upload several files at once, over the pooled session.
+
+        :param files: Paths to files intended for upload.
+        :param parent_folder: Canvas-side file tree destination.
+        :param max_workers: Most uploads in flight at the same time.
+        :param ledger_file: JSON file recording finished uploads, so that a
+            rerun only uploads what is missing.
+        :return: Whether each file was uploaded.
+        """
+        ledger = UploadLedger(ledger_file) if ledger_file is not None else None
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            results = pool.map(
+                lambda path: self.upload_file(path, parent_folder, ledger), files
+            )
+            return dict(zip(files, results))
+
+    def _open_quiz_report(self, course_name: str, number: int) -> BinaryIO:
+        """Open a quiz report CSV as a binary stream.
+
+        The CSV is never held in memory as a whole. Cached reports are opened
+        from disk; otherwise the download is streamed, through the cache if
+        there is one, or straight from the socket if not.
 
         :param course_name: Partial or complete name of the course, e.g. "CHE 334"
         :param number: Which Muddy Points survey to check, e.g. 1
-        :return: DataFrame created from downloaded CSV data.
+        :return: Binary stream of CSV data, to be closed by the caller.
         """
+        key = make_key(self.install_url, "report", course_name, number)
+        if self.offline:
+            cached = self.cache.get_report(key) if self.cache is not None else None
+            assert cached is not None, f"No cached report for {course_name} #{number}"
+            return cached.open("rb")
+
         course_id = self._get_course_id(course_name)
         quiz_id = self._get_muddy_points_id(course_id, number)
         report = self._get_quiz_report(course_id, quiz_id)
 
-        download_url = report.get("file").get("url")
-        response = self._get_with_token(download_url)
-        content = response.content
-        df = pd.read_csv(io.StringIO(content.decode("utf-8")))
+        version = report_version(report)
+        if self.cache is not None:
+            cached = self.cache.get_report(key, version)
+            if cached is not None:
+                print("Using cached report, no new submissions.")
+                return cached.open("rb")
+
+        download_url = report_file_url(report)
+        response = self._request("GET", download_url, stream=True)
+        response.raise_for_status()
+        if self.cache is not None:
+            with response, span("canvas.download"):
+                chunks = counted(
+                    response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE),
+                    "canvas.bytes_received",
+                )
+                return self.cache.put_report_chunks(key, version, chunks).open("rb")
+        # Streamed straight into pandas; the size is all that can be counted.
+        count("canvas.bytes_received", int(response.headers.get("Content-Length", 0)))
+        response.raw.decode_content = True
+        return response.raw
+
+    def get_quiz_report(
+            self,
+            course_name: str,
+            number: int,
+            usecols: Callable[[str], bool] = None,
+            dtype=None,
+            chunksize: int = None,
+    ) -> Union[pd.DataFrame, Iterator[pd.DataFrame]]:
+        """Get a quiz report DataFrame for a specific course and quiz number.
+
+        pandas parses the CSV straight from the download stream. Selecting only
+        the needed columns with usecols, and giving dtype up front so nothing has
+        to be inferred, keeps memory use down on large reports.
+
+        :param course_name: Partial or complete name of the course, e.g. "CHE 334"
+        :param number: Which Muddy Points survey to check, e.g. 1
+        :param usecols: Passed to pandas.read_csv, e.g. report_schema.report_usecols
+        :param dtype: Passed to pandas.read_csv.
+        :param chunksize: If given, return an iterator of DataFrames of this many rows.
+        :return: DataFrame created from downloaded CSV data.
+        """
+        stream = self._open_quiz_report(course_name, number)
+        if chunksize is not None:
+            return read_csv_chunks(stream, chunksize, usecols=usecols, dtype=dtype)
+        # Includes the download itself, when it is streamed straight from Canvas.
+        with stream, span("parse"):
+            df = pd.read_csv(stream, usecols=usecols, dtype=dtype)
         return df
@@ -0,0 +1,208 @@
+from collections import namedtuple
+from typing import Dict, List
+import numpy as np
+import pandas as pd
+
+from wordclouds import count_words
+
+"""Per-section aggregates of a quiz's responses, which a report is drawn from.
+
+Every figure and number in a report comes from a few sums over the responses:
+responses per section, how many students gave each confusion rating in each
+section, and the words of each section's short answers. Sums can be kept up to
+date by adding the rows of a report that are new and subtracting the ones that
+changed or are gone, which ResponseStore.update_quiz does, or computed from all
+of the responses at once. Both give a QuizAggregates of the same shape, so the
+figures drawn from them are identical, and FigureCache only redraws the figures
+of the sections that actually changed.
+
+The sums are passed around in long form, one row per (section, ...) with a
+count column, which is also how the ResponseStore keeps them.
+"""
+
+# Responses quoted per section, from the most confused students.
+MOST_CONFUSED = 3
+
+QuizAggregates = namedtuple(
+    "QuizAggregates",
+    [
+        "students",
+        "multi_section",
+        "section_counts",
+        "confusion",
+        "word_counts",
+        "most_confused",
+    ],
+)
+
+
+def long_form(counts: pd.Series, keys: List[str]) -> pd.DataFrame:
+    """Turn grouped counts into a DataFrame with a column per key and a count.
+
+    :param counts: Counts indexed by section and whatever else they are of.
+    :param keys: Names of the index levels, "section" first.
+    :return: DataFrame with the keys and a count column, sections as strings.
+    """
+    if len(counts) == 0:
+        # An update often has no rows (or no words) on one side.
+        return pd.DataFrame({key: [] for key in keys + ["count"]})
+    return (
+        counts.rename_axis(keys)
+        .reset_index(name="count")
+        .astype({"section": str})
+    )
+
+
+def section_totals(responses: pd.DataFrame) -> pd.DataFrame:
+    """Count the responses of each section.
+
+    :param responses: DataFrame from normalize_responses.
+    :return: DataFrame with section and count columns.
+    """
+    counts = responses.groupby("instructor", observed=True).size()
+    return long_form(counts, ["section"])
+
+
+def level_totals(responses: pd.DataFrame) -> pd.DataFrame:
+    """Count the confusion ratings of each section.
+
+    :param responses: DataFrame from normalize_responses.
+    :return: DataFrame with section, confusion and count columns.
+    """
+    counts = responses.groupby(["instructor", "confusion"], observed=True).size()
+    return long_form(counts, ["section", "confusion"])
+
+
+def word_totals(responses: pd.DataFrame) -> pd.DataFrame:
+    """Count the short-answer words of each section.
+
+    :param responses: DataFrame from normalize_responses.
+    :return: DataFrame with section, word and count columns.
+    """
+    return long_form(count_words(responses), ["section", "word"])
+
+
+def student_totals(responses: pd.DataFrame) -> Dict[str, int]:
+    """Count the students, and those who selected more than one section.
+
+    :param responses: DataFrame from normalize_responses.
+    :return: Number of "students" and of "multi_section" students.
+    """
+    rows = responses["student"].value_counts()
+    return {"students": len(rows), "multi_section": int((rows > 1).sum())}
+
+
+def most_confused(responses: pd.DataFrame) -> List[Dict]:
+    """Get the short answers of the most confused students.
+
+    Ties are broken by student ID, so the choice does not depend on the order
+    of the report.
+
+    :param responses: DataFrame from normalize_responses, usually one section's.
+    :return: Up to MOST_CONFUSED {response: confusion} dicts, most confused first.
+    """
+    rated = responses.dropna(subset=["confusion", "short_response"])
+    top = rated.sort_values(
+        ["confusion", "student"], ascending=[False, True], kind="mergesort"
+    ).head(MOST_CONFUSED)
+    return [
+        {response: int(confusion)}
+        for response, confusion in zip(top["short_response"], top["confusion"])
+    ]
+
+
+def level_table(levels: pd.DataFrame) -> pd.DataFrame:
+    """Pivot rating counts into a row per section and a column per rating.
+
+    :param levels: From level_totals, rows with no responses are left out.
+    :return: DataFrame of counts, sections and ratings in ascending order.
+    """
+    levels = levels[levels["count"] > 0]
+    if len(levels) == 0:
+        return pd.DataFrame(dtype=np.int64)
+    return (
+        levels.set_index(["section", "confusion"])["count"]
+        .astype(np.int64)
+        .unstack(fill_value=0)
+        .sort_index()
+        .sort_index(axis=1)
+    )
+
+
+def build_aggregates(
+        totals: Dict[str, int],
+        sections: pd.DataFrame,
+        levels: pd.DataFrame,
+        words: pd.DataFrame,
+        confused: Dict[str, List[Dict]],
+) -> QuizAggregates:
+    """Put the sums of a quiz in the shape the plotting functions take.
+
+    :param totals: From student_totals.
+    :param sections: From section_totals, rows with no responses are left out.
+    :param levels: From level_totals, rows with no responses are left out.
+    :param words: From word_totals, rows with no responses are left out.
+    :param confused: Output of most_confused, by section.
+    :return: The quiz's aggregates.
+    """
+    sections = sections[sections["count"] > 0].sort_values(
+        ["count", "section"], ascending=[False, True]
+    )
+    section_counts = pd.Series(
+        sections["count"].values.astype(np.int64),
+        index=pd.Index(sections["section"].values, name="section"),
+        name="count",
+    )
+    words = words[words["count"] > 0]
+    word_counts = words.set_index(["section", "word"])["count"].astype(np.int64)
+    return QuizAggregates(
+        totals["students"],
+        totals["multi_section"],
+        section_counts,
+        level_table(levels),
+        word_counts.sort_index(),
+        confused,
+    )
+
+
+def aggregate_responses(responses: pd.DataFrame) -> QuizAggregates:
+    """Compute a quiz's aggregates from all of its responses.
+
+    :param responses: DataFrame from normalize_responses.
+    :return: The quiz's aggregates.
+    """
+    confused = {
+        str(section): most_confused(section_df)
+        for section, section_df in responses.groupby("instructor", observed=True)
+    }
+    return build_aggregates(
+        student_totals(responses),
+        section_totals(responses),
+        level_totals(responses),
+        word_totals(responses),
+        confused,
+    )
+
+
+def section_levels(aggregates: QuizAggregates, section: str) -> pd.Series:
+    """Get how many students of a section gave each confusion rating.
+
+    :param aggregates: The quiz's aggregates.
+    :param section: Name of the section.
+    :return: Counts indexed by rating, empty if the section rated nothing.
+    """
+    if section not in aggregates.confusion.index:
+        return pd.Series([], dtype=np.int64)
+    levels = aggregates.confusion.loc[section]
+    return levels[levels > 0]
+
+
+def section_ratings(levels: pd.Series) -> pd.Series:
+    """Expand counts of ratings back into the ratings, in ascending order.
+
+    :param levels: Counts indexed by rating, from section_levels.
+    :return: Series of ratings.
+    """
+    return pd.Series(
+        np.repeat(levels.index.values.astype(float), levels.values), name="confusion"
+    )
@@ -0,0 +1,454 @@
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Dict, List
+import csv
+import json
+import os
+import pickle
+import time
+
+import instrumentation
+from defaults import (
+    LATEX_BUILD_DIR,
+    RESPONSE_STORE,
+    TEMPLATE_CACHE,
+    TIMINGS_FILE,
+    UPLOAD_LEDGER,
+)
+from instrumentation import span
+from report_cache import ReportCache
+from report_schema import report_usecols
+
+"""Many reports in one run, spread over worker processes and resumable.
+
+A job file lists the reports to build, one "COURSE_NAME,QUIZ_NUMBER,OUTPUT_DIR"
+line each. Every job works only in its own OUTPUT_DIR, its workspace, and runs
+the STAGES in order. Each stage leaves what the next one needs in the
+workspace: the fetched report.csv, contents.json and the pickled figure jobs,
+the figures, the rendered .tex file, and so on.
+
+A RunManifest in the workspace records every stage as it finishes, with the
+files it wrote. Running the batch again skips a job's stages up to the first
+one that did not finish (or whose files have gone missing since), and runs
+the rest. Only the report cache and the response store, both in the cache
+directory, are shared between jobs.
+"""
+
+STAGES = ["fetch", "process", "figures", "render", "typeset", "export", "upload"]
+
+MANIFEST_FILE = "manifest.json"
+
+# What each stage leaves in the workspace for the stages after it.
+REPORT_FILE = "report.csv"
+CONTENTS_FILE = "contents.json"
+FIGURE_JOBS_FILE = "figure_jobs.pickle"
+
+Job = namedtuple("Job", ["course_name", "quiz_number", "output_dir"])
+
+# Everything a job needs besides its Job, the same for every job of a batch.
+BatchSettings = namedtuple(
+    "BatchSettings",
+    [
+        "template_file",
+        "token",
+        "recipient_names",
+        "cache_dir",
+        "refresh",
+        "offline",
+        "incremental",
+        "figure_cache",
+        "latexmk",
+        "formats",
+        "upload_folder",
+    ],
+)
+
+
+def read_jobs(job_file: Path, output_dir: Path) -> List[Job]:
+    """Read the jobs of a batch, one "COURSE_NAME,QUIZ_NUMBER,OUTPUT_DIR" per line.
+
+    OUTPUT_DIR may be left out, the job then gets a directory of its own in
+    output_dir, as with generate-all.
+
+    :param job_file: CSV file listing the reports to generate.
+    :param output_dir: Directory for the jobs that do not name one.
+    :return: The jobs, in the order they are listed.
+    """
+    jobs = []
+    with job_file.open("r", newline="") as f:
+        for row in csv.reader(f):
+            if not row or row[0].startswith("#"):
+                continue
+            course_name, quiz_number = row[0].strip(), int(row[1])
+            if len(row) > 2 and row[2].strip():
+                job_dir = Path(row[2].strip())
+            else:
+                slug = course_name.replace(" ", "_")
+                job_dir = Path(output_dir / f"{slug}_{quiz_number}")
+            jobs.append(Job(course_name, quiz_number, job_dir))
+
+    workspaces = [job.output_dir.resolve() for job in jobs]
+    shared = sorted({str(d) for d in workspaces if workspaces.count(d) > 1})
+    if shared:
+        raise ValueError(f"Jobs share an output directory: {', '.join(shared)}")
+    return jobs
+
+
+class RunManifest:
+    """The stages of a job that have finished, kept in its workspace."""
+
+    def __init__(self, job: Job) -> None:
+        """Load the job's manifest, starting fresh if it is missing, corrupt or
+        was written for a different job.
+
+        :param job: The job, whose output_dir holds the manifest.
+        :return: None
+        """
+        self.manifest_file = Path(job.output_dir / MANIFEST_FILE)
+        self.job = [job.course_name, job.quiz_number]
+        try:
+            with self.manifest_file.open("r") as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            manifest = {}
+        if manifest.get("job") == self.job:
+            self.stages = manifest.get("stages", {})
+        else:
+            self.stages = {}
+
+    def is_done(self, stage: str) -> bool:
+        """Check whether a stage finished, and its files are still there.
+
+        :param stage: One of STAGES.
+        :return: True if the stage can be skipped.
+        """
+        entry = self.stages.get(stage)
+        return entry is not None and all(Path(f).exists() for f in entry["files"])
+
+    def record(self, stage: str, seconds: float, files: List[Path]) -> None:
+        """Remember that a stage finished, and save the manifest.
+
+        :param stage: One of STAGES.
+        :param seconds: How long it took.
+        :param files: What it wrote, that later stages need.
+        :return: None
+        """
+        self.stages[stage] = {
+            "finished_at": time.time(),
+            "seconds": seconds,
+            "files": [str(f) for f in files],
+        }
+        self.save()
+
+    def reset(self) -> None:
+        """Forget every finished stage, so the job is run from the start.
+
+        :return: None
+        """
+        self.stages = {}
+        self.save()
+
+    def save(self) -> None:
+        """Atomically write the manifest.
+
+        :return: None
+        """
+        tmp_file = self.manifest_file.with_suffix(".tmp")
+        with tmp_file.open("w") as f:
+            json.dump({"job": self.job, "stages": self.stages}, f, indent=1)
+        os.replace(str(tmp_file), str(self.manifest_file))
+
+
+class JobRunner:
+    """Runs the stages of one job in its workspace."""
+
+    def __init__(self, job: Job, settings: BatchSettings) -> None:
+        """Lay out the job's workspace.
+
+        :param job: The report to build.
+        :param settings: Options shared by every job of the batch.
+        :return: None
+        """
+        import export
+
+        self.job = job
+        self.settings = settings
+        self.figures_dir = Path(job.output_dir / "figures")
+        for d in [job.output_dir, self.figures_dir]:
+            export.create_dir(d)
+        base_filename = f"muddy_points_{job.quiz_number}"
+        self.outputs = {
+            fmt: Path(job.output_dir / f"{base_filename}.{fmt}")
+            for fmt in ["pdf", "docx", "tex", "zip"]
+        }
+        self._canvas = None
+
+    def canvas(self):
+        """Connect to Canvas, once, for the stages that need it.
+
+        :return: Canvas client.
+        """
+        if self._canvas is None:
+            from Canvas import Canvas
+
+            cache = ReportCache(self.settings.cache_dir, refresh=self.settings.refresh)
+            self._canvas = Canvas(
+                "asu.instructure.com",
+                "v1",
+                self.settings.token,
+                cache=cache,
+                offline=self.settings.offline,
+            )
+        return self._canvas
+
+    def close(self) -> None:
+        """Close the Canvas connection, if one was made.
+
+        :return: None
+        """
+        if self._canvas is not None:
+            self._canvas.close()
+
+    def _load_contents(self) -> Dict:
+        """Read the contents written by process.
+
+        :return: The report contents.
+        """
+        with Path(self.job.output_dir / CONTENTS_FILE).open("r") as f:
+            return json.load(f)
+
+    def fetch(self) -> List[Path]:
+        """Download the quiz report.
+
+        :return: The saved report CSV.
+        """
+        report_df = self.canvas().get_quiz_report(
+            self.job.course_name,
+            self.job.quiz_number,
+            usecols=report_usecols,
+            dtype=str,
+        )
+        report_file = Path(self.job.output_dir / REPORT_FILE)
+        report_df.to_csv(str(report_file), index=False)
+        return [report_file]
+
+    def process(self) -> List[Path]:
+        """Work out the contents and figure jobs, and resolve the recipients.
+
+        :return: The contents and the pickled figure jobs.
+        """
+        import pandas as pd
+        from response_store import ResponseStore
+        import data_processing
+
+        report_df = pd.read_csv(
+            str(Path(self.job.output_dir / REPORT_FILE)), dtype=str
+        )
+        with ResponseStore(Path(self.settings.cache_dir / RESPONSE_STORE)) as store:
+            contents, figure_jobs = data_processing.prepare_report_contents(
+                report_df,
+                self.job.quiz_number,
+                self.figures_dir,
+                store=store,
+                course_name=self.job.course_name,
+                incremental=self.settings.incremental,
+            )
+        if self.settings.recipient_names:
+            contents["recipients"] = self.canvas().get_recipient_ids(
+                self.settings.recipient_names, self.job.course_name
+            )
+
+        contents_file = Path(self.job.output_dir / CONTENTS_FILE)
+        with contents_file.open("w+") as f:
+            json.dump(contents, f)
+        figure_jobs_file = Path(self.job.output_dir / FIGURE_JOBS_FILE)
+        with figure_jobs_file.open("wb") as f:
+            pickle.dump(figure_jobs, f, protocol=4)
+        return [contents_file, figure_jobs_file]
+
+    def figures(self) -> List[Path]:
+        """Render the figures, skipping those already rendered from the same data.
+
+        :return: The figures.
+        """
+        from data_processing import FIGURE_MANIFEST
+        from figures import FigureCache, figure_outputs, output_file, render_figures
+
+        with Path(self.job.output_dir / FIGURE_JOBS_FILE).open("rb") as f:
+            figure_jobs = pickle.load(f)
+        cache = None
+        if self.settings.figure_cache:
+            cache = FigureCache(Path(self.job.output_dir / FIGURE_MANIFEST))
+        outputs = figure_outputs(self.settings.formats)
+        render_figures(figure_jobs, cache=cache, outputs=outputs)
+        return [
+            output_file(job.filename, output)
+            for job in figure_jobs
+            for output in outputs
+        ]
+
+    def render(self) -> List[Path]:
+        """Render the LaTeX template with the contents.
+
+        :return: The .tex file.
+        """
+        from templates import ReportTemplate
+        import export
+
+        # Compiled once per worker, and only once ever until the template changes.
+        tpl = ReportTemplate(
+            self.settings.template_file,
+            Path(self.settings.cache_dir / TEMPLATE_CACHE),
+        )
+        # The .tex file is what the PDF and the Word file are made from, so it
+        # is written even when it is not one of the formats asked for.
+        rendered_latex = tpl.render(self._load_contents())
+        export.make_texfile(rendered_latex, self.outputs["tex"])
+        return [self.outputs["tex"]]
+
+    def typeset(self) -> List[Path]:
+        """Typeset the PDF, if it is one of the formats.
+
+        :return: The PDF, if any.
+        """
+        from typesetting import Typesetter
+
+        if "pdf" not in self.settings.formats:
+            return []
+        typesetter = Typesetter(
+            Path(self.job.output_dir / LATEX_BUILD_DIR),
+            self.settings.template_file,
+            backend="latexmk" if self.settings.latexmk else "pdflatex",
+        )
+        with self.outputs["tex"].open("r") as f:
+            rendered_latex = f.read()
+        typesetter.build_pdf(
+            rendered_latex, self.outputs["pdf"], self.figures_dir.glob("*")
+        )
+        return [self.outputs["pdf"]]
+
+    def export(self) -> List[Path]:
+        """Convert to Word and archive, as far as the formats ask for.
+
+        :return: The Word file and archive, if any.
+        """
+        import export
+
+        formats = self.settings.formats
+        if "docx" in formats:
+            export.make_docx(
+                self.outputs["tex"], self.outputs["docx"], self.figures_dir
+            )
+        if "zip" in formats:
+            archived = [
+                self.outputs[fmt] for fmt in ["pdf", "docx", "tex"] if fmt in formats
+            ]
+            export.make_archive(self.outputs["zip"], archived, self.figures_dir)
+        return [self.outputs[fmt] for fmt in ["docx", "zip"] if fmt in formats]
+
+    def upload(self) -> List[Path]:
+        """Upload the outputs to Canvas, if there is an upload folder.
+
+        :return: Nothing, the uploads are recorded in the upload ledger.
+        """
+        if not self.settings.upload_folder:
+            return []
+        files = [self.outputs[fmt] for fmt in self.settings.formats]
+        results = self.canvas().upload_files(
+            files,
+            self.settings.upload_folder,
+            ledger_file=Path(self.job.output_dir / UPLOAD_LEDGER),
+        )
+        failed = [path.name for path, uploaded in results.items() if not uploaded]
+        if failed:
+            raise RuntimeError(f"Could not upload {', '.join(failed)}")
+        return []
+
+
+def run_job(job: Job, settings: BatchSettings, restart: bool = False) -> Dict:
+    """Run a job's unfinished stages.
+
+    Once a stage has to run, every stage after it runs too, since its inputs
+    may have changed. A stage that fails stops the job, to be resumed from that
+    stage next time.
+
+    :param job: The report to build.
+    :param settings: Options shared by every job of the batch.
+    :param restart: Run every stage, even those that finished before.
+    :return: "ran" or "skipped" by stage, and the "error" if a stage, or
+        setting up the job, failed.
+    """
+    status = {}
+    resuming = True
+    runner = None
+    stage = "setup"
+    try:
+        runner = JobRunner(job, settings)
+        manifest = RunManifest(job)
+        if restart:
+            manifest.reset()
+        for stage in STAGES:
+            if resuming and manifest.is_done(stage):
+                status[stage] = "skipped"
+                continue
+            resuming = False
+            start = time.perf_counter()
+            with span(f"batch.{stage}", course=job.course_name, quiz=job.quiz_number):
+                files = getattr(runner, stage)()
+            manifest.record(stage, time.perf_counter() - start, files)
+            status[stage] = "ran"
+    except Exception as e:
+        status["error"] = f"{stage}: {e!r}"
+    finally:
+        if runner is not None:
+            runner.close()
+    return status
+
+
+def run_job_in_worker(job: Job, settings: BatchSettings, restart: bool) -> Dict:
+    """Run a job in a worker process, saving its timings to its workspace.
+
+    :param job: The report to build.
+    :param settings: Options shared by every job of the batch.
+    :param restart: Run every stage, even those that finished before.
+    :return: As run_job.
+    """
+    recorder = instrumentation.reset()
+    try:
+        return run_job(job, settings, restart)
+    finally:
+        try:
+            recorder.write(Path(job.output_dir / TIMINGS_FILE))
+        except OSError:
+            # The workspace could not be created, as run_job reports.
+            pass
+
+
+def run_batch(
+        jobs: List[Job],
+        settings: BatchSettings,
+        workers: int = 1,
+        restart: bool = False,
+) -> Dict[Job, Dict]:
+    """Run every job, several at a time.
+
+    :param jobs: The reports to build.
+    :param settings: Options shared by every job of the batch.
+    :param workers: Worker processes to use, 1 runs the jobs in this process.
+    :param restart: Run every stage of every job, even those that finished before.
+    :return: What run_job returned, by job, in the order of jobs.
+    """
+    if workers <= 1 or len(jobs) <= 1:
+        results = [run_job(job, settings, restart) for job in jobs]
+    else:
+        with ProcessPoolExecutor(max_workers=min(workers, len(jobs))) as pool:
+            results = list(
+                pool.map(
+                    run_job_in_worker,
+                    jobs,
+                    [settings] * len(jobs),
+                    [restart] * len(jobs),
+                )
+            )
+    return dict(zip(jobs, results))
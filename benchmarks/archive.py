@@ -0,0 +1,99 @@
+import click
+import sys
+import tempfile
+import time
+import zipfile
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import export  # noqa: E402
+
+"""Archive benchmark on a figures directory full of 300 dpi figures.
+
+Compares a plain zipfile archive, deflating every member, with
+export.make_archive, which stores the figures that are already compressed.
+
+    python benchmarks/archive.py --figures 40
+"""
+
+
+def make_figures(figures_dir: Path, count: int) -> None:
+    """Draw noisy 300 dpi figures, alternating between PNG and PDF.
+
+    :param figures_dir: Directory to write the figures to.
+    :param count: How many figures to draw.
+    :return: None
+    """
+    import matplotlib
+
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    import numpy as np
+
+    random = np.random.RandomState(0)
+    for i in range(count):
+        fig = plt.figure(figsize=(7.5, 3), dpi=300)
+        ax = fig.add_subplot(1, 1, 1)
+        ax.imshow(random.rand(60, 150), aspect="auto")
+        ax.plot(random.rand(500).cumsum())
+        suffix = "png" if i % 2 == 0 else "pdf"
+        fig.savefig(str(figures_dir / f"figure_{i}.{suffix}"))
+        plt.close(fig)
+
+
+def serial_archive(archive_name: Path, files: list, figures: Path) -> None:
+    """The archive as it used to be built: deflate everything, in one thread.
+
+    :param archive_name: Path to write the archive to.
+    :param files: Report files to include.
+    :param figures: Directory of figures to include.
+    :return: None
+    """
+    with zipfile.ZipFile(str(archive_name), mode="w") as zf:
+        for filename in files + list(figures.glob("**/*")):
+            zf.write(str(filename), compress_type=zipfile.ZIP_DEFLATED)
+
+
+def timed(run) -> float:
+    """Time a function call.
+
+    :param run: Function to call.
+    :return: Seconds it took.
+    """
+    start = time.perf_counter()
+    run()
+    return time.perf_counter() - start
+
+
+@click.command()
+@click.option("--figures", "count", type=click.INT, default=40, help="Figures.")
+def main(count):
+    """Time building the report archive."""
+    with tempfile.TemporaryDirectory() as tmp:
+        output_dir = Path(tmp)
+        figures_dir = Path(output_dir / "figures")
+        figures_dir.mkdir()
+        make_figures(figures_dir, count)
+        report = Path(output_dir / "report.tex")
+        report.write_text("\\section{Muddy Points}\n" * 2000)
+        files = [report]
+        archive_name = Path(output_dir / "report.zip")
+
+        results = {
+            "serial deflate": timed(
+                lambda: serial_archive(archive_name, files, figures_dir)
+            ),
+            "make_archive": timed(
+                lambda: export.make_archive(archive_name, files, figures_dir)
+            ),
+        }
+        size = sum(p.stat().st_size for p in figures_dir.iterdir()) / 2 ** 20
+
+    print(f"{count} figures, {size:.1f} MiB")
+    for name, seconds in results.items():
+        print(f"{name}: {seconds:.3f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+import asyncio
+import click
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from AsyncCanvas import AsyncCanvas  # noqa: E402
+from mock_canvas import MockCanvas  # noqa: E402
+from report_schema import report_usecols  # noqa: E402
+from synthetic import generate_report  # noqa: E402
+
+"""Fetch benchmark of AsyncCanvas at growing concurrency.
+
+Serves a number of courses' quiz reports from a local MockCanvas that answers
+every request after a fixed latency, and times AsyncCanvas.get_quiz_reports
+fetching all of them, as generate-all does, at each concurrency. With enough
+reports, wall-clock time should fall close to 1/concurrency until the
+reports run out.
+
+    python benchmarks/concurrency.py --courses 4 --quizzes 4 --latency 0.05
+"""
+
+
+async def fetch(api_base: str, pairs: list, concurrency: int) -> list:
+    """Fetch every report, as cli.fetch_all does.
+
+    :param api_base: Where the mock serves the API.
+    :param pairs: (course_name, quiz_number) for every report wanted.
+    :param concurrency: Maximum number of requests in flight.
+    :return: Report DataFrames.
+    """
+    async with AsyncCanvas(
+        "asu.instructure.com",
+        "v1",
+        "benchmark",
+        concurrency=concurrency,
+        requests_per_second=1000.0,
+    ) as c:
+        c.api_base = api_base
+        return await c.get_quiz_reports(pairs, usecols=report_usecols, dtype=str)
+
+
+@click.command()
+@click.option("--courses", type=click.INT, default=4, help="Courses.")
+@click.option("--quizzes", type=click.INT, default=4, help="Quizzes per course.")
+@click.option("--rows", type=click.INT, default=500, help="Students per report.")
+@click.option(
+    "--latency", type=click.FLOAT, default=0.05, help="Seconds per request."
+)
+@click.option(
+    "--concurrency",
+    "levels",
+    default="1,2,4,8",
+    help="Comma-separated concurrency levels.",
+)
+def main(courses, quizzes, rows, latency, levels):
+    """Time fetching many reports with AsyncCanvas at each concurrency."""
+    with tempfile.TemporaryDirectory() as tmp:
+        reports = {}
+        for course in range(courses):
+            for quiz in range(1, quizzes + 1):
+                report_file = Path(tmp) / f"course_{course}_{quiz}.csv"
+                report = generate_report(rows, seed=course * 100 + quiz)
+                report.to_csv(str(report_file), index=False)
+                reports[(f"CHE 3{course:02}", quiz)] = report_file
+        pairs = sorted(reports)
+
+        results = {}
+        with MockCanvas(reports, latency=latency) as server:
+            for concurrency in [int(c) for c in levels.split(",") if c.strip()]:
+                start = time.perf_counter()
+                frames = asyncio.run(fetch(server.api_base, pairs, concurrency))
+                results[concurrency] = time.perf_counter() - start
+                assert [len(df) for df in frames] == [rows] * len(pairs)
+            requests = len(server.requests)
+
+    print(
+        f"{len(pairs)} reports of {rows} rows, {latency * 1000:.0f} ms per request, "
+        f"{requests} requests in all"
+    )
+    baseline = next(iter(results.values()))
+    for concurrency, seconds in results.items():
+        print(
+            f"concurrency {concurrency}: {seconds:.3f}s, "
+            f"{baseline / seconds:.2f}x of concurrency {next(iter(results))}"
+        )
+
+
+if __name__ == "__main__":
+    main()
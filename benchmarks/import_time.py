@@ -0,0 +1,91 @@
+import click
+import re
+import subprocess
+import sys
+from pathlib import Path
+from typing import Dict
+
+"""Import-time benchmark for the command-line entrypoint.
+
+Runs `python -X importtime` on the modules each startup path imports and fails
+if the total is over budget, or if the plotting stack sneaks into a path that
+never draws a figure.
+
+    python benchmarks/import_time.py --budget_ms 250
+"""
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+
+# What each startup path imports before doing any work.
+STARTUP_PATHS = {
+    "help": "import cli",
+    # generate --saved and render: templates loads jinja2 and latex.jinja2
+    # once it compiles, typesetting and pipeline build the outputs.
+    "render-only": (
+        "import cli, export, figures, pipeline, templates, typesetting, "
+        "jinja2, latex.jinja2"
+    ),
+}
+
+# Modules that only the figure stage should ever load.
+PLOTTING_MODULES = ["matplotlib", "seaborn", "wordcloud", "pandas", "data_processing"]
+
+IMPORTTIME_LINE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)")
+
+
+def import_times(statement: str) -> Dict[str, int]:
+    """Import modules in a fresh interpreter and record how long each took.
+
+    :param statement: Python code doing the imports.
+    :return: Cumulative microseconds for every top-level import, by module.
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", statement],
+        cwd=str(REPO_DIR),
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"{statement!r} failed:\n{result.stderr}")
+
+    times = {}
+    for line in result.stderr.splitlines():
+        match = IMPORTTIME_LINE.match(line)
+        if match is None:
+            continue
+        _, cumulative, indent, module = match.groups()
+        # Nested imports are already counted in their parent's cumulative time.
+        if len(indent) == 1:
+            times[module] = int(cumulative)
+        times.setdefault(module, 0)
+    return times
+
+
+@click.command()
+@click.option(
+    "--budget_ms", type=click.FLOAT, default=250.0, help="Budget for each path."
+)
+@click.option("--repeat", type=click.INT, default=5, help="Runs per path, best kept.")
+def main(budget_ms, repeat):
+    """Check that every CLI startup path imports quickly and stays light."""
+    failed = False
+    for name, statement in STARTUP_PATHS.items():
+        runs = [import_times(statement) for _ in range(repeat)]
+        best = min(sum(times.values()) for times in runs) / 1000
+        loaded = [m for m in PLOTTING_MODULES if m in runs[0]]
+
+        slowest = sorted(runs[0].items(), key=lambda item: -item[1])[:3]
+        detail = ", ".join(f"{m} {us / 1000:.0f}ms" for m, us in slowest)
+        print(f"{name}: {best:.0f}ms of {budget_ms:.0f}ms ({detail})")
+        if best > budget_ms:
+            print(f"  over budget by {best - budget_ms:.0f}ms")
+            failed = True
+        if loaded:
+            print(f"  imports the plotting stack: {', '.join(loaded)}")
+            failed = True
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+import click
+import io
+import multiprocessing
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from mock_canvas import MockCanvas  # noqa: E402
+from synthetic import generate_report  # noqa: E402
+
+"""Memory benchmark of downloading and parsing a large quiz report.
+
+Serves a synthetic report from a local MockCanvas and, each in a fresh
+process, parses it three ways:
+
+    full body   the whole download read into memory, then parsed, every column
+                inferred (how reports used to be read)
+    streamed    Canvas.get_quiz_report, parsed straight from the socket with
+                report_usecols and dtype=str
+    chunks      the same, chunksize rows at a time, nothing kept
+
+and reports each one's peak traced allocation (tracemalloc, which numpy and
+pandas report to) and the process' peak RSS.
+
+AsyncCanvas.get_quiz_report, used by generate-all, still reads the whole body
+before parsing it, so its peak is that of "full body" with usecols applied.
+
+    python benchmarks/memory.py --rows 100000
+"""
+
+COURSE = "CHE 334"
+QUIZ = 1
+
+
+def parse(mode: str, api_base: str, chunksize: int) -> dict:
+    """Fetch and parse the report one way, measuring memory.
+
+    :param mode: "full body", "streamed" or "chunks".
+    :param api_base: Where the mock serves the API.
+    :param chunksize: Rows per chunk, for "chunks".
+    :return: Rows parsed, seconds, and peak traced and resident MiB.
+    """
+    import pandas as pd
+    from Canvas import Canvas
+    from quiz_reports import report_file_url
+    from report_schema import report_usecols
+
+    c = Canvas("asu.instructure.com", "v1", "benchmark")
+    c.api_base = api_base
+    tracemalloc.start()
+    start = time.perf_counter()
+    if mode == "full body":
+        course_id = c._get_course_id(COURSE)
+        quiz_id = c._get_muddy_points_id(course_id, QUIZ)
+        report = c._get_quiz_report(course_id, quiz_id)
+        content = c._request("GET", report_file_url(report)).content
+        rows = len(pd.read_csv(io.BytesIO(content)))
+    elif mode == "streamed":
+        rows = len(c.get_quiz_report(COURSE, QUIZ, usecols=report_usecols, dtype=str))
+    else:
+        chunks = c.get_quiz_report(
+            COURSE, QUIZ, usecols=report_usecols, dtype=str, chunksize=chunksize
+        )
+        rows = sum(len(chunk) for chunk in chunks)
+    seconds = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    c.close()
+    # ru_maxrss is in KiB on Linux, bytes on macOS.
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    rss = rss / 2 ** 20 if sys.platform == "darwin" else rss / 2 ** 10
+    return {"rows": rows, "seconds": seconds, "traced": peak / 2 ** 20, "rss": rss}
+
+
+@click.command()
+@click.option("--rows", type=click.INT, default=100000, help="Students.")
+@click.option("--words", type=click.INT, default=12, help="Words per short answer.")
+@click.option("--chunksize", type=click.INT, default=10000, help="Rows per chunk.")
+def main(rows, words, chunksize):
+    """Compare peak memory of streamed and full-body report parsing."""
+    with tempfile.TemporaryDirectory() as tmp:
+        report_file = Path(tmp) / "report.csv"
+        generate_report(rows, words=words).to_csv(str(report_file), index=False)
+        size = report_file.stat().st_size / 2 ** 20
+
+        results = {}
+        # A fresh process for each, so one's peak cannot hide another's.
+        context = multiprocessing.get_context("spawn")
+        with MockCanvas({(COURSE, QUIZ): report_file}) as server:
+            for mode in ["full body", "streamed", "chunks"]:
+                with context.Pool(1) as pool:
+                    results[mode] = pool.apply(
+                        parse, (mode, server.api_base, chunksize)
+                    )
+
+    print(f"{rows} rows, {size:.1f} MiB CSV")
+    for mode, result in results.items():
+        assert result["rows"] == rows
+        print(
+            f"{mode:10} peak traced {result['traced']:7.1f} MiB, "
+            f"peak RSS {result['rss']:7.1f} MiB, {result['seconds']:.2f}s"
+        )
+
+
+if __name__ == "__main__":
+    main()
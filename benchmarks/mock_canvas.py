@@ -0,0 +1,262 @@
+import itertools
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from pathlib import Path
+from socketserver import ThreadingMixIn
+from typing import Dict, List, Tuple
+from urllib.parse import parse_qs, urlparse
+
+"""A local stand-in for the parts of the Canvas API that Canvas.py uses.
+
+Serves courses, Muddy Points quizzes, quiz reports (with their progress and
+file download), recipient search and the three-step file upload, from reports
+given as CSV files. Lists are paginated with Link headers like Canvas does, and
+every response carries a generous X-Rate-Limit-Remaining, so nothing is
+throttled unless asked to be. A latency can be added to every request, to
+stand in for the round trip to a real Canvas; requests are served
+concurrently, so overlapping requests overlap their latency too.
+
+Point a client at it by replacing its api_base:
+
+    with MockCanvas({("CHE 334", 1): Path("report.csv")}) as server:
+        c = Canvas("asu.instructure.com", "v1", "token")
+        c.api_base = server.api_base
+"""
+
+# Items per page of a list, unless the request asks for fewer.
+PAGE_SIZE = 10
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class MockCanvas:
+    """A Canvas API server on localhost, running on a background thread."""
+
+    def __init__(
+            self,
+            reports: Dict[Tuple[str, int], Path],
+            people: List[str] = None,
+            progress_polls: int = 0,
+            latency: float = 0.0,
+    ) -> None:
+        """Set up the courses and quizzes the reports belong to.
+
+        :param reports: Report CSV by (course name, quiz number).
+        :param people: Names recipient search finds.
+        :param progress_polls: Times a new report's progress is polled before it
+            is done; 0 hands out finished reports straight away.
+        :param latency: Seconds every request takes before it is answered.
+        :return: None
+        """
+        self.reports = reports
+        self.progress_polls = progress_polls
+        self.latency = latency
+        courses = sorted({course for course, _ in reports})
+        self.courses = [{"id": 1000 + i, "name": c} for i, c in enumerate(courses)]
+        self.quizzes = {}
+        for (course, number), report_file in reports.items():
+            course_id = next(c["id"] for c in self.courses if c["name"] == course)
+            quiz_id = course_id * 100 + number
+            self.quizzes[quiz_id] = {
+                "id": quiz_id,
+                "course_id": course_id,
+                "title": f"Muddy and Interesting Points #{number}",
+                "file": report_file,
+            }
+        self.people = [
+            {"id": 2000 + i, "full_name": name, "name": name}
+            for i, name in enumerate(people or [])
+        ]
+        self.requests = []
+        self.uploads = {}
+        self._polls = {}
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        """Where the server listens, e.g. "http://127.0.0.1:50123"."""
+        host, port = self._server.server_address
+        return f"http://{host}:{port}"
+
+    @property
+    def api_base(self) -> str:
+        """What to set a client's api_base to."""
+        return self.url + "/api/v1"
+
+    def start(self) -> "MockCanvas":
+        """Start serving, on a free port.
+
+        :return: The server.
+        """
+        mock = self
+
+        class Handler(_Handler):
+            canvas = mock
+
+        self._server = _Server(("127.0.0.1", 0), Handler)
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        """Stop serving.
+
+        :return: None
+        """
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    def __enter__(self) -> "MockCanvas":
+        return self.start()
+
+    def __exit__(self, *exc_info) -> None:
+        self.stop()
+
+    def report(self, quiz_id: int, report_id: int) -> Dict:
+        """Describe a quiz's report, finished once it has been polled enough.
+
+        :param quiz_id: The quiz.
+        :param report_id: The report.
+        :return: Canvas' JSON representation of the report.
+        """
+        quiz = self.quizzes[quiz_id]
+        report = {
+            "id": report_id,
+            "report_type": "student_analysis",
+            "updated_at": "2019-09-09T08:00:00Z",
+            "progress_url": f"{self.api_base}/progress/{report_id}",
+            "progress": {"workflow_state": "running"},
+        }
+        if self._polls.get(report_id, 0) >= self.progress_polls:
+            report["progress"] = {"workflow_state": "completed"}
+            report["file"] = {
+                "url": f"{self.url}/files/{quiz_id}/report.csv?verifier=mock",
+                "updated_at": "2019-09-09T08:00:00Z",
+                "size": quiz["file"].stat().st_size,
+            }
+        return report
+
+
+class _Handler(BaseHTTPRequestHandler):
+    """Routes requests to the MockCanvas it belongs to."""
+
+    canvas = None
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args) -> None:
+        pass
+
+    def _send(self, status: int, body: bytes, headers: Dict = None) -> None:
+        self.send_response(status)
+        headers = dict(headers or {})
+        headers.setdefault("Content-Type", "application/json")
+        headers["Content-Length"] = str(len(body))
+        headers["X-Rate-Limit-Remaining"] = "700.0"
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def _json(self, data, status: int = 200, headers: Dict = None) -> None:
+        self._send(status, json.dumps(data).encode(), headers)
+
+    def _page(self, items: List[Dict], query: Dict) -> None:
+        per_page = min(int(query.get("per_page", [PAGE_SIZE])[0]), PAGE_SIZE)
+        page = int(query.get("page", ["1"])[0])
+        start = (page - 1) * per_page
+        headers = {}
+        if start + per_page < len(items):
+            url = urlparse(self.path)
+            following = dict(query, page=[str(page + 1)], per_page=[str(per_page)])
+            params = "&".join(f"{k}={v}" for k, vs in following.items() for v in vs)
+            headers["Link"] = (
+                f'<{self.canvas.url}{url.path}?{params}>; rel="next"'
+            )
+        self._json(items[start:start + per_page], headers=headers)
+
+    def _body(self) -> bytes:
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def do_HEAD(self) -> None:
+        self.do_GET()
+
+    def do_GET(self) -> None:
+        canvas = self.canvas
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        parts = url.path.strip("/").split("/")
+        with canvas._lock:
+            canvas.requests.append((self.command, url.path))
+        time.sleep(canvas.latency)
+
+        if parts[0] == "files":
+            quiz = canvas.quizzes[int(parts[1])]
+            body = quiz["file"].read_bytes()
+            return self._send(200, body, {"Content-Type": "text/csv"})
+        api = parts[2:]
+        if api == ["courses"]:
+            term = query.get("search_term", [""])[0]
+            courses = [c for c in canvas.courses if term in c["name"]]
+            return self._page(courses, query)
+        if len(api) == 3 and api[2] == "quizzes":
+            course_id = int(api[1])
+            quizzes = [
+                {"id": q["id"], "title": q["title"]}
+                for q in canvas.quizzes.values()
+                if q["course_id"] == course_id
+            ]
+            return self._page(quizzes, query)
+        if len(api) == 5 and api[4] == "reports":
+            return self._json([])
+        if len(api) == 6 and api[4] == "reports":
+            return self._json(canvas.report(int(api[3]), int(api[5])))
+        if api[0] == "progress":
+            report_id = int(api[1])
+            with canvas._lock:
+                canvas._polls[report_id] = canvas._polls.get(report_id, 0) + 1
+                done = canvas._polls[report_id] >= canvas.progress_polls
+            state = "completed" if done else "running"
+            return self._json({"workflow_state": state})
+        if api == ["search", "recipients"]:
+            term = query.get("search", [""])[0].casefold()
+            people = [p for p in canvas.people if term in p["full_name"].casefold()]
+            return self._page(people, query)
+        if api[0] == "files":
+            return self._json(canvas.uploads[int(api[1])])
+        self._json({"errors": [{"message": "not found"}]}, status=404)
+
+    def do_POST(self) -> None:
+        canvas = self.canvas
+        url = urlparse(self.path)
+        parts = url.path.strip("/").split("/")
+        body = self._body()
+        with canvas._lock:
+            canvas.requests.append((self.command, url.path))
+            new_id = next(canvas._ids)
+        time.sleep(canvas.latency)
+
+        if parts[0] == "upload":
+            # The storage backend: answers with where to confirm the upload.
+            canvas.uploads[new_id] = {"id": new_id, "size": len(body)}
+            location = f"{canvas.api_base}/files/{new_id}"
+            return self._json({}, status=201, headers={"Location": location})
+        api = parts[2:]
+        if len(api) == 5 and api[4] == "reports":
+            return self._json(canvas.report(int(api[3]), new_id))
+        if api == ["users", "self", "files"]:
+            fields = parse_qs(body.decode())
+            ticket = {
+                "upload_url": f"{canvas.url}/upload",
+                "upload_params": {"filename": fields.get("name", ["file"])[0]},
+            }
+            return self._json(ticket)
+        self._json({"errors": [{"message": "not found"}]}, status=404)
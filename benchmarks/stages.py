@@ -0,0 +1,192 @@
+import click
+import datetime
+import json
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Dict, List
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import instrumentation  # noqa: E402
+from batch import STAGES, BatchSettings, Job, JobRunner  # noqa: E402
+from mock_canvas import MockCanvas  # noqa: E402
+from synthetic import generate_report  # noqa: E402
+
+"""End-to-end benchmark of every stage of generating a report.
+
+For each report size, writes a synthetic quiz report, serves it from a local
+MockCanvas, and times the stages of a batch job (fetch, process, figures,
+render, typeset, export, upload) one after another, from a cold cache. PDFs are
+only typeset if pdflatex is installed, and Word files only written if pandoc
+is. Each run is appended to a results file, together with the commit it ran
+on, and compared with the run before it. The results file is local to the
+checkout (benchmarks/results.json is ignored by git), pass --results_file to
+keep it elsewhere.
+
+    python benchmarks/stages.py --rows 100,10000,100000
+"""
+
+REPO = Path(__file__).resolve().parent.parent
+
+COURSE = "CHE 334"
+QUIZ = 1
+RECIPIENTS = ["Heather Emady", "Jeffrey Varman"]
+
+
+class MockJobRunner(JobRunner):
+    """A JobRunner whose Canvas is the mock server."""
+
+    def __init__(self, job: Job, settings: BatchSettings, server: MockCanvas):
+        super().__init__(job, settings)
+        self.server = server
+
+    def canvas(self):
+        canvas = super().canvas()
+        canvas.api_base = self.server.api_base
+        return canvas
+
+
+def available_formats() -> List[str]:
+    """Choose the output formats the tools installed here can make.
+
+    :return: Formats to benchmark.
+    """
+    formats = ["tex", "zip"]
+    if shutil.which("pdflatex"):
+        formats.insert(0, "pdf")
+    if shutil.which("pandoc"):
+        formats.insert(-1, "docx")
+    return formats
+
+
+def git_commit() -> str:
+    """Get the commit being benchmarked.
+
+    :return: Short hash, with "+" if the tree has changes, or "" outside git.
+    """
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=str(REPO), stdout=subprocess.PIPE, check=True,
+        ).stdout.decode().strip()
+        dirty = subprocess.run(
+            ["git", "status", "--porcelain", "--untracked-files=no"],
+            cwd=str(REPO), stdout=subprocess.PIPE, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+    return commit + ("+" if dirty else "")
+
+
+def run_stages(rows: int, sections: int, workdir: Path, formats: List[str]) -> Dict:
+    """Generate one report of a given size, timing each stage.
+
+    :param rows: Students in the report.
+    :param sections: Lecture sections.
+    :param workdir: Empty directory to work in.
+    :param formats: Output formats.
+    :return: Seconds by stage, and the instrumentation counters.
+    """
+    report_file = Path(workdir / "report.csv")
+    generate_report(rows, sections=sections).to_csv(str(report_file), index=False)
+
+    settings = BatchSettings(
+        template_file=Path(REPO / "report_template.tex"),
+        token="benchmark",
+        recipient_names=RECIPIENTS,
+        cache_dir=Path(workdir / "cache"),
+        refresh=False,
+        offline=False,
+        incremental=False,
+        figure_cache=False,
+        latexmk=False,
+        formats=formats,
+        upload_folder="benchmarks",
+    )
+    job = Job(COURSE, QUIZ, Path(workdir / "output"))
+    recorder = instrumentation.reset()
+    seconds = {}
+    with MockCanvas({(COURSE, QUIZ): report_file}, people=RECIPIENTS) as server:
+        runner = MockJobRunner(job, settings, server)
+        try:
+            for stage in STAGES:
+                start = time.perf_counter()
+                getattr(runner, stage)()
+                seconds[stage] = time.perf_counter() - start
+        finally:
+            runner.close()
+    seconds["total"] = sum(seconds.values())
+    return {"seconds": seconds, "counters": recorder.report()["counters"]}
+
+
+def load_results(results_file: Path) -> List[Dict]:
+    """Read the runs saved so far.
+
+    :param results_file: JSON results file.
+    :return: Runs, oldest first.
+    """
+    if not results_file.exists():
+        return []
+    with results_file.open("r") as f:
+        return json.load(f)
+
+
+def compare(run: Dict, previous: Dict = None) -> None:
+    """Print a run's stage timings, next to those of the run before it.
+
+    :param run: The run.
+    :param previous: The run before it, if any.
+    :return: None
+    """
+    for rows, result in run["sizes"].items():
+        before = (previous or {}).get("sizes", {}).get(rows)
+        print(f"{rows} rows")
+        for stage, seconds in result["seconds"].items():
+            line = f"  {stage:8} {seconds:8.3f}s"
+            if before and stage in before["seconds"] and before["seconds"][stage]:
+                ratio = seconds / before["seconds"][stage]
+                line += f"  {ratio:5.2f}x of {previous['commit'] or 'previous'}"
+            print(line)
+
+
+@click.command()
+@click.option(
+    "--rows", default="100,10000,100000", help="Comma-separated report sizes."
+)
+@click.option("--sections", type=click.INT, default=3, help="Lecture sections.")
+@click.option(
+    "-o",
+    "--results_file",
+    type=Path,
+    default=Path(REPO / "benchmarks" / "results.json"),
+    help="JSON file the runs are appended to.",
+)
+def main(rows, sections, results_file):
+    """Time each stage of generating a report, at several report sizes."""
+    formats = available_formats()
+    run = {
+        "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "formats": formats,
+        "sizes": {},
+    }
+    for size in [int(r) for r in rows.split(",") if r.strip()]:
+        with tempfile.TemporaryDirectory() as tmp:
+            run["sizes"][str(size)] = run_stages(size, sections, Path(tmp), formats)
+
+    results = load_results(results_file)
+    compare(run, results[-1] if results else None)
+    results.append(run)
+    with results_file.open("w") as f:
+        json.dump(results, f, indent=1)
+    print(f"Saved to {results_file}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+import click
+from pathlib import Path
+from typing import List
+
+"""Synthetic Canvas quiz reports, for benchmarks.
+
+Writes a student_analysis CSV laid out like the ones Canvas generates: the
+student columns, then a "<question id>: <question text>" column for each of
+the attendance, confusion and short-answer questions, each followed by its
+points column, then the score columns. Rows, sections and the length of the
+short answers are configurable; the same seed always gives the same report.
+
+    python benchmarks/synthetic.py --rows 10000 --sections 4 -o report.csv
+"""
+
+QUESTIONS = {
+    "attendance": "Which lecture section are you registered for?",
+    "confusion": (
+        "On a scale of 1 to 5, please rank your confusion about this week's "
+        "material (5 is most confused)."
+    ),
+    "short_response": (
+        "What were the most confusing or interesting topics from this week?"
+    ),
+}
+
+# Section (instructor) names, numbered once they run out.
+SECTION_NAMES = ["Varman", "Lind", "Emady", "Forzani", "Torres", "Kurtz"]
+
+TOPIC_WORDS = (
+    "enthalpy entropy fugacity activity coefficient raoult henry vapor liquid "
+    "equilibrium phase diagram azeotrope gibbs helmholtz residual property "
+    "departure function cubic equation state peng robinson virial compressibility "
+    "factor mixing rule excess chemical potential reaction extent conversion "
+    "isotherm isobar flash distillation column stage reboiler condenser heat "
+    "capacity latent steam table turbine compressor efficiency cycle rankine "
+    "refrigeration throttling joule thomson"
+).split()
+
+FILLER_WORDS = (
+    "the how why when which what is are was were to of and in on for with about "
+    "really still confused understand lecture example homework problem exam "
+    "notes step part last week this"
+).split()
+
+
+def section_names(count: int) -> List[str]:
+    """Name the sections of a synthetic course.
+
+    :param count: How many sections.
+    :return: The names.
+    """
+    return [
+        SECTION_NAMES[i % len(SECTION_NAMES)]
+        + (f" {i // len(SECTION_NAMES) + 1}" if i >= len(SECTION_NAMES) else "")
+        for i in range(count)
+    ]
+
+
+def generate_report(
+        rows: int,
+        sections: int = 3,
+        words: int = 12,
+        seed: int = 0,
+        multi_section: float = 0.02,
+        unrated: float = 0.05,
+        unanswered: float = 0.1,
+):
+    """Make up a quiz report.
+
+    :param rows: Students who submitted.
+    :param sections: Lecture sections to spread them over.
+    :param words: Average words in a short answer.
+    :param seed: Random seed.
+    :param multi_section: Share of students who select two sections.
+    :param unrated: Share of students who leave the confusion rating blank.
+    :param unanswered: Share of students who leave the short answer blank.
+    :return: DataFrame with the columns of a Canvas student analysis report.
+    """
+    import numpy as np
+    import pandas as pd
+
+    random = np.random.RandomState(seed)
+    names = np.array(section_names(sections), dtype=object)
+
+    picked = random.randint(0, sections, size=rows)
+    attendance = names[picked]
+    if sections > 1:
+        multi = random.rand(rows) < multi_section
+        other = names[(picked + random.randint(1, sections, size=rows)) % sections]
+        attendance[multi] = attendance[multi] + "," + other[multi]
+
+    # Confusion leans towards the middle of the scale, as real ratings do.
+    confusion = random.choice(
+        ["1", "2", "3", "4", "5"], size=rows, p=[0.1, 0.25, 0.3, 0.22, 0.13]
+    ).astype(object)
+    confusion[random.rand(rows) < unrated] = np.nan
+
+    vocabulary = np.array(TOPIC_WORDS + FILLER_WORDS, dtype=object)
+    lengths = np.maximum(1, random.poisson(words, size=rows))
+    picks = iter(random.randint(0, len(vocabulary), size=int(lengths.sum())))
+    answers = np.array(
+        [" ".join(vocabulary[next(picks)] for _ in range(n)) for n in lengths],
+        dtype=object,
+    )
+    answers[random.rand(rows) < unanswered] = np.nan
+
+    ids = np.arange(100000, 100000 + rows)
+    submitted = pd.Timestamp("2019-09-02 08:00") + pd.to_timedelta(
+        random.randint(0, 7 * 24 * 60, size=rows), unit="m"
+    )
+    report = pd.DataFrame(
+        {
+            "name": [f"Student {i}" for i in ids],
+            "id": ids,
+            "sis_id": ids + 1200000000,
+            "section": "CHE 334 All Sections",
+            "section_id": 4000,
+            "section_sis_id": "",
+            "submitted": submitted.strftime("%Y-%m-%d %H:%M:%S UTC"),
+            "attempt": 1,
+        }
+    )
+    columns = [
+        ("attendance", attendance),
+        ("confusion", confusion),
+        ("short_response", answers),
+    ]
+    for position, (role, values) in enumerate(columns):
+        question_id = 5000 + position
+        report[f"{question_id}: {QUESTIONS[role]}"] = values
+        # Canvas follows every question with its points, all headed "1.0",
+        # which pandas reads back as "1.0", "1.0.1", ...
+        report[f"1.0{'.' + str(position) if position else ''}"] = 0.0
+    report["n correct"] = 0
+    report["n incorrect"] = 0
+    report["score"] = 0.0
+    return report
+
+
+@click.command()
+@click.option("--rows", type=click.INT, default=1000, help="Students.")
+@click.option("--sections", type=click.INT, default=3, help="Lecture sections.")
+@click.option("--words", type=click.INT, default=12, help="Words per short answer.")
+@click.option("--seed", type=click.INT, default=0, help="Random seed.")
+@click.option(
+    "-o", "--output_file", type=Path, default=Path("report.csv"), help="CSV to write."
+)
+def main(rows, sections, words, seed, output_file):
+    """Write a synthetic student analysis report."""
+    report = generate_report(rows, sections=sections, words=words, seed=seed)
+    report.to_csv(str(output_file), index=False)
+    size = output_file.stat().st_size / 2 ** 20
+    print(f"Wrote {rows} rows, {sections} sections to {output_file} ({size:.1f} MiB)")
+
+
+if __name__ == "__main__":
+    main()
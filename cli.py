@@ -1,13 +1,77 @@
 import click
+import csv
 import json
-from jinja2 import FileSystemLoader
-from latex.jinja2 import make_env
-from latex import build_pdf
+from functools import partial, wraps
 from pathlib import Path
 
-from Canvas import Canvas
-import data_processing
-import export
+import instrumentation
+from defaults import (
+    CACHE_DIR,
+    LATEX_BUILD_DIR,
+    OUTPUT_DIR,
+    OUTPUT_FORMATS,
+    RECIPIENTS_FILE,
+    RESPONSE_STORE,
+    TEMPLATE_CACHE,
+    TEMPLATE_FILE,
+    TIMINGS_FILE,
+    TOKEN_FILE,
+    UPLOAD_LEDGER,
+)
+from figures import figure_outputs
+from instrumentation import span
+from report_cache import ReportCache
+from report_schema import report_usecols
+
+# The Canvas clients, data_processing (pandas, matplotlib, seaborn, wordcloud),
+# LaTeX and pandoc are imported by the stage that needs them, so that --help
+# and re-rendering saved contents start quickly.
+
+
+def parse_formats(ctx, param, value: str) -> list:
+    """Parse and check a comma-separated list of output formats.
+
+    :param value: e.g. "pdf,zip".
+    :return: List of formats.
+    """
+    formats = [f.strip().lower() for f in value.split(",") if f.strip()]
+    unknown = [f for f in formats if f not in OUTPUT_FORMATS]
+    if unknown or not formats:
+        raise click.BadParameter(
+            f"choose from {','.join(OUTPUT_FORMATS)}, got {value!r}"
+        )
+    return formats
+
+
+def instrumented(command):
+    """Record a command's timing report, and profile it if asked to.
+
+    The command gets a --profile option, and its spans and counters are saved
+    to TIMINGS_FILE in its output directory, even if it fails.
+
+    :param command: Command function taking output_dir.
+    :return: The wrapped command function.
+    """
+
+    @click.option(
+        "--profile",
+        type=Path,
+        default=None,
+        help="Write a cProfile dump of the run here, for pstats.",
+    )
+    @wraps(command)
+    def run(*args, profile, **kwargs):
+        recorder = instrumentation.reset()
+        try:
+            with instrumentation.profiled(profile), span(command.__name__):
+                command(*args, **kwargs)
+        finally:
+            timings_file = Path(kwargs["output_dir"] / TIMINGS_FILE)
+            if timings_file.parent.is_dir():
+                recorder.write(timings_file)
+                print(f"Timings written to {timings_file}")
+
+    return run
 
 
 @click.group()
@@ -19,88 +83,613 @@ def cli():
 @click.argument("course_name", type=click.STRING)
 @click.argument("quiz_number", type=click.INT)
 @click.option(
-    "-o", "--output_dir", type=Path, default=Path("output"), help="Output directory"
+    "-o", "--output_dir", type=Path, default=OUTPUT_DIR, help="Output directory"
 )
 @click.option(
     "-t",
     "--template_file",
     type=Path,
-    default=Path("report_template.tex"),
+    default=TEMPLATE_FILE,
     help="LaTeX/Jinja2 template.",
 )
 @click.option(
     "-r",
     "--recipients_file",
     type=Path,
-    default=Path("recipients.txt"),
+    default=RECIPIENTS_FILE,
     help="List of recipient names.",
 )
 @click.option(
     "--token_file",
     type=Path,
-    default=Path("canvas_token.txt"),
+    default=TOKEN_FILE,
     help="Canvas API auth token.",
 )
-@click.option("-s", help="Use previously generated data.")
+@click.option(
+    "--cache_dir",
+    type=Path,
+    default=CACHE_DIR,
+    help="Cache for reports and Canvas IDs.",
+)
+@click.option("--refresh", is_flag=True, help="Ignore the cache, fetch everything.")
+@click.option("--offline", is_flag=True, help="Use only the cache, no network.")
+@click.option(
+    "-j", "--jobs", type=click.INT, default=1, help="Processes for rendering figures."
+)
+@click.option(
+    "--incremental",
+    is_flag=True,
+    help="Only process the responses that changed since the last run.",
+)
+@click.option(
+    "--no_figure_cache", is_flag=True, help="Redraw figures even if unchanged."
+)
+@click.option(
+    "--latexmk", is_flag=True, help="Typeset with latexmk instead of pdflatex."
+)
+@click.option("--upload_folder", help="Upload the outputs to this Canvas folder.")
+@click.option(
+    "--formats",
+    default=",".join(OUTPUT_FORMATS),
+    callback=parse_formats,
+    help="Outputs to write, any of pdf,docx,tex,zip.",
+)
+@click.option(
+    "-s", "--saved", is_flag=True, help="Re-render contents.json, fetch nothing."
+)
+@instrumented
 def generate(
-        course_name, quiz_number, output_dir, template_file, recipients_file, token_file, s
+        course_name, quiz_number, output_dir, template_file, recipients_file, token_file,
+        cache_dir, refresh, offline, jobs, incremental, no_figure_cache, latexmk,
+        upload_folder, formats, saved
 ):
     """Driver/interface function for generating a report.
     """
+    if offline and upload_folder:
+        raise click.UsageError("--upload_folder needs the network, drop --offline.")
+    import export
+
     # Create directories if needed
     figures_dir = Path(output_dir / "figures")
     for d in [output_dir, figures_dir]:
         export.create_dir(d)
 
     # Use a stale dataset, or grab a fresh one
-    if s is True:
+    if saved:
         print("Loading contents from file...")
         with open("contents.json", "r") as f:
             contents = json.load(f)
     else:
+        from Canvas import Canvas
+        from response_store import ResponseStore
+        import data_processing
+
         print("Fetching data from Canvas...")
-        with token_file.open("r") as f:
-            token = f.read()
-        c = Canvas("asu.instructure.com", "v1", token)
-        report_df = c.get_quiz_report(course_name, quiz_number)
+        token = read_token(token_file, offline)
+        cache = ReportCache(cache_dir, refresh=refresh)
+        c = Canvas("asu.instructure.com", "v1", token, cache=cache, offline=offline)
+        with span("fetch"):
+            report_df = c.get_quiz_report(
+                course_name, quiz_number, usecols=report_usecols, dtype=str
+            )
         print("Fetch complete.")
-        contents = data_processing.generate_report_contents(
-            c, report_df, quiz_number, figures_dir, recipients_file
-        )
+        with span("process"):
+            contents = data_processing.generate_report_contents(
+                c,
+                report_df,
+                quiz_number,
+                figures_dir,
+                recipients_file,
+                jobs=jobs,
+                figure_cache=not no_figure_cache,
+                store=ResponseStore(Path(cache_dir / RESPONSE_STORE)),
+                course_name=course_name,
+                incremental=incremental,
+                figure_outputs=figure_outputs(formats),
+            )
         with open("contents.json", "w+") as f:
             json.dump(contents, f)
 
+    files = build_outputs(
+        contents,
+        output_dir,
+        figures_dir,
+        template_file,
+        latexmk,
+        formats,
+        Path(cache_dir / TEMPLATE_CACHE),
+    )
+    if upload_folder:
+        upload_outputs(
+            files,
+            upload_folder,
+            read_token(token_file),
+            Path(cache_dir / UPLOAD_LEDGER),
+        )
+
+
+def build_outputs(
+        contents: dict,
+        output_dir: Path,
+        figures_dir: Path,
+        template_file: Path,
+        latexmk: bool = False,
+        formats: list = None,
+        bytecode_dir: Path = None,
+) -> list:
+    """Render, typeset, export and archive one report.
+
+    :param contents: Report contents from data_processing.generate_report_contents.
+    :param output_dir: Directory to write the report files to.
+    :param figures_dir: Directory the report's figures were written to.
+    :param template_file: LaTeX/Jinja2 template.
+    :param latexmk: Typeset with latexmk instead of pdflatex.
+    :param formats: Which of OUTPUT_FORMATS to write, all by default.
+    :param bytecode_dir: Directory to keep the compiled template in, if any.
+    :return: Paths of the files written.
+    """
+    from pipeline import Stage, run_stages
+    from templates import ReportTemplate
+    from typesetting import Typesetter
+    import export
+
+    if formats is None:
+        formats = OUTPUT_FORMATS
+
     # Render LaTeX template
     print("Rendering LaTeX Template...")
-    env = make_env(loader=FileSystemLoader(str(template_file.parent)))
-    tpl = env.get_template(str(template_file.name))
-    rendered_latex = tpl.render(contents=contents)
+    tpl = ReportTemplate(template_file, bytecode_dir)
+    with span("render"):
+        rendered_latex = tpl.render(contents)
     print("Render complete.")
 
-    # Typeset PDF
-    print("Typesetting PDF...")
     base_filename = f"muddy_points_{contents.get('quiz_number')}"
     pdf_filename = Path(output_dir / f"{base_filename}.pdf")
-    pdf = build_pdf(rendered_latex, texinputs=[str(Path.cwd()), ""])
-    pdf.save_to(str(pdf_filename))
-    print("Typesetting complete.")
-
-    # Export to Microsoft Word and LaTeX formats for further editing
     docx_filename = Path(output_dir / f"{base_filename}.docx")
     latex_filename = Path(output_dir / f"{base_filename}.tex")
-    export.make_texfile(rendered_latex, latex_filename)
-    export.make_docx(latex_filename, docx_filename)
-
-    # Create archive
-    print("Creating archive...")
     zip_filename = Path(output_dir / f"{base_filename}.zip")
-    export.make_archive(
-        zip_filename, [pdf_filename, docx_filename, latex_filename], figures_dir
+    outputs = {"pdf": pdf_filename, "docx": docx_filename, "tex": latex_filename}
+
+    def typeset():
+        print("Typesetting PDF...")
+        typesetter = Typesetter(
+            Path(output_dir / LATEX_BUILD_DIR),
+            template_file,
+            backend="latexmk" if latexmk else "pdflatex",
+        )
+        if typesetter.build_pdf(rendered_latex, pdf_filename, figures_dir.glob("*")):
+            print("Typesetting complete.")
+        else:
+            print("Report unchanged, reused the last PDF.")
+
+    def archive():
+        print("Creating archive...")
+        archived = [outputs[name] for name in outputs if name in formats]
+        export.make_archive(zip_filename, archived, figures_dir)
+        print(f"Created archive: {zip_filename}")
+
+    # Typeset PDF and export to Microsoft Word and LaTeX formats for further
+    # editing side by side. Word is converted from the .tex file, so needs it.
+    stages = []
+    if "pdf" in formats:
+        stages.append(Stage("pdf", typeset, []))
+    if "tex" in formats or "docx" in formats:
+        make_texfile = partial(export.make_texfile, rendered_latex, latex_filename)
+        stages.append(Stage("tex", make_texfile, []))
+    if "docx" in formats:
+        make_docx = partial(
+            export.make_docx, latex_filename, docx_filename, figures_dir
+        )
+        stages.append(Stage("docx", make_docx, ["tex"]))
+    if "zip" in formats:
+        stages.append(Stage("zip", archive, [stage.name for stage in stages]))
+
+    timings = run_stages(stages)
+    print(
+        "Output stages: "
+        + ", ".join(f"{name} {seconds:.2f}s" for name, seconds in timings.items())
+    )
+    outputs["zip"] = zip_filename
+    return [outputs[name] for name in OUTPUT_FORMATS if name in formats]
+
+
+def upload_outputs(
+        files: list, upload_folder: str, token: str, ledger_file: Path
+) -> None:
+    """Upload report files to the user's Canvas files, several at a time.
+
+    :param files: Paths of the files to upload.
+    :param upload_folder: Canvas-side folder to upload to.
+    :param token: Canvas API auth token.
+    :param ledger_file: Record of finished uploads, so reruns skip them.
+    :return: None
+    """
+    from Canvas import Canvas
+
+    print(f"Uploading {len(files)} files to {upload_folder}...")
+    with Canvas("asu.instructure.com", "v1", token) as c, span("upload"):
+        results = c.upload_files(files, upload_folder, ledger_file=ledger_file)
+    failed = [path.name for path, uploaded in results.items() if not uploaded]
+    if failed:
+        raise click.ClickException(f"Could not upload {', '.join(failed)}")
+    print("Upload complete.")
+
+
+def read_token(token_file: Path, offline: bool = False) -> str:
+    """Read the Canvas API auth token.
+
+    :param token_file: File containing the token.
+    :param offline: Offline runs never talk to Canvas, so need no token.
+    :return: The token, or an empty string when offline.
+    """
+    if offline:
+        return ""
+    with token_file.open("r") as f:
+        return f.read()
+
+
+def read_pairs(pairs_file: Path) -> list:
+    """Read (course name, quiz number) pairs, one "COURSE_NAME,QUIZ_NUMBER" per line.
+
+    :param pairs_file: CSV file listing the reports to generate.
+    :return: List of (course_name, quiz_number) tuples.
+    :raises click.BadParameter: If a line is not a course name and a quiz number.
+    """
+    pairs = []
+    with pairs_file.open("r", newline="") as f:
+        reader = csv.reader(f)
+        for row in reader:
+            if not row or row[0].startswith("#"):
+                continue
+            course_name = row[0].strip()
+            quiz_number = row[1].strip() if len(row) >= 2 else ""
+            if not course_name or not quiz_number.isdigit():
+                raise click.BadParameter(
+                    f"{pairs_file}, line {reader.line_num}: expected "
+                    f"COURSE_NAME,QUIZ_NUMBER, got {','.join(row)!r}",
+                    param_hint="PAIRS_FILE",
+                )
+            pairs.append((course_name, int(quiz_number)))
+    return pairs
+
+
+async def fetch_all(
+        pairs: list,
+        token: str,
+        names: list,
+        concurrency: int,
+        rate: float,
+        cache: ReportCache = None,
+        offline: bool = False,
+) -> tuple:
+    """Fetch every quiz report and the recipient IDs concurrently.
+
+    :param pairs: (course_name, quiz_number) for every report wanted.
+    :param token: Canvas API auth token.
+    :param names: Recipient names to resolve, may be empty.
+    :param concurrency: Maximum number of requests in flight.
+    :param rate: Maximum requests per second to each host.
+    :param cache: Optional on-disk cache for reports and ID lookups.
+    :param offline: Serve everything from the cache, never touch the network.
+    :return: List of report DataFrames (in the order of pairs) and recipient IDs.
+    """
+    import asyncio
+    from AsyncCanvas import AsyncCanvas
+
+    async with AsyncCanvas(
+        "asu.instructure.com",
+        "v1",
+        token,
+        concurrency=concurrency,
+        requests_per_second=rate,
+        cache=cache,
+        offline=offline,
+    ) as c:
+        reports = asyncio.ensure_future(
+            c.get_quiz_reports(
+                pairs, usecols=report_usecols, dtype=str
+            )
+        )
+        recipients = {}
+        if names:
+            # Recipients are searched for among the people of each course.
+            courses = list(dict.fromkeys(course for course, _ in pairs))
+            for found in await asyncio.gather(
+                *(c.get_recipient_ids(names, course) for course in courses)
+            ):
+                recipients.update(found)
+        return await reports, recipients
+
+
+@click.command("generate-all")
+@click.argument("pairs_file", type=Path)
+@click.option(
+    "-o", "--output_dir", type=Path, default=OUTPUT_DIR, help="Output directory"
+)
+@click.option(
+    "-t",
+    "--template_file",
+    type=Path,
+    default=TEMPLATE_FILE,
+    help="LaTeX/Jinja2 template.",
+)
+@click.option(
+    "-r",
+    "--recipients_file",
+    type=Path,
+    default=RECIPIENTS_FILE,
+    help="List of recipient names.",
+)
+@click.option(
+    "--token_file",
+    type=Path,
+    default=TOKEN_FILE,
+    help="Canvas API auth token.",
+)
+@click.option(
+    "-c", "--concurrency", type=click.INT, default=10, help="Requests in flight."
+)
+@click.option(
+    "--rate", type=click.FLOAT, default=10.0, help="Requests per second per host."
+)
+@click.option(
+    "--cache_dir",
+    type=Path,
+    default=CACHE_DIR,
+    help="Cache for reports and Canvas IDs.",
+)
+@click.option("--refresh", is_flag=True, help="Ignore the cache, fetch everything.")
+@click.option("--offline", is_flag=True, help="Use only the cache, no network.")
+@click.option(
+    "-j", "--jobs", type=click.INT, default=1, help="Processes for rendering figures."
+)
+@click.option(
+    "--incremental",
+    is_flag=True,
+    help="Only process the responses that changed since the last run.",
+)
+@click.option(
+    "--no_figure_cache", is_flag=True, help="Redraw figures even if unchanged."
+)
+@click.option(
+    "--latexmk", is_flag=True, help="Typeset with latexmk instead of pdflatex."
+)
+@click.option("--upload_folder", help="Upload the outputs to this Canvas folder.")
+@click.option(
+    "--formats",
+    default=",".join(OUTPUT_FORMATS),
+    callback=parse_formats,
+    help="Outputs to write, any of pdf,docx,tex,zip.",
+)
+@instrumented
+def generate_all(
+        pairs_file, output_dir, template_file, recipients_file, token_file, concurrency,
+        rate, cache_dir, refresh, offline, jobs, incremental, no_figure_cache, latexmk,
+        upload_folder, formats
+):
+    """Generate a report for every (course, quiz) pair listed in PAIRS_FILE.
+
+    PAIRS_FILE has one "COURSE_NAME,QUIZ_NUMBER" line per report. All Canvas
+    requests are made concurrently, then each report is built in turn.
+    """
+    if offline and upload_folder:
+        raise click.UsageError("--upload_folder needs the network, drop --offline.")
+    import asyncio
+    from response_store import ResponseStore
+    import data_processing
+    import export
+
+    pairs = read_pairs(pairs_file)
+    token = read_token(token_file, offline)
+    cache = ReportCache(cache_dir, refresh=refresh)
+    names = []
+    if recipients_file.exists():
+        with recipients_file.open("r") as f:
+            names = [name.strip() for name in f.readlines() if name.strip()]
+
+    print(f"Fetching {len(pairs)} reports from Canvas...")
+    with span("fetch"):
+        reports, recipients = asyncio.run(
+            fetch_all(pairs, token, names, concurrency, rate, cache, offline)
+        )
+    print("Fetch complete.")
+
+    store = ResponseStore(Path(cache_dir / RESPONSE_STORE))
+    files = []
+    for (course_name, quiz_number), report_df in zip(pairs, reports):
+        slug = course_name.replace(" ", "_")
+        report_dir = Path(output_dir / f"{slug}_{quiz_number}")
+        figures_dir = Path(report_dir / "figures")
+        for d in [report_dir, figures_dir]:
+            export.create_dir(d)
+
+        with span("process", course=course_name, quiz=quiz_number):
+            contents = data_processing.generate_report_contents(
+                None,
+                report_df,
+                quiz_number,
+                figures_dir,
+                jobs=jobs,
+                figure_cache=not no_figure_cache,
+                store=store,
+                course_name=course_name,
+                incremental=incremental,
+                figure_outputs=figure_outputs(formats),
+            )
+        contents["recipients"] = recipients
+        with Path(report_dir / "contents.json").open("w+") as f:
+            json.dump(contents, f)
+        files.extend(
+            build_outputs(
+                contents,
+                report_dir,
+                figures_dir,
+                template_file,
+                latexmk,
+                formats,
+                Path(cache_dir / TEMPLATE_CACHE),
+            )
+        )
+
+    # Every report's files go up together, so the uploads overlap
+    if upload_folder:
+        upload_outputs(files, upload_folder, token, Path(cache_dir / UPLOAD_LEDGER))
+
+
+@click.command()
+@click.argument("job_file", type=Path)
+@click.option(
+    "-o",
+    "--output_dir",
+    type=Path,
+    default=OUTPUT_DIR,
+    help="Output directory, for jobs that name none.",
+)
+@click.option(
+    "-t",
+    "--template_file",
+    type=Path,
+    default=TEMPLATE_FILE,
+    help="LaTeX/Jinja2 template.",
+)
+@click.option(
+    "-r",
+    "--recipients_file",
+    type=Path,
+    default=RECIPIENTS_FILE,
+    help="List of recipient names.",
+)
+@click.option(
+    "--token_file",
+    type=Path,
+    default=TOKEN_FILE,
+    help="Canvas API auth token.",
+)
+@click.option(
+    "-w", "--workers", type=click.INT, default=4, help="Jobs to run at the same time."
+)
+@click.option(
+    "--cache_dir",
+    type=Path,
+    default=CACHE_DIR,
+    help="Cache for reports and Canvas IDs.",
+)
+@click.option("--refresh", is_flag=True, help="Ignore the cache, fetch everything.")
+@click.option("--offline", is_flag=True, help="Use only the cache, no network.")
+@click.option(
+    "--incremental",
+    is_flag=True,
+    help="Only process the responses that changed since the last run.",
+)
+@click.option(
+    "--no_figure_cache", is_flag=True, help="Redraw figures even if unchanged."
+)
+@click.option(
+    "--latexmk", is_flag=True, help="Typeset with latexmk instead of pdflatex."
+)
+@click.option("--upload_folder", help="Upload the outputs to this Canvas folder.")
+@click.option(
+    "--formats",
+    default=",".join(OUTPUT_FORMATS),
+    callback=parse_formats,
+    help="Outputs to write, any of pdf,docx,tex,zip.",
+)
+@click.option(
+    "--restart", is_flag=True, help="Run every stage again, even finished ones."
+)
+@instrumented
+def batch(
+        job_file, output_dir, template_file, recipients_file, token_file, workers,
+        cache_dir, refresh, offline, incremental, no_figure_cache, latexmk,
+        upload_folder, formats, restart
+):
+    """Generate the reports listed in JOB_FILE on a pool of worker processes.
+
+    JOB_FILE has one "COURSE_NAME,QUIZ_NUMBER,OUTPUT_DIR" line per report.
+    Each job keeps its files, and a manifest of the stages it finished, in its
+    OUTPUT_DIR; running the batch again resumes every job where it stopped.
+    """
+    if offline and upload_folder:
+        raise click.UsageError("--upload_folder needs the network, drop --offline.")
+    from batch import BatchSettings, read_jobs, run_batch
+
+    try:
+        jobs = read_jobs(job_file, output_dir)
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint="JOB_FILE")
+    output_dir.mkdir(parents=True, exist_ok=True)
+    names = []
+    if recipients_file.exists():
+        with recipients_file.open("r") as f:
+            names = [name.strip() for name in f.readlines() if name.strip()]
+    settings = BatchSettings(
+        template_file=template_file,
+        token=read_token(token_file, offline),
+        recipient_names=names,
+        cache_dir=cache_dir,
+        refresh=refresh,
+        offline=offline,
+        incremental=incremental,
+        figure_cache=not no_figure_cache,
+        latexmk=latexmk,
+        formats=formats,
+        upload_folder=upload_folder,
     )
-    print(f"Created archive: {zip_filename}")
+
+    print(f"Running {len(jobs)} jobs on {workers} workers...")
+    results = run_batch(jobs, settings, workers=workers, restart=restart)
+    failed = []
+    for job, status in results.items():
+        ran = [stage for stage, state in status.items() if state == "ran"]
+        print(
+            f"{job.course_name} quiz {job.quiz_number}: "
+            f"ran {', '.join(ran) or 'nothing'}"
+            + (f", failed in {status['error']}" if "error" in status else "")
+        )
+        if "error" in status:
+            failed.append(str(job.output_dir))
+    if failed:
+        raise click.ClickException(
+            f"{len(failed)} jobs failed, run the batch again to resume them."
+        )
+
+
+@click.command()
+@click.argument("contents_files", type=Path, nargs=-1, required=True)
+@click.option(
+    "-t",
+    "--template_file",
+    type=Path,
+    default=TEMPLATE_FILE,
+    help="LaTeX/Jinja2 template.",
+)
+@click.option(
+    "--cache_dir",
+    type=Path,
+    default=CACHE_DIR,
+    help="Cache for the compiled template.",
+)
+def render(contents_files, template_file, cache_dir):
+    """Render saved contents.json files to LaTeX, each next to its contents.
+
+    Every report is rendered with the same compiled template, so re-rendering a
+    semester of reports after a template change takes little more than reading
+    and writing the files.
+    """
+    import time
+    from templates import ReportTemplate
+
+    start = time.perf_counter()
+    tpl = ReportTemplate(template_file, Path(cache_dir / TEMPLATE_CACHE))
+    tex_files = tpl.render_files(list(contents_files))
+    seconds = time.perf_counter() - start
+    print(f"Rendered {len(tex_files)} reports in {seconds:.2f}s.")
 
 
 cli.add_command(generate)
+cli.add_command(generate_all)
+cli.add_command(batch)
+cli.add_command(render)
 
 if __name__ == "__main__":
     cli()
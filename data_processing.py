@@ -1,294 +1,526 @@
-import requests
-import re
 import pytz
+import re
+import time
+import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
-from matplotlib.ticker import MaxNLocator
-import seaborn as sns
-from typing import Dict, Tuple
-from wordcloud import WordCloud
+import matplotlib
+
+# Headless: seaborn and pandas import pyplot, which must not pick a GUI backend.
+matplotlib.use("Agg")
+import matplotlib.style  # noqa: E402
+from matplotlib.ticker import MaxNLocator  # noqa: E402
+import seaborn as sns  # noqa: E402
+from typing import Dict, List, Tuple
 from datetime import datetime
 from pathlib import Path
 
+from aggregates import (
+    QuizAggregates,
+    aggregate_responses,
+    section_levels,
+    section_ratings,
+)
 from Canvas import Canvas
+from figures import (
+    OUTPUTS,
+    PRINT,
+    FigureCache,
+    FigureJob,
+    new_figure,
+    output_file,
+    render_figures,
+    save_figure,
+)
+from instrumentation import span
+from report_schema import ReportSchema, report_schema
+from response_store import ResponseStore, row_digests
+from trends import confusion_trend
+from wordclouds import RESOLUTION, word_frequencies, wordcloud_image
+
+matplotlib.style.use("seaborn")
+matplotlib.rcParams["font.family"] = "STIXGeneral"
+matplotlib.rcParams["mathtext.fontset"] = "stix"
+
+# Digests of rendered figures, kept in the output directory so that the
+# figures directory only ever holds figures.
+FIGURE_MANIFEST = ".figure_cache.json"
+
+# Fixed creation date for PDFs that are not written by matplotlib.
+PDF_DATE = time.gmtime(0)
+
+# Canvas joins the answers of a multiple-answer question with commas.
+SECTION_SEPARATOR = ","
+
+# Confusion is rated on a 1-5 scale.
+CONFUSION_LEVELS = [1, 2, 3, 4, 5]
+
+
+def normalize_responses(
+        report_df: pd.DataFrame, schema: ReportSchema
+) -> pd.DataFrame:
+    """Clean the responses once, for every plotting function to share.
+
+    Confusion ratings that are not whole, non-negative numbers become NaN, and
+    the instructor column becomes categorical, with a category per section
+    found in the report. A student who selected several sections gets a row in
+    each of them, all sharing the index of their row in report_df.
 
-plt.style.use("seaborn")
-plt.rcParams["font.family"] = "STIXGeneral"
-plt.rcParams["mathtext.fontset"] = "stix"
+    :param report_df: DataFrame of quiz report data.
+    :param schema: ReportSchema of report_df.
+    :return: DataFrame with student, instructor, confusion and short_response
+        columns.
+    """
+    confusion = pd.to_numeric(report_df[schema.header("confusion")], errors="coerce")
+    confusion = confusion.where((confusion >= 0) & (confusion % 1 == 0))
+    responses = pd.DataFrame(
+        {
+            "student": report_df["id"],
+            "instructor": report_df[schema.header("attendance")].str.split(
+                SECTION_SEPARATOR
+            ),
+            "confusion": confusion,
+            "short_response": report_df[schema.header("short_response")],
+        }
+    ).explode("instructor")
+    sections = responses["instructor"].str.strip().replace("", np.nan)
+    responses["instructor"] = sections.astype("category")
+    return responses
+
+
+def section_slug(section: str) -> str:
+    """Make a section name safe to use in a filename that LaTeX includes.
+
+    :param section: Name of the section, e.g. "Varman".
+    :return: The name with anything but letters, digits and dashes replaced.
+    """
+    return re.sub(r"[^\w-]+", "_", section)
 
 
-def plot_attendance_by_section(questions_df: pd.DataFrame, filename: Path) -> Dict:
-    """Create plot of survey participation.
+def confusion_counts(aggregates: QuizAggregates) -> pd.DataFrame:
+    """Count confusion ratings per instructor, on the 1-5 scale.
 
-    :param questions_df: DataFrame with questions/responses as columns.
+    :param aggregates: The quiz's aggregates.
+    :return: DataFrame with a row per instructor and a column per confusion level.
+    """
+    return aggregates.confusion.reindex(columns=CONFUSION_LEVELS, fill_value=0)
+
+
+def draw_attendance(
+        value_counts: pd.Series, filename: Path, outputs: List[str] = PRINT
+) -> None:
+    """Draw a bar plot of responses per section.
+
+    :param value_counts: Number of responses per section.
     :param filename: Path to write plot to file.
-    :return: Information about the plot to be used in LaTeX template.
+    :param outputs: Names of the figures.OUTPUTS to write.
+    :return: None
     """
-    attendance_text = list(
-        filter(lambda q: "registered for" in q, questions_df.columns.values)
-    )[0]
-    attendance_question = questions_df[attendance_text]
+    with new_figure() as fig:
+        ax = fig.add_subplot(1, 1, 1)
+        value_counts.plot(kind="bar", y="Responses", rot=0, ax=ax)
+        ax.set_ylabel("Responses")
+        save_figure(fig, filename, outputs)
 
-    plt.figure(figsize=(7.5, 3), dpi=300)
-    attendance_question.value_counts().plot(kind="bar", y="Responses", rot=0)
-    plt.ylabel("Responses")
-    plt.savefig(str(filename), bbox_inches="tight")
+
+def plot_attendance_by_section(
+        aggregates: QuizAggregates, filename: Path
+) -> Tuple[Dict, FigureJob]:
+    """Create plot of survey participation.
+
+    :param aggregates: The quiz's aggregates.
+    :param filename: Path to write plot to file.
+    :return: Information about the plot to be used in LaTeX template, and its job.
+    """
+    value_counts = aggregates.section_counts
 
     attendance = {
         "title": "Muddy Points responses by section.",
         "filename": str(filename),
-        "count": len(attendance_question),
+        "count": int(aggregates.students),
     }
 
-    if len(attendance_question.value_counts()) > 2:
+    # Students who selected several sections are counted in each of them.
+    multiple = aggregates.multi_section
+    if multiple > 0:
         attendance[
             "notes"
-        ] = """At least one student selected both instructors. This may be an error, 
-        or it may indicate that the student attended a lecture in each section this week.
+        ] = f"""{multiple} student(s) selected more than one section, and are counted
+        in each of them. This may be an error, or it may indicate that the student
+        attended a lecture in each section this week.
         """
 
-    return attendance
-
+    return attendance, FigureJob(draw_attendance, value_counts, filename)
 
-def split_by_instructor(
-    questions_df: pd.DataFrame
-) -> Tuple[pd.DataFrame, pd.DataFrame]:
-    """Split a DataFrame by instructor.
 
-    This function is almost certainly going to be deprecated soon. It turns out that keeping the original
-    DataFrame intact and querying it has almost the same performance.
+def draw_stacked_confusion(
+        counts: pd.DataFrame, filename: Path, outputs: List[str] = PRINT
+) -> None:
+    """Draw a stacked bar plot of confusion ratings, one layer per section.
 
-    :param questions_df: DataFrame with questions/responses as columns.
-    :return: Tuple of DataFrames for each instructor.
+    :param counts: DataFrame from confusion_counts.
+    :param filename: Path to write plot to file.
+    :param outputs: Names of the figures.OUTPUTS to write.
+    :return: None
     """
-    attendance_text = list(
-        filter(lambda q: "registered for" in q, questions_df.columns.values)
-    )[0]
-    varman_df = questions_df[questions_df[attendance_text] == "Varman"]
-    holloway_df = questions_df[questions_df[attendance_text] == "Holloway"]
-    return varman_df, holloway_df
-
-
-def combined_confusion_barplot(report_df: pd.DataFrame, filename: Path) -> Dict:
+    with new_figure() as fig:
+        ax = fig.add_subplot(1, 1, 1)
+        bottom = np.zeros(len(CONFUSION_LEVELS))
+        for section, section_counts in counts.iterrows():
+            ax.bar(
+                CONFUSION_LEVELS,
+                section_counts.values,
+                bottom=bottom,
+                width=0.8,
+                label=section,
+            )
+            bottom = bottom + section_counts.values
+        ax.set_xlabel("Confusion")
+        ax.set_ylabel("Responses")
+        ax.legend()
+        save_figure(fig, filename, outputs)
+
+
+def combined_confusion_barplot(
+        counts: pd.DataFrame, filename: Path
+) -> Tuple[Dict, FigureJob]:
     """Create stacked barplot of confusion ratings.
 
-    :param report_df: DataFrame of quiz report data.
+    :param counts: DataFrame from confusion_counts.
     :param filename: Path to write plot to file.
-    :return: Information about the plot to be used in LaTeX template.
+    :return: Information about the plot to be used in LaTeX template, and its job.
     """
-    df = report_df.filter(regex=r"(registered for)|(rank your)").dropna()
-    df.columns = ["instructor", "confusion"]
-    df = df[df["confusion"].apply(lambda x: str(x).isdigit())]
-    df["confusion"] = pd.to_numeric(df["confusion"])
-    df = df[df["instructor"].apply(lambda s: "," not in s)]
-
-    v_df = df[df["instructor"] == "Varman"]
-    value_counts = (v_df["confusion"].value_counts().get(i) for i in range(1, 6))
-    v_counts = [x if x is not None else 0 for x in value_counts]
-
-    h_df = df[df["instructor"] == "Holloway"]
-    value_counts = (h_df["confusion"].value_counts().get(i) for i in range(1, 6))
-    h_counts = [x if x is not None else 0 for x in value_counts]
-
-    fig = plt.figure(figsize=(7.5, 3), dpi=300)
-    ax = fig.add_subplot(1, 1, 1)
-    ax.bar([1, 2, 3, 4, 5], v_counts, width=0.8, label="Varman")
-    ax.bar([1, 2, 3, 4, 5], h_counts, bottom=v_counts, width=0.8, label="Holloway")
-    ax.set_xlabel("Confusion")
-    ax.set_ylabel("Responses")
-    plt.legend()
-    plt.savefig(str(filename), bbox_inches="tight")
-
-    return {
+    info = {
         "title": "Stacked Bar Plot of Self-Assessed Confusion",
         "filename": str(filename),
     }
+    return info, FigureJob(draw_stacked_confusion, counts, filename)
 
 
-def combined_confusion_kdeplot(report_df: pd.DataFrame, filename: Path) -> Dict:
+def draw_kde(
+        confusion: Dict[str, pd.Series], filename: Path, outputs: List[str] = PRINT
+) -> None:
+    """Draw overlaid Kernel Density Estimates of confusion ratings.
+
+    :param confusion: Cleaned confusion ratings keyed by instructor.
+    :param filename: Path to write plot to file.
+    :param outputs: Names of the figures.OUTPUTS to write.
+    :return: None
+    """
+    with new_figure() as fig:
+        ax = fig.add_subplot(1, 1, 1)
+        for instructor, ratings in confusion.items():
+            sns.kdeplot(ratings, shade=True, label=instructor, ax=ax)
+        save_figure(fig, filename, outputs)
+
+
+def combined_confusion_kdeplot(
+        aggregates: QuizAggregates, filename: Path
+) -> Tuple[Dict, FigureJob]:
     """Create Kernel Density Estimation plot for confusion ratings.
 
     This makes a very cool KDE plot comparing each section. I know KDE is not the proper
     way to compare collections of categorical data, so the report just uses a stacked bar
     plot. I do like how this looks...
 
-    :param report_df: DataFrame of quiz report data.
+    :param aggregates: The quiz's aggregates.
     :param filename: Path to write plot to file.
-    :return: Information about the plot to be used in LaTeX template.
+    :return: Information about the plot to be used in LaTeX template, and its job.
     """
-    varman_df, holloway_df = split_by_instructor(report_df)
-    varman_df = varman_df.filter(regex="rank your").dropna()
-    varman_df.columns = ["confusion"]
-    varman_df = varman_df[varman_df["confusion"].apply(lambda x: str(x).isdigit())]
-    holloway_df = holloway_df.filter(regex="rank your").dropna()
-    holloway_df.columns = ["confusion"]
-    holloway_df = holloway_df[
-        holloway_df["confusion"].apply(lambda x: str(x).isdigit())
-    ]
-
-    plt.figure(figsize=(7.5, 3), dpi=300)
-    sns.kdeplot(varman_df["confusion"], shade=True, label="Varman")
-    sns.kdeplot(holloway_df["confusion"], shade=True, label="Holloway")
-    plt.savefig(str(filename), bbox_inches="tight")
-
-    return {
+    confusion = {
+        section: section_ratings(section_levels(aggregates, section))
+        for section in aggregates.confusion.index
+    }
+
+    info = {
         "title": "Kernel Density Estimate Plot of Self-Assessed Confusion",
         "filename": str(filename),
     }
+    return info, FigureJob(draw_kde, confusion, filename)
 
 
-def points_wordcloud(q: pd.DataFrame, df: pd.DataFrame, filename: Path) -> None:
-    """Create a WordCloud of the short-answer responses.
+def draw_confusion_trend(
+        trend: pd.DataFrame, filename: Path, outputs: List[str] = PRINT
+) -> None:
+    """Draw a line plot of each section's confusion across quizzes.
 
-    :param q: DataFrame containing only the short-answer column.
-    :param df: DataFrame of quiz report data.
+    :param trend: DataFrame from trends.confusion_trend.
     :param filename: Path to write plot to file.
+    :param outputs: Names of the figures.OUTPUTS to write.
     :return: None
     """
-    try:
-        text = " ".join([str(response) for response in df[q]])
-        wc = WordCloud(background_color="white").generate_from_text(text)
-    except ValueError as e:
-        print(f"Using the constitution, not enough responses: {e}")
-        text = requests.get("https://www.usconstitution.net/const.txt").text
-        wc = WordCloud(background_color="white").generate_from_text(text)
+    with new_figure() as fig:
+        ax = fig.add_subplot(1, 1, 1)
+        for section in trend["mean"].columns:
+            line, = ax.plot(
+                trend.index,
+                trend["mean", section],
+                marker="o",
+                label=f"{section} mean",
+            )
+            ax.plot(
+                trend.index,
+                trend["median", section],
+                linestyle="--",
+                color=line.get_color(),
+                label=f"{section} median",
+            )
+        ax.set_xlabel("Muddy Points survey")
+        ax.set_ylabel("Confusion")
+        ax.set_ylim(CONFUSION_LEVELS[0], CONFUSION_LEVELS[-1])
+        ax.xaxis.set_major_locator(MaxNLocator(integer=True))
+        ax.legend()
+        save_figure(fig, filename, outputs)
+
+
+def confusion_trend_plot(
+        summary: pd.DataFrame, filename: Path
+) -> Tuple[Dict, FigureJob]:
+    """Create a plot of confusion across every stored quiz.
+
+    :param summary: DataFrame from ResponseStore.confusion_summary.
+    :param filename: Path to write plot to file.
+    :return: Information about the plot to be used in LaTeX template, and its job.
+    """
+    trend = confusion_trend(summary)
+    info = {
+        "title": "Mean and Median Self-Assessed Confusion by Survey",
+        "filename": str(filename),
+        "quizzes": len(trend),
+    }
+    return info, FigureJob(draw_confusion_trend, trend, filename)
 
-    plt.figure(figsize=(7.5, 3), dpi=300)
-    plt.axis("off")
-    plt.imshow(wc, interpolation="bilinear")
-    plt.savefig(str(filename), bbox_inches="tight")
 
+def draw_wordcloud(
+        frequencies: Dict[str, int], filename: Path, outputs: List[str] = PRINT
+) -> None:
+    """Draw a WordCloud of the short-answer responses.
 
-def confusion_histogram(report_df: pd.DataFrame, filename: Path) -> pd.Series:
-    """Create a bar plot of self-rated confusion.
+    The cloud is saved straight from PIL rather than through matplotlib: PDFs
+    at the cloud's own resolution, with a fixed date so the file is
+    byte-identical, and PNGs scaled down to the output's resolution.
 
-    :param report_df: DataFrame of quiz report data.
+    :param frequencies: Words and their counts, from word_frequencies.
     :param filename: Path to write plot to file.
-    :return: pandas Series of cleaned response data.
+    :param outputs: Names of the figures.OUTPUTS to write.
+    :return: None
     """
-    df = report_df.filter(regex=r"rank your").dropna()
-    df.columns = ["confusion"]
-    df = df[df["confusion"].apply(lambda x: str(x).isdigit())]
-    df["confusion"] = pd.to_numeric(df["confusion"])
-    value_counts = (df["confusion"].value_counts().get(i) for i in range(1, 6))
-    counts = [x if x is not None else 0 for x in value_counts]
-
-    fig = plt.figure(figsize=(7.5, 3), dpi=300)
-    ax = fig.add_subplot(1, 1, 1)
-    ax.bar([1, 2, 3, 4, 5], counts)
-    ax.set_xlabel("Confusion (5 is most confused)")
-    ax.set_ylabel("Responses")
-    ax.yaxis.set_major_locator(MaxNLocator(integer=True))
-    plt.savefig(str(filename), bbox_inches="tight")
+    from PIL import Image
+
+    image = wordcloud_image(frequencies)
+    for output in outputs:
+        fmt = OUTPUTS[output]
+        path = str(output_file(filename, output))
+        if fmt.suffix == ".pdf":
+            image.save(
+                path, resolution=RESOLUTION, creationDate=PDF_DATE, modDate=PDF_DATE
+            )
+        else:
+            scale = fmt.dpi / RESOLUTION
+            size = (round(image.width * scale), round(image.height * scale))
+            image.resize(size, Image.LANCZOS).save(path, dpi=(fmt.dpi, fmt.dpi))
+
+
+def points_wordcloud(frequencies: Dict[str, int], filename: Path) -> FigureJob:
+    """Create a WordCloud of the short-answer responses.
 
-    return df["confusion"]
+    :param frequencies: Words and their counts, from word_frequencies.
+    :param filename: Path to write plot to file.
+    :return: The job that draws the WordCloud.
+    """
+    return FigureJob(draw_wordcloud, frequencies, filename)
 
 
-def most_confused_responses(df: pd.DataFrame) -> Dict:
-    """Get a dictionary of responses from the most confused students.
+def draw_confusion_histogram(
+        counts: np.ndarray, filename: Path, outputs: List[str] = PRINT
+) -> None:
+    """Draw a bar plot of how many students gave each confusion rating.
 
-    :param df: DataFrame of quiz report data.
-    :return: dictionary of responses.
+    :param counts: Number of responses for each of CONFUSION_LEVELS.
+    :param filename: Path to write plot to file.
+    :param outputs: Names of the figures.OUTPUTS to write.
+    :return: None
     """
-    short_response_header = [
-        h for h in df.columns.values if "confusing or interesting topics" in h
-    ][0]
-
-    confusion_header = [h for h in df.columns.values if "rank your confusion" in h][0]
+    with new_figure() as fig:
+        ax = fig.add_subplot(1, 1, 1)
+        ax.bar(CONFUSION_LEVELS, counts)
+        ax.set_xlabel("Confusion (5 is most confused)")
+        ax.set_ylabel("Responses")
+        ax.yaxis.set_major_locator(MaxNLocator(integer=True))
+        save_figure(fig, filename, outputs)
+
+
+def confusion_histogram(
+        levels: pd.Series, filename: Path
+) -> Tuple[pd.Series, FigureJob]:
+    """Create a bar plot of self-rated confusion.
 
-    sorted_df = df.sort_values(by=confusion_header, ascending=False)
-    number_of_responses = min(3, len(sorted_df))
-    responses = [
-        {row[short_response_header]: row[confusion_header]}
-        for index, row in sorted_df[0:number_of_responses].iterrows()
-    ]
-    return {"most_confused": responses}
+    :param levels: How many students gave each rating, from section_levels.
+    :param filename: Path to write plot to file.
+    :return: pandas Series of the ratings, and the plot's job.
+    """
+    counts = levels.reindex(CONFUSION_LEVELS, fill_value=0).values
+    job = FigureJob(draw_confusion_histogram, counts, filename)
+    return section_ratings(levels), job
 
 
 def process_instructor_results(
-        df: pd.DataFrame, instructor: str, figures_dir: Path
-) -> Dict:
-    """Call plotting functions and collect data for instructor-specific DataFrames.
+        aggregates: QuizAggregates,
+        instructor: str,
+        figures_dir: Path,
+        schema: ReportSchema,
+) -> Tuple[Dict, List[FigureJob]]:
+    """Collect plots and data for one instructor.
 
-    :param df: DataFrame containing data for one instructor.
+    :param aggregates: The quiz's aggregates.
     :param instructor: Name of the instructor.
     :param figures_dir: Path to the output directory for figures.
-    :return: dictionary of data to be used in LaTeX document.
+    :param schema: ReportSchema of the quiz report.
+    :return: dictionary of data to be used in LaTeX document, and the plots' jobs.
     """
-    if len(df) == 0:
+    if aggregates.section_counts.get(instructor, 0) == 0:
         print("Could not plot, not enough entries.")
-        return {}
+        return {}, []
     plots_created = {}
+    jobs = []
 
-    for q in df.columns.values.tolist()[0:-1:2]:
-        number, title = re.match(r"(\d+): ([^\"]+)", q).groups()
-        blacklist = ["\xa0"]
-        for item in blacklist:
-            title = title.replace(item, " ")
-        filename = Path(figures_dir / f"{instructor}_{number}.pdf")
+    for role in ["confusion", "short_response"]:
+        title = schema[role].title
+        question_id = schema[role].question_id
+        filename = Path(figures_dir / f"{section_slug(instructor)}_{question_id}.pdf")
 
-        if "confusing or interesting topics" in q:
-            points_wordcloud(q, df, filename)
+        if role == "short_response":
+            frequencies = word_frequencies(aggregates.word_counts, instructor)
+            jobs.append(points_wordcloud(frequencies, filename))
             plots_created["short_response"] = {
                 "title": title,
                 "filename": str(filename),
             }
 
-        elif "rank your confusion" in q:
-            responses = confusion_histogram(df, filename)
+        elif role == "confusion":
+            confusion, job = confusion_histogram(
+                section_levels(aggregates, instructor), filename
+            )
+            jobs.append(job)
 
             plots_created["ranked_confusion"] = {
                 "title": title,
                 "filename": str(filename),
-                "count": len(responses),
-                "mean_confusion": responses.mean(),
-                "median_confusion": responses.median(),
+                "count": len(confusion),
+                "mean_confusion": confusion.mean(),
+                "median_confusion": confusion.median(),
             }
 
-    return plots_created
+    plots_created["most_confused"] = aggregates.most_confused.get(instructor, [])
+    return plots_created, jobs
 
 
-def generate_report_contents(
-        c: Canvas,
+def store_responses(
+        store: ResponseStore,
+        course_name: str,
+        quiz_number: int,
+        report_df: pd.DataFrame,
+        schema: ReportSchema,
+        incremental: bool = False,
+) -> QuizAggregates:
+    """Add a quiz report to the store, and get the quiz's aggregates from it.
+
+    :param store: The store to add the responses to.
+    :param course_name: Name of the course.
+    :param quiz_number: Which Muddy Points survey the report is of.
+    :param report_df: DataFrame of quiz report data.
+    :param schema: ReportSchema of report_df.
+    :param incremental: Only clean and apply the rows that are new or changed
+        since the quiz was last stored. The whole report is processed if the
+        quiz has not been stored before.
+    :return: The quiz's aggregates.
+    """
+    digests = row_digests(report_df)
+    delta = None
+    if incremental:
+        delta = store.report_delta(course_name, quiz_number, digests)
+    if delta is None:
+        responses = normalize_responses(report_df, schema)
+        store.add_quiz(course_name, quiz_number, responses, digests)
+    else:
+        changed, removed = delta
+        print(f"{len(changed)} new or changed responses, {len(removed)} removed.")
+        if not changed and not removed:
+            return store.aggregates(course_name, quiz_number)
+        rows = report_df[report_df["id"].isin(changed)]
+        store.update_quiz(
+            course_name,
+            quiz_number,
+            normalize_responses(rows, schema),
+            changed + removed,
+            digests[changed],
+        )
+    return store.aggregates(course_name, quiz_number)
+
+
+def prepare_report_contents(
         report_df: pd.DataFrame,
         quiz_number: int,
         figures_dir: Path,
-        recipients_file: Path = None,
-) -> Dict:
-    """Create a JSON-serializable Dict of the report contents
+        store: ResponseStore = None,
+        course_name: str = None,
+        incremental: bool = False,
+) -> Tuple[Dict, List[FigureJob]]:
+    """Work out the report contents, and the figures they need, without drawing.
 
-    :param c: Already instantiated Canvas object.
     :param report_df: DataFrame of quiz report data.
     :param quiz_number: Which Muddy Points survey to check, e.g. 1
     :param figures_dir: Path to the output directory for figures.
-    :param recipients_file: Path to file containing recipient names.
-    :param return: dictionary of report contents to be used in LaTeX document.
+    :param store: Add the responses to this store, and plot the course's trend.
+    :param course_name: Name of the course, needed with store.
+    :param incremental: With store, only process the rows of the report that
+        changed since it was last stored.
+    :return: JSON-serializable report contents, and the FigureJobs that draw the
+        figures they refer to.
     """
-    # Create plots and add them to contents
+    # Sum up the responses once, then create plots and add them to contents
     print("Generating report contents...")
-    questions_df = report_df.filter(regex=r"\d+", axis=1)
+    schema = report_schema(report_df.columns)
+    if store is None:
+        with span("normalize", rows=len(report_df)):
+            aggregates = aggregate_responses(normalize_responses(report_df, schema))
+    else:
+        with span("store", rows=len(report_df), incremental=incremental):
+            aggregates = store_responses(
+                store, course_name, quiz_number, report_df, schema, incremental
+            )
+    figure_jobs = []
+
     combined_figures = {}
     attendance_filename = Path(figures_dir / "attendance.pdf")
-    combined_figures["attendance"] = plot_attendance_by_section(
-        questions_df, attendance_filename
+    combined_figures["attendance"], job = plot_attendance_by_section(
+        aggregates, attendance_filename
     )
+    figure_jobs.append(job)
     combined_confusion_filename = Path(figures_dir / "combined_kdeplot.pdf")
-    combined_figures["kdeplot"] = combined_confusion_kdeplot(
-        report_df, combined_confusion_filename
+    combined_figures["kdeplot"], job = combined_confusion_kdeplot(
+        aggregates, combined_confusion_filename
     )
+    figure_jobs.append(job)
     combined_barplot_filename = Path(figures_dir / "combined_barplot.pdf")
-    combined_figures["stacked"] = combined_confusion_barplot(
-        report_df, combined_barplot_filename
+    combined_figures["stacked"], job = combined_confusion_barplot(
+        confusion_counts(aggregates), combined_barplot_filename
     )
-    varman_df, holloway_df = split_by_instructor(questions_df)
-    varman_data = process_instructor_results(varman_df, "Varman", figures_dir)
-    holloway_data = process_instructor_results(holloway_df, "Holloway", figures_dir)
-
-    # Get the most confused questions and add them to the contents
-    varman_questions = most_confused_responses(varman_df)
-    varman_data.update(varman_questions)
-    holloway_questions = most_confused_responses(holloway_df)
-    holloway_data.update(holloway_questions)
+    figure_jobs.append(job)
+    if store is not None:
+        trend_filename = Path(figures_dir / "confusion_trend.pdf")
+        combined_figures["trend"], job = confusion_trend_plot(
+            store.confusion_summary(course_name), trend_filename
+        )
+        figure_jobs.append(job)
+
+    # Every section's figures come from the same aggregates
+    instructors = {}
+    with span("sections"):
+        for instructor in sorted(aggregates.section_counts.index):
+            instructors[instructor], instructor_jobs = process_instructor_results(
+                aggregates, instructor, figures_dir, schema
+            )
+            figure_jobs.extend(instructor_jobs)
 
     # Generate a timestamp
     d = datetime.now()
@@ -302,13 +534,65 @@ def generate_report_contents(
     report_contents["timestamp"] = timestamp
     report_contents["quiz_number"] = quiz_number
     report_contents["combined"] = combined_figures
-    report_contents["instructors"] = {"Varman": varman_data, "Holloway": holloway_data}
+    report_contents["instructors"] = instructors
+    return report_contents, figure_jobs
+
+
+def generate_report_contents(
+        c: Canvas,
+        report_df: pd.DataFrame,
+        quiz_number: int,
+        figures_dir: Path,
+        recipients_file: Path = None,
+        jobs: int = 1,
+        figure_cache: bool = True,
+        store: ResponseStore = None,
+        course_name: str = None,
+        incremental: bool = False,
+        figure_outputs: List[str] = PRINT,
+) -> Dict:
+    """Create a JSON-serializable Dict of the report contents
+
+    :param c: Already instantiated Canvas object.
+    :param report_df: DataFrame of quiz report data.
+    :param quiz_number: Which Muddy Points survey to check, e.g. 1
+    :param figures_dir: Path to the output directory for figures.
+    :param recipients_file: Path to file containing recipient names.
+    :param jobs: Number of processes to render figures with.
+    :param figure_cache: Skip figures whose inputs have not changed since last run.
+    :param store: Add the responses to this store, and plot the course's trend.
+    :param course_name: Name of the course, needed with store; also limits the
+        recipient search to the course.
+    :param incremental: With store, only process the rows of the report that
+        changed since it was last stored.
+    :param figure_outputs: Names of the figures.OUTPUTS to render figures for.
+    :param return: dictionary of report contents to be used in LaTeX document.
+    """
+    report_contents, figure_jobs = prepare_report_contents(
+        report_df,
+        quiz_number,
+        figures_dir,
+        store=store,
+        course_name=course_name,
+        incremental=incremental,
+    )
+
+    # Render every figure before the report can be typeset
+    print(f"Rendering {len(figure_jobs)} figures...")
+    cache = None
+    if figure_cache:
+        cache = FigureCache(Path(figures_dir.parent / FIGURE_MANIFEST))
+    with span("figures", jobs=jobs):
+        counts = render_figures(
+            figure_jobs, max_workers=jobs, cache=cache, outputs=figure_outputs
+        )
+    print(f"Figure cache: {counts['hits']} hits, {counts['misses']} misses.")
 
     # Get recipient IDs
     if recipients_file is not None:
-        with recipients_file.open("r") as f:
+        with recipients_file.open("r") as f, span("recipients"):
             names = [name.strip() for name in f.readlines()]
-            recipients = c.get_recipient_ids(names)
+            recipients = c.get_recipient_ids(names, course_name)
             report_contents["recipients"] = recipients
 
     print("Generation complete.")
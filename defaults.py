@@ -0,0 +1,30 @@
+from pathlib import Path
+
+"""Names and defaults shared by the command line and the batch engine.
+
+Kept apart from cli.py, so that the batch engine and its worker processes do
+not import the command line to know where things go.
+"""
+
+# Every fetched report is also added here, for trends across quizzes.
+RESPONSE_STORE = "responses.sqlite"
+
+# Finished uploads, so an interrupted upload only re-sends what is missing.
+UPLOAD_LEDGER = "uploads.json"
+
+# Kept in each output directory, so unchanged reports are not typeset again.
+LATEX_BUILD_DIR = ".latex"
+
+# Compiled report templates, so that a new run does not compile them again.
+TEMPLATE_CACHE = "templates"
+
+OUTPUT_FORMATS = ["pdf", "docx", "tex", "zip"]
+
+# Written to the output directory after every run: where the time went.
+TIMINGS_FILE = "timings.json"
+
+OUTPUT_DIR = Path("output")
+TEMPLATE_FILE = Path("report_template.tex")
+RECIPIENTS_FILE = Path("recipients.txt")
+TOKEN_FILE = Path("canvas_token.txt")
+CACHE_DIR = Path(".cache")
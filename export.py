@@ -1,6 +1,11 @@
+import io
+import os
 import pypandoc
 import zipfile
-from typing import List
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from typing import BinaryIO, List, Tuple
 from pathlib import Path
 
 """Module for file export and archiving.
@@ -44,31 +49,158 @@ def make_texfile(rendered_latex: str, latex_filepath: Path) -> None:
         f.write(rendered_latex)
 
 
-def make_docx(latex_filepath: str, docx_filepath: Path) -> None:
+def make_docx(
+        latex_filepath: str, docx_filepath: Path, figures: Path = None
+) -> None:
     """Create .docx file from LaTeX document.
 
     Due to limitations in pypandoc/pandoc itself, pypandoc.convert_file must
     be used to create a .docx file. Otherwise, the LaTeX parameter could
     be a string of rendered LaTeX as in make_texfile.
 
+    Word cannot show PDF figures. With figures, every PDF figure that was also
+    rendered for Word is swapped for its PNG, in a copy of the LaTeX document
+    that is converted instead.
+
     :param latex_filepath: source Path of LaTeX document
     :param docx_filepath: destination Path to write .docx to file
+    :param figures: Path to directory containing all figures
+    :return: None
+    """
+    from figures import output_file
+
+    swaps = []
+    if figures is not None:
+        for figure in sorted(figures.glob("*.pdf")):
+            docx_figure = output_file(figure, "docx")
+            if docx_figure.exists():
+                swaps.append((str(figure), str(docx_figure)))
+    if not swaps:
+        pypandoc.convert_file(
+            str(latex_filepath), "docx", outputfile=str(docx_filepath)
+        )
+        return
+
+    latex = Path(latex_filepath).read_text()
+    for figure, docx_figure in swaps:
+        latex = latex.replace(figure, docx_figure)
+    docx_latex = Path(latex_filepath).with_suffix(".docx.tex")
+    docx_latex.write_text(latex)
+    try:
+        pypandoc.convert_file(str(docx_latex), "docx", outputfile=str(docx_filepath))
+    finally:
+        docx_latex.unlink()
+
+
+def compression_for(path: Path) -> int:
+    """Pick how to compress a file in an archive.
+
+    Formats that are already compressed are stored, since deflating them again
+    costs time and saves next to nothing.
+
+    :param path: Path of the file to archive.
+    :return: zipfile.ZIP_STORED or zipfile.ZIP_DEFLATED.
+    """
+    compressed_suffixes = {".pdf", ".png", ".jpg", ".jpeg", ".gif", ".zip", ".docx"}
+    if path.suffix.lower() in compressed_suffixes:
+        return zipfile.ZIP_STORED
+    return compression
+
+
+def archive_members(
+        files: List[Path], figures: Path, base_dir: Path
+) -> List[Tuple[Path, str]]:
+    """List the files of an archive, with their names inside it.
+
+    :param files: list of file Paths to include in archive
+    :param figures: Path to directory containing all figures
+    :param base_dir: Directory that names in the archive are relative to
+    :return: (file Path, archive name) for every file
+    """
+    paths = list(files) + sorted(p for p in figures.glob("**/*") if p.is_file())
+    members = []
+    for path in paths:
+        arcname = Path(os.path.relpath(str(path), str(base_dir)))
+        if arcname.parts[0] == os.pardir:
+            arcname = Path(path.name)
+        members.append((path, arcname.as_posix()))
+    return members
+
+
+def read_member(path: Path, arcname: str) -> Tuple[zipfile.ZipInfo, bytes]:
+    """Read one file for an archive.
+
+    Called from worker threads, so the next files are read while one is being
+    compressed and written.
+
+    :param path: Path of the file to archive
+    :param arcname: Name of the file inside the archive
+    :return: ZipInfo describing the member, and the file's contents
+    """
+    zinfo = zipfile.ZipInfo.from_file(str(path), arcname)
+    zinfo.compress_type = compression_for(path)
+    with path.open("rb") as f:
+        return zinfo, f.read()
+
+
+def write_archive(
+        stream: BinaryIO, members: List[Tuple[Path, str]], max_workers: int = 4
+) -> None:
+    """Write a .zip archive to a stream, compressing each member as suits it.
+
+    The stream does not need to be seekable: it can be a file, a socket or an
+    io.BytesIO. Files are read ahead on a thread pool, at most max_workers at
+    a time, so no more than that many are held in memory at once.
+
+    :param stream: Binary stream to write the archive to
+    :param members: (file Path, archive name) of every file, e.g. from
+        archive_members
+    :param max_workers: Threads to read members with
     :return: None
     """
-    pypandoc.convert_file(str(latex_filepath), "docx", outputfile=str(docx_filepath))
+    members = iter(members)
+    with zipfile.ZipFile(stream, mode="w") as zf, ThreadPoolExecutor(
+            max_workers=max_workers
+    ) as pool:
+        pending = deque(
+            pool.submit(read_member, *member)
+            for member in islice(members, max_workers)
+        )
+        while pending:
+            zinfo, data = pending.popleft().result()
+            for member in islice(members, 1):
+                pending.append(pool.submit(read_member, *member))
+            zf.writestr(zinfo, data)
 
 
 def make_archive(archive_name: Path, files: List[Path], figures: Path) -> None:
-    """Add files to .zip archive, compressing if possible.
+    """Add files to .zip archive, compressing where it helps.
+
+    Names in the archive are relative to the archive's directory, e.g.
+    "muddy_points_1.pdf" and "figures/attendance.pdf". The archive is written
+    to a temporary file and moved into place, so removed files do not linger.
 
     :param archive_name: destination Path to write .zip to file
     :param files: list of file Paths to include in archive
     :param figures: Path to directory containing all figures
     :return: None
     """
-    with zipfile.ZipFile(str(archive_name), mode="w") as zf:
-        for filename in files:
-            zf.write(str(filename), compress_type=compression)
+    members = archive_members(files, figures, archive_name.parent)
+    tmp_name = archive_name.with_suffix(".tmp")
+    with tmp_name.open("wb") as f:
+        write_archive(f, members)
+    os.replace(str(tmp_name), str(archive_name))
+
+
+def archive_buffer(files: List[Path], figures: Path, base_dir: Path) -> io.BytesIO:
+    """Build a .zip archive in memory, e.g. to upload it without a temp file.
 
-        for filename in figures.glob("**/*"):
-            zf.write(str(filename), compress_type=compression)
+    :param files: list of file Paths to include in archive
+    :param figures: Path to directory containing all figures
+    :param base_dir: Directory that names in the archive are relative to
+    :return: The archive, positioned at its start
+    """
+    buffer = io.BytesIO()
+    write_archive(buffer, archive_members(files, figures, base_dir))
+    buffer.seek(0)
+    return buffer
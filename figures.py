@@ -0,0 +1,313 @@
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from functools import lru_cache, partial
+from pathlib import Path
+from typing import Dict, Iterator, List
+import hashlib
+import json
+import os
+import pickle
+import time
+
+from instrumentation import count, recorder
+
+"""Figure jobs and how to run them.
+
+Rendering a figure is the slow part of building a report, and matplotlib only
+ever uses one core. Each figure is therefore described as a FigureJob: a
+module-level drawing function, the already-cleaned data it needs and the path
+to write to. Jobs share no state, so they can be rendered one after another or
+spread over a pool of worker processes with identical results.
+
+A FigureCache remembers a digest of every job it has rendered: the job's data,
+its drawing code, the source of the modules drawing functions rely on (their
+helpers, sizes and styles), matplotlib's settings and the plotting library
+versions. A job
+whose digest matches and whose files still exist is not rendered again.
+
+Drawing functions never go through pyplot. Each process draws every figure on
+one matplotlib Figure with an Agg canvas, handed out by new_figure and cleared
+as soon as the figure is saved, so memory use stays the same however many
+figures a process renders. save_figure writes a figure once per output in
+OUTPUTS, each in its own format and resolution.
+"""
+
+# Libraries whose upgrades can change how a figure looks.
+PLOTTING_LIBRARIES = ["matplotlib", "numpy", "pandas", "seaborn", "wordcloud"]
+
+# Modules of this project whose changes can change how a figure looks: the
+# drawing functions, the helpers they call, figure sizes and matplotlib style.
+DRAWING_MODULES = ["figures", "wordclouds", "data_processing"]
+
+FigureJob = namedtuple("FigureJob", ["draw", "data", "filename"])
+
+# How a figure is written for each of its uses. The report is typeset with the
+# vector PDFs; Word cannot show PDF images, so it gets PNGs, and previews
+# smaller PNGs still.
+FigureFormat = namedtuple("FigureFormat", ["suffix", "dpi"])
+OUTPUTS = {
+    "print": FigureFormat(".pdf", 300),
+    "docx": FigureFormat(".png", 150),
+    "preview": FigureFormat(".png", 72),
+}
+
+# The outputs rendered unless asked otherwise; the .tex file refers to these.
+PRINT = ["print"]
+
+# Size of every figure, in inches.
+FIGSIZE = (7.5, 3)
+
+
+def output_file(filename: Path, output: str) -> Path:
+    """Get where a figure is written for one of its outputs.
+
+    :param filename: The figure's path, as given in its FigureJob.
+    :param output: Name of one of the OUTPUTS.
+    :return: The figure's own path for "print", a sibling for the others, e.g.
+        "attendance_docx.png".
+    """
+    filename = Path(filename)
+    suffix = OUTPUTS[output].suffix
+    if output == "print":
+        return filename.with_suffix(suffix)
+    return filename.with_name(f"{filename.stem}_{output}{suffix}")
+
+
+def figure_outputs(formats: List[str]) -> List[str]:
+    """Choose the outputs to render figures for, from the report formats.
+
+    :param formats: Report formats being written, as in defaults.OUTPUT_FORMATS.
+    :return: Names of OUTPUTS.
+    """
+    return PRINT + (["docx"] if "docx" in formats else [])
+
+
+@lru_cache(maxsize=1)
+def _figure():
+    """Create the Figure every figure of this process is drawn on.
+
+    :return: matplotlib Figure with an Agg canvas.
+    """
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+
+    fig = Figure(figsize=FIGSIZE)
+    FigureCanvasAgg(fig)
+    return fig
+
+
+@contextmanager
+def new_figure() -> Iterator:
+    """Lend out this process's Figure, blank, and clear it again afterwards.
+
+    The Figure is shared, so figures must be drawn one at a time in a process.
+
+    :return: Context manager giving the matplotlib Figure.
+    """
+    fig = _figure()
+    try:
+        yield fig
+    finally:
+        fig.clear()
+        fig.set_size_inches(FIGSIZE)
+
+
+def save_figure(fig, filename: Path, outputs: List[str] = PRINT) -> None:
+    """Write a figure for each of its outputs.
+
+    PDFs are written without a creation date, so the same data always renders
+    to a byte-identical file, whichever process renders it.
+
+    :param fig: Figure from new_figure.
+    :param filename: The figure's path, as given in its FigureJob.
+    :param outputs: Names of OUTPUTS to write.
+    :return: None
+    """
+    for output in outputs:
+        fmt = OUTPUTS[output]
+        metadata = {"CreationDate": None} if fmt.suffix == ".pdf" else None
+        fig.savefig(
+            str(output_file(filename, output)),
+            dpi=fmt.dpi,
+            format=fmt.suffix.lstrip("."),
+            bbox_inches="tight",
+            metadata=metadata,
+        )
+
+
+def render_figure(job: FigureJob, outputs: List[str] = PRINT) -> str:
+    """Render a single figure.
+
+    :param job: The figure to render.
+    :param outputs: Names of OUTPUTS to write.
+    :return: The path the figure was written to.
+    """
+    job.draw(job.data, job.filename, outputs)
+    return str(job.filename)
+
+
+def _timed_render(job: FigureJob, outputs: List[str] = PRINT) -> float:
+    """Render a single figure, in whichever process.
+
+    :param job: The figure to render.
+    :param outputs: Names of OUTPUTS to write.
+    :return: How long it took, in seconds.
+    """
+    start = time.perf_counter()
+    render_figure(job, outputs)
+    return time.perf_counter() - start
+
+
+@lru_cache(maxsize=1)
+def plotting_environment() -> str:
+    """Describe everything outside a job that affects how it renders.
+
+    :return: Library versions and matplotlib rcParams, as one string.
+    """
+    import matplotlib
+
+    versions = []
+    for name in PLOTTING_LIBRARIES:
+        module = __import__(name)
+        versions.append(f"{name}=={getattr(module, '__version__', '?')}")
+    params = sorted((k, repr(v)) for k, v in matplotlib.rcParams.items())
+    return repr((versions, params))
+
+
+@lru_cache(maxsize=None)
+def module_source_digest(module_name: str) -> str:
+    """Hash the source of one of this project's modules.
+
+    :param module_name: Name of a module next to this one, e.g. "wordclouds".
+    :return: Hex SHA-256 digest of its source file.
+    """
+    source_file = Path(Path(__file__).parent / f"{module_name}.py")
+    return hashlib.sha256(source_file.read_bytes()).hexdigest()
+
+
+def job_digest(job: FigureJob, outputs: List[str] = PRINT) -> str:
+    """Hash everything that determines the bytes of a figure.
+
+    :param job: The figure to hash.
+    :param outputs: Names of the OUTPUTS it is rendered for.
+    :return: Hex SHA-256 digest.
+    """
+    code = job.draw.__code__
+    sha = hashlib.sha256()
+    sha.update(f"{job.draw.__module__}.{job.draw.__qualname__}".encode())
+    sha.update(code.co_code)
+    # Nested code objects repr with their memory address, so leave them out.
+    consts = [c for c in code.co_consts if not hasattr(c, "co_code")]
+    sha.update(repr(consts).encode())
+    sha.update(Path(job.filename).suffix.encode())
+    sha.update(repr([(output, OUTPUTS[output]) for output in outputs]).encode())
+    sha.update(plotting_environment().encode())
+    # Drawing functions call helpers whose bytecode is not part of their own.
+    modules = set(DRAWING_MODULES)
+    if Path(Path(__file__).parent / f"{job.draw.__module__}.py").exists():
+        modules.add(job.draw.__module__)
+    for module_name in sorted(modules):
+        sha.update(module_source_digest(module_name).encode())
+    sha.update(pickle.dumps(job.data, protocol=4))
+    return sha.hexdigest()
+
+
+class FigureCache:
+    """Digests of rendered figures, kept in a JSON manifest."""
+
+    def __init__(self, manifest_file: Path) -> None:
+        """Load the manifest, starting fresh if it is missing or corrupt.
+
+        :param manifest_file: JSON file mapping figure paths to digests.
+        :return: None
+        """
+        self.manifest_file = manifest_file
+        self.hits = 0
+        self.misses = 0
+        try:
+            with manifest_file.open("r") as f:
+                self.digests = json.load(f)
+        except (OSError, ValueError):
+            self.digests = {}
+
+    def is_fresh(
+            self, job: FigureJob, digest: str, outputs: List[str] = PRINT
+    ) -> bool:
+        """Check whether a figure was already rendered from identical inputs.
+
+        :param job: The figure to check.
+        :param digest: The job's digest from job_digest.
+        :param outputs: Names of the OUTPUTS it is rendered for.
+        :return: True if rendering can be skipped.
+        """
+        fresh = self.digests.get(str(job.filename)) == digest and all(
+            output_file(job.filename, output).exists() for output in outputs
+        )
+        if fresh:
+            self.hits = self.hits + 1
+        else:
+            self.misses = self.misses + 1
+        return fresh
+
+    def record(self, job: FigureJob, digest: str) -> None:
+        """Remember that a figure has been rendered.
+
+        :param job: The rendered figure.
+        :param digest: The job's digest from job_digest.
+        :return: None
+        """
+        self.digests[str(job.filename)] = digest
+
+    def save(self) -> None:
+        """Atomically write the manifest.
+
+        :return: None
+        """
+        tmp_file = self.manifest_file.with_suffix(".tmp")
+        with tmp_file.open("w") as f:
+            json.dump(self.digests, f, indent=1, sort_keys=True)
+        os.replace(str(tmp_file), str(self.manifest_file))
+
+
+def render_figures(
+        jobs: List[FigureJob],
+        max_workers: int = 1,
+        cache: FigureCache = None,
+        outputs: List[str] = PRINT,
+) -> Dict:
+    """Render every figure, returning only once all of them are written.
+
+    :param jobs: Figures to render.
+    :param max_workers: Worker processes to use, 1 renders in this process.
+    :param cache: Skip figures already rendered from identical inputs.
+    :param outputs: Names of OUTPUTS to write every figure for.
+    :return: Number of cache "hits" and "misses".
+    """
+    if cache is not None:
+        digests = {job.filename: job_digest(job, outputs) for job in jobs}
+        jobs = [
+            j for j in jobs if not cache.is_fresh(j, digests[j.filename], outputs)
+        ]
+
+    render = partial(_timed_render, outputs=outputs)
+    if max_workers <= 1 or len(jobs) <= 1:
+        seconds = [render(job) for job in jobs]
+    else:
+        with ProcessPoolExecutor(max_workers=min(max_workers, len(jobs))) as pool:
+            # Consuming the results re-raises any exception from a worker.
+            seconds = list(pool.map(render, jobs))
+    for job, elapsed in zip(jobs, seconds):
+        recorder().add(
+            "figure", elapsed, draw=job.draw.__name__, file=Path(job.filename).name
+        )
+
+    if cache is None:
+        count("figures.rendered", len(jobs))
+        return {"hits": 0, "misses": len(jobs)}
+    count("figures.rendered", cache.misses)
+    count("figures.reused", cache.hits)
+    for job in jobs:
+        cache.record(job, digests[job.filename])
+    cache.save()
+    return {"hits": cache.hits, "misses": cache.misses}
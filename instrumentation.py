@@ -0,0 +1,191 @@
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional
+import json
+import threading
+import time
+
+"""Where a run's time goes.
+
+Code marks the work it does with `with span("name"):` and tallies things such as
+requests made or bytes transferred with count(). Both go to the process-wide
+Recorder, which a command starts afresh with reset() and finally saves as a JSON
+timing report. Spans nest: a span opened inside another (on the same thread)
+records it as its parent, so the report shows e.g. which stage a Canvas request
+was made from.
+
+Recording is cheap enough to leave on: a span is two clock reads and a list
+append. For a function-level picture, profiled() runs a block under cProfile.
+"""
+
+
+class Recorder:
+    """Spans and counters of one run."""
+
+    def __init__(self) -> None:
+        """Start recording.
+
+        :return: None
+        """
+        self.started_at = time.time()
+        self._start = time.perf_counter()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.spans = []
+        self.counters = {}
+
+    def _stack(self) -> List[str]:
+        if not hasattr(self._local, "stack"):
+            self._local.stack = []
+        return self._local.stack
+
+    @contextmanager
+    def span(self, name: str, **attrs) -> Iterator[Dict]:
+        """Time a block of work.
+
+        :param name: What the work is, e.g. "fetch" or "canvas.request".
+        :param attrs: JSON-serializable details, e.g. the URL requested.
+        :return: Context manager yielding the span's attrs, which the block may
+            add to, e.g. the response status.
+        """
+        stack = self._stack()
+        parent = stack[-1] if stack else None
+        stack.append(name)
+        start = time.perf_counter()
+        try:
+            yield attrs
+        finally:
+            seconds = time.perf_counter() - start
+            stack.pop()
+            self.add(name, seconds, start=start, parent=parent, **attrs)
+
+    def add(self, name: str, seconds: float, start: float = None, **attrs) -> None:
+        """Record a span timed elsewhere, e.g. in a worker process.
+
+        :param name: What the work is.
+        :param seconds: How long it took.
+        :param start: time.perf_counter() when it started, if known.
+        :param attrs: JSON-serializable details.
+        :return: None
+        """
+        entry = {"name": name, "seconds": seconds}
+        if start is not None:
+            entry["start"] = start - self._start
+        entry.update((k, v) for k, v in attrs.items() if v is not None)
+        with self._lock:
+            self.spans.append(entry)
+
+    def count(self, name: str, value: int = 1) -> None:
+        """Add to a counter.
+
+        :param name: What is counted, e.g. "canvas.bytes_received".
+        :param value: Amount to add.
+        :return: None
+        """
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def totals(self) -> Dict[str, Dict]:
+        """Sum the spans up by name.
+
+        :return: Number of spans, total and longest seconds, by name.
+        """
+        totals = {}
+        for entry in self.spans:
+            total = totals.setdefault(
+                entry["name"], {"count": 0, "seconds": 0.0, "max_seconds": 0.0}
+            )
+            total["count"] = total["count"] + 1
+            total["seconds"] = total["seconds"] + entry["seconds"]
+            total["max_seconds"] = max(total["max_seconds"], entry["seconds"])
+        return totals
+
+    def report(self) -> Dict:
+        """Describe the run so far.
+
+        :return: Wall time, span totals, counters and every span, in the order
+            they finished.
+        """
+        with self._lock:
+            return {
+                "started_at": self.started_at,
+                "seconds": time.perf_counter() - self._start,
+                "totals": self.totals(),
+                "counters": dict(self.counters),
+                "spans": list(self.spans),
+            }
+
+    def write(self, report_file: Path) -> None:
+        """Save the timing report as JSON.
+
+        :param report_file: File to write.
+        :return: None
+        """
+        with report_file.open("w") as f:
+            json.dump(self.report(), f, indent=1)
+
+
+_recorder = Recorder()
+
+
+def reset() -> Recorder:
+    """Start a new recording, e.g. at the start of a command.
+
+    :return: The new Recorder.
+    """
+    global _recorder
+    _recorder = Recorder()
+    return _recorder
+
+
+def recorder() -> Recorder:
+    """Get the Recorder in use.
+
+    :return: The Recorder.
+    """
+    return _recorder
+
+
+def span(name: str, **attrs):
+    """Time a block of work on the Recorder in use, see Recorder.span.
+
+    :param name: What the work is.
+    :param attrs: JSON-serializable details.
+    :return: Context manager.
+    """
+    return _recorder.span(name, **attrs)
+
+
+def count(name: str, value: int = 1) -> None:
+    """Add to a counter of the Recorder in use.
+
+    :param name: What is counted.
+    :param value: Amount to add.
+    :return: None
+    """
+    _recorder.count(name, value)
+
+
+@contextmanager
+def profiled(profile_file: Optional[Path]) -> Iterator[None]:
+    """Run a block under cProfile, and dump the stats for pstats.
+
+    Only the calling thread is profiled; work done on thread pools or in worker
+    processes shows up as the time spent waiting for it.
+
+    :param profile_file: File to dump the stats to, None to not profile.
+    :return: Context manager.
+    """
+    if profile_file is None:
+        yield
+        return
+    import cProfile
+
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        yield
+    finally:
+        profile.disable()
+        profile.dump_stats(str(profile_file))
+        print(f"Profile written to {profile_file}")
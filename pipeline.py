@@ -0,0 +1,64 @@
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Dict, List
+import time
+
+from instrumentation import span
+
+"""A small executor for stages that depend on each other.
+
+Each Stage names the stages it needs to have finished first. Every stage whose
+dependencies are done is started at once, on a thread pool: the output stages
+mostly wait on pdflatex and pandoc subprocesses or on zlib, none of which hold
+the GIL, so they really do run side by side.
+
+If a stage fails, no further stages are started, the ones already running are
+allowed to finish, and the exception is raised.
+"""
+
+Stage = namedtuple("Stage", ["name", "run", "depends_on"])
+
+
+def _timed(stage: Stage) -> float:
+    """Run a stage.
+
+    :param stage: The stage to run.
+    :return: How long it took, in seconds.
+    """
+    start = time.perf_counter()
+    with span(f"stage.{stage.name}"):
+        stage.run()
+    return time.perf_counter() - start
+
+
+def run_stages(stages: List[Stage], max_workers: int = 4) -> Dict[str, float]:
+    """Run every stage as soon as the stages it depends on have finished.
+
+    :param stages: The stages to run, with unique names.
+    :param max_workers: Most stages to run at the same time.
+    :return: Seconds each stage took, by name, in the order they finished.
+    """
+    names = {stage.name for stage in stages}
+    for stage in stages:
+        missing = [name for name in stage.depends_on if name not in names]
+        if missing:
+            raise ValueError(f"Stage {stage.name} depends on unknown {missing}")
+
+    timings = {}
+    pending = list(stages)
+    running = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        while pending or running:
+            ready = [s for s in pending if all(d in timings for d in s.depends_on)]
+            for stage in ready:
+                pending.remove(stage)
+                running[pool.submit(_timed, stage)] = stage
+            if not running:
+                cycle = ", ".join(stage.name for stage in pending)
+                raise ValueError(f"Stages depend on each other in a cycle: {cycle}")
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                stage = running.pop(future)
+                timings[stage.name] = future.result()
+    return timings
@@ -0,0 +1,223 @@
+from typing import Callable, Dict, List, Optional
+import random
+import time
+
+"""State machine for acquiring Canvas quiz reports.
+
+Canvas generates quiz reports in the background. Creating one returns either
+the finished report, or a report with a progress URL that has to be polled
+until the file is ready. QuizReportJob keeps track of where one report is in
+that process and when it should next be polled; it makes no HTTP requests of
+its own, so the same job drives both Canvas and AsyncCanvas.
+
+    pending -> generating -> fetching -> completed
+                    |            |
+                    +------------+-----> failed / timed_out
+"""
+
+PENDING = "pending"
+GENERATING = "generating"
+FETCHING = "fetching"
+COMPLETED = "completed"
+FAILED = "failed"
+TIMED_OUT = "timed_out"
+
+REPORT_TYPE = "student_analysis"
+
+
+def report_file_url(report: Dict) -> Optional[str]:
+    """Get the download URL of a report's file, if it has been generated.
+
+    :param report: Deserialized JSON data of a quiz report.
+    :return: The file URL, or None.
+    """
+    return (report.get("file") or {}).get("url")
+
+
+def report_version(report: Dict) -> str:
+    """Identify which generation of a report this is.
+
+    Canvas regenerates the report file when new submissions arrive, which bumps
+    the updated_at timestamps of the report and its file.
+
+    :param report: Deserialized JSON data of a quiz report.
+    :return: A string that changes whenever the report's contents may have.
+    """
+    file = report.get("file") or {}
+    return f"{report.get('updated_at')}|{file.get('updated_at')}|{file.get('size')}"
+
+
+class QuizReportJob:
+    """Progress of a single quiz report through generation and download."""
+
+    def __init__(
+            self,
+            course_id: str,
+            quiz_id: str,
+            timeout: float = 300.0,
+            callback: Callable[["QuizReportJob"], None] = None,
+            initial_delay: float = 1.0,
+            max_delay: float = 30.0,
+    ) -> None:
+        """Create a job for one quiz report.
+
+        :param course_id: The ID of the course to look in.
+        :param quiz_id: The ID of the desired quiz.
+        :param timeout: Seconds to wait for Canvas before giving up.
+        :param callback: Called with the job once it completes, fails or times out.
+        :param initial_delay: Seconds before the first progress poll.
+        :param max_delay: Upper bound on the delay between polls.
+        :return: None
+        """
+        self.course_id = course_id
+        self.quiz_id = quiz_id
+        self.timeout = timeout
+        self.callback = callback
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+
+        self.state = PENDING
+        self.report = None
+        self.report_id = None
+        self.progress_url = None
+        self.error = None
+        self.polls = 0
+        self.started_at = time.monotonic()
+        self.next_poll_at = self.started_at
+
+    def __repr__(self) -> str:
+        return (
+            f"QuizReportJob(course_id={self.course_id}, quiz_id={self.quiz_id}, "
+            f"state={self.state})"
+        )
+
+    @property
+    def done(self) -> bool:
+        """True once the job has completed, failed or timed out."""
+        return self.state in (COMPLETED, FAILED, TIMED_OUT)
+
+    def seconds_until_poll(self) -> float:
+        """Seconds until the job should next be polled, never negative.
+
+        :return: Delay in seconds.
+        """
+        return max(0.0, self.next_poll_at - time.monotonic())
+
+    def reusable_report(self, reports: List[Dict]) -> Optional[Dict]:
+        """Pick an existing, already generated student analysis report.
+
+        :param reports: Deserialized JSON list of the quiz's reports.
+        :return: The most recently updated generated report, or None.
+        """
+        generated = [
+            r
+            for r in reports
+            if r.get("report_type") == REPORT_TYPE and report_file_url(r)
+        ]
+        if not generated:
+            return None
+        return max(generated, key=lambda r: r.get("updated_at") or "")
+
+    def on_report(self, report: Dict) -> None:
+        """Advance the job with the latest known state of the report.
+
+        :param report: Deserialized JSON data of the report.
+        :return: None
+        """
+        self.report_id = report.get("id", self.report_id)
+        if report_file_url(report):
+            self._finish(COMPLETED, report=report)
+            return
+
+        progress = report.get("progress") or {}
+        if progress.get("workflow_state") == FAILED:
+            self._finish(FAILED, error=progress.get("message") or "Report failed")
+            return
+
+        self.progress_url = report.get("progress_url") or self.progress_url
+        if progress.get("workflow_state") == COMPLETED or not self.progress_url:
+            # Generated, but the file has not been attached yet.
+            self.state = FETCHING
+        else:
+            self.state = GENERATING
+        self._schedule()
+
+    def on_conflict(self, reports: List[Dict]) -> None:
+        """Handle 409 (In Progress) by attaching to the report being generated.
+
+        :param reports: Deserialized JSON list of the quiz's reports.
+        :return: None
+        """
+        in_progress = [r for r in reports if r.get("report_type") == REPORT_TYPE]
+        if not in_progress:
+            self._finish(FAILED, error="Report is in progress but could not be found")
+            return
+        self.on_report(max(in_progress, key=lambda r: r.get("updated_at") or ""))
+
+    def on_progress(self, progress: Dict) -> None:
+        """Advance the job with a polled Canvas Progress object.
+
+        :param progress: Deserialized JSON data of the progress URL.
+        :return: None
+        """
+        workflow_state = progress.get("workflow_state")
+        if workflow_state == COMPLETED:
+            self.state = FETCHING
+            self.next_poll_at = time.monotonic()
+        elif workflow_state == FAILED:
+            self._finish(FAILED, error=progress.get("message") or "Report failed")
+        else:
+            self._schedule()
+
+    def fail(self, error: str) -> None:
+        """Mark the job as failed.
+
+        :param error: Why the report could not be acquired.
+        :return: None
+        """
+        self._finish(FAILED, error=error)
+
+    def check_timeout(self) -> bool:
+        """Time the job out if it has been running for too long.
+
+        :return: True if the job timed out.
+        """
+        if not self.done and time.monotonic() - self.started_at > self.timeout:
+            self._finish(TIMED_OUT, error=f"No report after {self.timeout:.0f}s")
+        return self.state == TIMED_OUT
+
+    def result(self) -> Dict:
+        """Get the finished report.
+
+        :return: Deserialized JSON data of the report.
+        """
+        if self.state == TIMED_OUT:
+            raise TimeoutError(f"{self}: {self.error}")
+        if self.state != COMPLETED:
+            raise RuntimeError(f"{self}: {self.error}")
+        return self.report
+
+    def _schedule(self) -> None:
+        """Set the next poll time using exponential backoff with jitter.
+
+        :return: None
+        """
+        delay = min(self.max_delay, self.initial_delay * (2 ** self.polls))
+        # Equal jitter: at least half the delay, so polls never bunch up.
+        delay = delay / 2 + random.uniform(0, delay / 2)
+        self.next_poll_at = time.monotonic() + delay
+        self.polls = self.polls + 1
+
+    def _finish(self, state: str, report: Dict = None, error: str = None) -> None:
+        """Move into a final state and notify the callback.
+
+        :param state: One of COMPLETED, FAILED or TIMED_OUT.
+        :param report: The finished report, if any.
+        :param error: Why the job did not complete, if it did not.
+        :return: None
+        """
+        self.state = state
+        self.report = report
+        self.error = error
+        if self.callback is not None:
+            self.callback(self)
@@ -0,0 +1,252 @@
+from contextlib import contextmanager
+from typing import Any, Dict, Iterable, Iterator, Optional
+from pathlib import Path
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+
+# File locks keep processes sharing a cache (batch workers) from losing each
+# other's updates; where there are none, only threads are kept apart.
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+"""On-disk cache for quiz report CSVs and Canvas ID lookups.
+
+Report CSVs are stored content-addressed: each file in blobs/ is named after the
+SHA-256 of its bytes, so identical downloads are only stored once. index.json
+maps lookup keys to blobs (and to cached IDs). Every entry expires after a TTL,
+and the least recently used reports are evicted once the blobs outgrow the size
+budget.
+
+The index is rewritten on every update. Every update holds a lock on
+index.lock, both a thread lock and a file lock, so that updates made from
+several threads (e.g. concurrent recipient lookups) or several processes (the
+workers of a batch) do not lose each other. Blobs are moved into place under
+the same lock, and eviction only deletes the blobs of the entries it evicts,
+so a blob another process has just stored is never deleted.
+"""
+
+
+def make_key(*parts: Any) -> str:
+    """Join the parts of a cache key into a single string.
+
+    :param parts: e.g. install_url, course name, quiz number.
+    :return: The cache key.
+    """
+    return "|".join(str(part) for part in parts)
+
+
+class ReportCache:
+    """Local cache of quiz reports and ID lookups, with TTL and LRU eviction."""
+
+    def __init__(
+            self,
+            cache_dir: Path,
+            ttl: float = 7 * 24 * 60 * 60,
+            max_bytes: int = 500 * 1024 * 1024,
+            refresh: bool = False,
+    ) -> None:
+        """Open (or create) a cache directory.
+
+        :param cache_dir: Directory holding index.json and blobs/.
+        :param ttl: Seconds before an entry expires.
+        :param max_bytes: Size budget for cached reports.
+        :param refresh: Ignore cached entries when reading, but keep writing.
+        :return: None
+        """
+        self.cache_dir = cache_dir
+        self.blobs_dir = Path(cache_dir / "blobs")
+        self.index_file = Path(cache_dir / "index.json")
+        self.lock_file = Path(cache_dir / "index.lock")
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.refresh = refresh
+        self._lock = threading.Lock()
+        self.blobs_dir.mkdir(parents=True, exist_ok=True)
+
+    def _load_index(self) -> Dict:
+        """Read index.json, starting fresh if it is missing or corrupt.
+
+        :return: The index.
+        """
+        try:
+            with self.index_file.open("r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {"ids": {}, "reports": {}}
+
+    @contextmanager
+    def _index_lock(self) -> Iterator[None]:
+        """Hold the index, against other threads and other processes.
+
+        :return: Context manager holding the lock.
+        """
+        with self._lock, self.lock_file.open("a") as f:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+    def _tmp_name(self) -> str:
+        """Name a temporary file no other thread or process will use.
+
+        :return: File name.
+        """
+        return f"{os.getpid()}-{uuid.uuid4().hex}.tmp"
+
+    def _save_index(self, index: Dict) -> None:
+        """Atomically replace index.json.
+
+        :param index: The index to write.
+        :return: None
+        """
+        tmp_file = Path(self.cache_dir / f"index-{self._tmp_name()}")
+        with tmp_file.open("w") as f:
+            json.dump(index, f)
+        os.replace(str(tmp_file), str(self.index_file))
+
+    def _expired(self, entry: Dict) -> bool:
+        return time.time() - entry.get("stored_at", 0) > self.ttl
+
+    def _blob_path(self, digest: str) -> Path:
+        return Path(self.blobs_dir / f"{digest}.csv")
+
+    def get_id(self, key: str, allow_expired: bool = False) -> Optional[Any]:
+        """Get a cached ID lookup.
+
+        :param key: Key from make_key.
+        :param allow_expired: Return the entry even if it is past its TTL.
+        :return: The cached value, or None if missing, expired or refreshing.
+        """
+        if self.refresh:
+            return None
+        entry = self._load_index()["ids"].get(key)
+        if entry is None or (self._expired(entry) and not allow_expired):
+            return None
+        return entry.get("value")
+
+    def put_id(self, key: str, value: Any) -> None:
+        """Store an ID lookup.
+
+        :param key: Key from make_key.
+        :param value: JSON-serializable value to cache.
+        :return: None
+        """
+        with self._index_lock():
+            index = self._load_index()
+            index["ids"][key] = {"value": value, "stored_at": time.time()}
+            self._save_index(index)
+
+    def get_report(self, key: str, version: str = None) -> Optional[Path]:
+        """Get the cached CSV for a report.
+
+        :param key: Key from make_key, without the version.
+        :param version: Report version, e.g. its updated_at. None accepts the
+            most recently stored version even past its TTL, which is what
+            offline runs want.
+        :return: Path to the cached CSV, or None on a miss.
+        """
+        if self.refresh:
+            return None
+        with self._index_lock():
+            index = self._load_index()
+            entry = index["reports"].get(key)
+            if entry is None:
+                return None
+            if version is not None and (
+                    self._expired(entry) or entry.get("version") != version
+            ):
+                return None
+            path = self._blob_path(entry["blob"])
+            if not path.exists():
+                return None
+            entry["accessed_at"] = time.time()
+            self._save_index(index)
+        return path
+
+    def put_report(self, key: str, version: str, content: bytes) -> Path:
+        """Store a report CSV and evict whatever no longer fits.
+
+        :param key: Key from make_key, without the version.
+        :param version: Report version, e.g. its updated_at.
+        :param content: Raw bytes of the CSV.
+        :return: Path to the cached CSV.
+        """
+        return self.put_report_chunks(key, version, [content])
+
+    def put_report_chunks(
+            self, key: str, version: str, chunks: Iterable[bytes]
+    ) -> Path:
+        """Store a report CSV as it streams in, hashing it on the way to disk.
+
+        :param key: Key from make_key, without the version.
+        :param version: Report version, e.g. its updated_at.
+        :param chunks: Raw bytes of the CSV, in order.
+        :return: Path to the cached CSV.
+        """
+        sha = hashlib.sha256()
+        size = 0
+        tmp_path = Path(self.blobs_dir / self._tmp_name())
+        with tmp_path.open("wb") as f:
+            for chunk in chunks:
+                sha.update(chunk)
+                size = size + len(chunk)
+                f.write(chunk)
+        digest = sha.hexdigest()
+        path = self._blob_path(digest)
+
+        now = time.time()
+        with self._index_lock():
+            os.replace(str(tmp_path), str(path))
+            index = self._load_index()
+            index["reports"][key] = {
+                "version": version,
+                "blob": digest,
+                "size": size,
+                "stored_at": now,
+                "accessed_at": now,
+            }
+            self._evict(index)
+            self._save_index(index)
+        return path
+
+    def _evict(self, index: Dict) -> None:
+        """Drop expired entries, then least recently used reports over budget.
+
+        The blobs of evicted reports are deleted, unless another report still
+        refers to them. Must be called holding the index lock.
+
+        :param index: The index to prune in place.
+        :return: None
+        """
+        evicted = []
+        for section in ("ids", "reports"):
+            for key in [k for k, e in index[section].items() if self._expired(e)]:
+                entry = index[section].pop(key)
+                if section == "reports":
+                    evicted.append(entry["blob"])
+
+        reports = index["reports"]
+        by_age = sorted(reports, key=lambda k: reports[k]["accessed_at"])
+        blob_sizes = {e["blob"]: e["size"] for e in reports.values()}
+        total = sum(blob_sizes.values())
+        while total > self.max_bytes and len(by_age) > 1:
+            entry = reports.pop(by_age.pop(0))
+            evicted.append(entry["blob"])
+            if all(e["blob"] != entry["blob"] for e in reports.values()):
+                total = total - entry["size"]
+
+        referenced = {e["blob"] for e in reports.values()}
+        for digest in set(evicted) - referenced:
+            try:
+                self._blob_path(digest).unlink()
+            except FileNotFoundError:
+                pass
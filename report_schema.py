@@ -0,0 +1,137 @@
+from collections import namedtuple
+from functools import lru_cache
+from typing import Dict, Sequence, Tuple
+import re
+
+"""Index of the questions in a Canvas student analysis report.
+
+Canvas names each question column "<question id>: <question text>". Rather than
+scanning the headers for substrings every time a question is needed, a
+ReportSchema is built once per set of headers and maps each semantic role to
+its column. If a quiz is edited so that a question can no longer be found, a
+SchemaDriftError says which one, instead of an IndexError further down.
+"""
+
+# Substrings identifying the report question for each role.
+QUESTION_ROLES = {
+    "attendance": "registered for",
+    "confusion": "rank your confusion",
+    "short_response": "confusing or interesting topics",
+}
+
+# Report columns kept alongside the questions, to tell students apart and to
+# notice when one of them submits again.
+STUDENT_COLUMNS = ["id", "submitted"]
+
+QUESTION_HEADER = re.compile(r"(\d+): ([^\"]+)")
+
+# Characters Canvas leaves in question text that LaTeX should not see.
+TITLE_BLACKLIST = ["\xa0"]
+
+QuestionColumn = namedtuple(
+    "QuestionColumn", ["role", "position", "header", "question_id", "title"]
+)
+
+
+class SchemaDriftError(Exception):
+    """The report's headers no longer match the questions we expect."""
+
+
+def clean_title(title: str) -> str:
+    """Clean question text for use in the report.
+
+    :param title: Question text from a report header.
+    :return: Cleaned question text.
+    """
+    for item in TITLE_BLACKLIST:
+        title = title.replace(item, " ")
+    return title.strip()
+
+
+def report_usecols(header: str) -> bool:
+    """Select only the report columns that hold a known question or student ID.
+
+    Meant to be passed as pandas.read_csv(usecols=...), so that score and
+    unrelated question columns are never parsed.
+
+    :param header: A column header of the quiz report.
+    :return: True if the column should be kept.
+    """
+    if header in STUDENT_COLUMNS:
+        return True
+    return any(question in header for question in QUESTION_ROLES.values())
+
+
+class ReportSchema:
+    """Where each question role lives in one particular set of report headers."""
+
+    def __init__(self, columns: Dict[str, QuestionColumn]) -> None:
+        """Create the schema.
+
+        :param columns: QuestionColumn for every role in QUESTION_ROLES.
+        :return: None
+        """
+        self.columns = columns
+
+    def __getitem__(self, role: str) -> QuestionColumn:
+        return self.columns[role]
+
+    def header(self, role: str) -> str:
+        """Get the column header for a role.
+
+        :param role: A key of QUESTION_ROLES, e.g. "confusion".
+        :return: The full column header.
+        """
+        return self.columns[role].header
+
+    @classmethod
+    def from_headers(cls, headers: Sequence[str]) -> "ReportSchema":
+        """Index the question columns in a list of report headers.
+
+        :param headers: Column headers of the report, in order.
+        :return: The schema.
+        """
+        columns = {}
+        problems = []
+        for role, question in QUESTION_ROLES.items():
+            matches = [
+                (position, header)
+                for position, header in enumerate(headers)
+                if question in header
+            ]
+            if len(matches) != 1:
+                found = "no" if not matches else f"{len(matches)}"
+                problems.append(f"{found} columns contain {question!r} ({role})")
+                continue
+
+            position, header = matches[0]
+            match = QUESTION_HEADER.match(header)
+            if match is None:
+                problems.append(f"{header!r} is not a '<id>: <question>' header")
+                continue
+
+            question_id, title = match.groups()
+            columns[role] = QuestionColumn(
+                role, position, header, question_id, clean_title(title)
+            )
+
+        if problems:
+            raise SchemaDriftError(
+                "Quiz report does not match the expected questions: "
+                + "; ".join(problems)
+            )
+        return cls(columns)
+
+
+@lru_cache(maxsize=32)
+def _schema_for(headers: Tuple[str, ...]) -> ReportSchema:
+    return ReportSchema.from_headers(headers)
+
+
+def report_schema(headers: Sequence[str]) -> ReportSchema:
+    """Get the schema for a set of report headers, built once per signature.
+
+    :param headers: Column headers of the report, e.g. report_df.columns.
+    :return: The schema.
+    """
+    return _schema_for(tuple(headers))
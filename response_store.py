@@ -0,0 +1,470 @@
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+import sqlite3
+import numpy as np
+import pandas as pd
+
+from aggregates import (
+    MOST_CONFUSED,
+    QuizAggregates,
+    build_aggregates,
+    level_table,
+    level_totals,
+    section_totals,
+    student_totals,
+    word_totals,
+)
+from trends import section_summary
+
+"""Local store of every quiz's responses, for analysis across quizzes.
+
+Responses are kept in SQLite, one row per (course, quiz, section, student).
+Adding a quiz replaces only that quiz's rows, and its per-section summary is
+computed at the same time, so reading a semester's trend never touches the
+individual responses again.
+
+Alongside the responses, each quiz keeps a snapshot of the report it was last
+added from (a digest of every row, by student) and the per-section sums of
+aggregates.py. When a quiz is reported again mid-week, report_delta finds the
+students whose rows are new, changed or gone, and update_quiz subtracts their
+old responses from the sums and adds their new ones, so the update costs as
+much as the rows that changed, not the whole class.
+"""
+
+# Seconds to wait for another process (e.g. a batch worker) to finish writing
+# before giving up; adding a large report can hold the write lock a while.
+LOCK_TIMEOUT = 120.0
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+    course TEXT NOT NULL,
+    quiz INTEGER NOT NULL,
+    section TEXT NOT NULL,
+    student TEXT NOT NULL,
+    confusion REAL,
+    short_response TEXT,
+    PRIMARY KEY (course, quiz, section, student)
+);
+CREATE TABLE IF NOT EXISTS confusion_summary (
+    course TEXT NOT NULL,
+    quiz INTEGER NOT NULL,
+    section TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    mean REAL,
+    median REAL,
+    PRIMARY KEY (course, quiz, section)
+);
+CREATE TABLE IF NOT EXISTS report_rows (
+    course TEXT NOT NULL,
+    quiz INTEGER NOT NULL,
+    student TEXT NOT NULL,
+    digest INTEGER NOT NULL,
+    PRIMARY KEY (course, quiz, student)
+);
+CREATE TABLE IF NOT EXISTS quiz_totals (
+    course TEXT NOT NULL,
+    quiz INTEGER NOT NULL,
+    students INTEGER NOT NULL,
+    multi_section INTEGER NOT NULL,
+    PRIMARY KEY (course, quiz)
+);
+CREATE TABLE IF NOT EXISTS section_counts (
+    course TEXT NOT NULL,
+    quiz INTEGER NOT NULL,
+    section TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (course, quiz, section)
+);
+CREATE TABLE IF NOT EXISTS confusion_levels (
+    course TEXT NOT NULL,
+    quiz INTEGER NOT NULL,
+    section TEXT NOT NULL,
+    confusion REAL NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (course, quiz, section, confusion)
+);
+CREATE TABLE IF NOT EXISTS word_counts (
+    course TEXT NOT NULL,
+    quiz INTEGER NOT NULL,
+    section TEXT NOT NULL,
+    word TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (course, quiz, section, word)
+);
+CREATE TEMP TABLE IF NOT EXISTS stale_students (
+    student TEXT PRIMARY KEY
+);
+"""
+
+# Per-section sums and the columns, after course and quiz, that key them.
+SUM_TABLES = {
+    "section_counts": ["section"],
+    "confusion_levels": ["section", "confusion"],
+    "word_counts": ["section", "word"],
+}
+
+# Stored in place of a missing section, which the primary key does not allow.
+NO_SECTION = ""
+
+
+def _sql_value(value: Any) -> Any:
+    """Convert a pandas value into one sqlite3 can store, NaN becoming NULL.
+
+    :param value: A scalar from a DataFrame.
+    :return: The value as a plain Python object.
+    """
+    if pd.isna(value):
+        return None
+    return value.item() if hasattr(value, "item") else value
+
+
+def row_digests(report_df: pd.DataFrame) -> pd.Series:
+    """Hash every row of a quiz report, to tell which rows changed.
+
+    :param report_df: DataFrame of quiz report data.
+    :return: int64 digest of each row, indexed by student ID.
+    """
+    hashes = pd.util.hash_pandas_object(report_df, index=False)
+    return pd.Series(hashes.values.view(np.int64), index=report_df["id"].values)
+
+
+def latest_submissions(responses: pd.DataFrame) -> pd.DataFrame:
+    """Keep only the last submission of each student.
+
+    A student who resubmitted appears in a report more than once, but the store
+    keeps one response per section and student; tallying every submission
+    would count the student again for each.
+
+    :param responses: DataFrame from normalize_responses, whose rows share the
+        index of the report row they come from.
+    :return: The rows of each student's last report row, one per section.
+    """
+    submissions = responses.loc[~responses.index.duplicated(), "student"]
+    latest = submissions.index[~submissions.duplicated(keep="last")]
+    kept = responses[responses.index.isin(latest)]
+    return kept.drop_duplicates(["student", "instructor"])
+
+
+def _tally(responses: pd.DataFrame) -> Dict:
+    """Sum up responses the way the store keeps them.
+
+    :param responses: DataFrame from normalize_responses.
+    :return: student_totals, and a long DataFrame for each of SUM_TABLES.
+    """
+    return {
+        "totals": student_totals(responses),
+        "section_counts": section_totals(responses),
+        "confusion_levels": level_totals(responses),
+        "word_counts": word_totals(responses),
+    }
+
+
+class ResponseStore:
+    """SQLite database of responses and their per-section summaries."""
+
+    def __init__(self, db_file: Path) -> None:
+        """Open (or create) the store.
+
+        :param db_file: SQLite database file.
+        :return: None
+        """
+        db_file.parent.mkdir(parents=True, exist_ok=True)
+        self.db_file = db_file
+        self.connection = sqlite3.connect(str(db_file), timeout=LOCK_TIMEOUT)
+        # Readers do not block the writer, nor it them, so batch workers only
+        # wait on each other's writes.
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.executescript(SCHEMA)
+        columns = [
+            row[1] for row in self.connection.execute("PRAGMA table_info(responses)")
+        ]
+        if "short_response" not in columns:
+            # Stores created before short answers were kept.
+            try:
+                self.connection.execute(
+                    "ALTER TABLE responses ADD COLUMN short_response TEXT"
+                )
+            except sqlite3.OperationalError as e:
+                # Another process migrated the store in the meantime.
+                if "duplicate column" not in str(e):
+                    raise
+
+    def __enter__(self) -> "ResponseStore":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """Close the database connection.
+
+        :return: None
+        """
+        self.connection.close()
+
+    def add_quiz(
+            self,
+            course: str,
+            quiz: int,
+            responses: pd.DataFrame,
+            digests: pd.Series = None,
+    ) -> None:
+        """Store a quiz's responses, replacing any stored earlier.
+
+        :param course: Name of the course, e.g. "CHE 334".
+        :param quiz: Which Muddy Points survey the responses are from.
+        :param responses: DataFrame from normalize_responses. Of a student who
+            submitted more than once, only the last submission is kept.
+        :param digests: From row_digests, of the report the responses are from,
+            for a later update_quiz to compare against. Without them (or if
+            student IDs repeat) no snapshot is kept, and the next update is a
+            full one.
+        :return: None
+        """
+        responses = latest_submissions(responses)
+        with self.connection:
+            tables = ["responses", "confusion_summary", "report_rows", "quiz_totals"]
+            for table in tables + list(SUM_TABLES):
+                self.connection.execute(
+                    f"DELETE FROM {table} WHERE course = ? AND quiz = ?", (course, quiz)
+                )
+            self._insert_responses(course, quiz, responses)
+            self._add_tally(course, quiz, _tally(responses), 1)
+            if digests is not None and digests.index.is_unique:
+                self._insert_digests(course, quiz, digests)
+            self._summarize(course, quiz)
+
+    def report_delta(
+            self, course: str, quiz: int, digests: pd.Series
+    ) -> Optional[Tuple[List[str], List[str]]]:
+        """Compare a quiz report with the one the quiz was last stored from.
+
+        :param course: Name of the course, e.g. "CHE 334".
+        :param quiz: Which Muddy Points survey the report is of.
+        :param digests: From row_digests, of the new report.
+        :return: IDs of the students whose rows are new or changed, and of those
+            whose rows are gone; None if there is nothing to compare with.
+        """
+        if not digests.index.is_unique:
+            return None
+        stored = pd.read_sql_query(
+            "SELECT student, digest FROM report_rows WHERE course = ? AND quiz = ?",
+            self.connection,
+            params=(course, quiz),
+            index_col="student",
+        )["digest"]
+        if len(stored) == 0:
+            return None
+        known = digests.index.isin(stored.index)
+        differs = stored.reindex(digests.index[known]).values != digests.values[known]
+        changed = digests.index[~known].append(digests.index[known][differs])
+        removed = stored.index.difference(digests.index)
+        return list(changed), list(removed)
+
+    def update_quiz(
+            self,
+            course: str,
+            quiz: int,
+            responses: pd.DataFrame,
+            stale: List[str],
+            digests: pd.Series,
+    ) -> None:
+        """Apply the rows of a quiz report that changed since it was last stored.
+
+        :param course: Name of the course, e.g. "CHE 334".
+        :param quiz: Which Muddy Points survey the responses are from.
+        :param responses: DataFrame from normalize_responses, of the new and
+            changed rows only.
+        :param stale: IDs of the students whose stored responses are replaced
+            or gone, from report_delta.
+        :param digests: From row_digests, of the new and changed rows.
+        :return: None
+        """
+        responses = latest_submissions(responses)
+        with self.connection:
+            self.connection.execute("DELETE FROM stale_students")
+            self.connection.executemany(
+                "INSERT OR IGNORE INTO stale_students VALUES (?)",
+                ((student,) for student in stale),
+            )
+            previous = pd.read_sql_query(
+                "SELECT section AS instructor, student, confusion, short_response "
+                "FROM responses WHERE course = ? AND quiz = ? "
+                "AND student IN (SELECT student FROM stale_students)",
+                self.connection,
+                params=(course, quiz),
+            )
+            previous["instructor"] = previous["instructor"].replace(NO_SECTION, np.nan)
+            self._add_tally(course, quiz, _tally(previous), -1)
+            for table in ["responses", "report_rows"]:
+                self.connection.execute(
+                    f"DELETE FROM {table} WHERE course = ? AND quiz = ? "
+                    "AND student IN (SELECT student FROM stale_students)",
+                    (course, quiz),
+                )
+
+            self._insert_responses(course, quiz, responses)
+            self._add_tally(course, quiz, _tally(responses), 1)
+            self._insert_digests(course, quiz, digests)
+            self.connection.execute(
+                "DELETE FROM confusion_summary WHERE course = ? AND quiz = ?",
+                (course, quiz),
+            )
+            self._summarize(course, quiz)
+
+    def _insert_responses(
+            self, course: str, quiz: int, responses: pd.DataFrame
+    ) -> None:
+        rows = zip(
+            responses["instructor"].astype(object).fillna(NO_SECTION).astype(str),
+            responses["student"].astype(str),
+            responses["confusion"],
+            responses["short_response"],
+        )
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)",
+            (
+                (course, quiz, section, student)
+                + (_sql_value(confusion), _sql_value(text))
+                for section, student, confusion, text in rows
+            ),
+        )
+
+    def _insert_digests(self, course: str, quiz: int, digests: pd.Series) -> None:
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO report_rows VALUES (?, ?, ?, ?)",
+            (
+                (course, quiz, str(student), int(digest))
+                for student, digest in digests.items()
+            ),
+        )
+
+    def _add_tally(self, course: str, quiz: int, tally: Dict, sign: int) -> None:
+        """Add sums to (or, with sign -1, subtract them from) a quiz's sums.
+
+        :param course: Name of the course.
+        :param quiz: Which Muddy Points survey.
+        :param tally: From _tally.
+        :param sign: 1 to add, -1 to subtract.
+        :return: None
+        """
+        for table, keys in SUM_TABLES.items():
+            frame = tally[table]
+            key_values = [
+                tuple(_sql_value(v) for v in row) for row in frame[keys].values
+            ]
+            placeholders = ", ".join("?" for _ in keys)
+            self.connection.executemany(
+                f"INSERT OR IGNORE INTO {table} VALUES (?, ?, {placeholders}, 0)",
+                ((course, quiz) + key for key in key_values),
+            )
+            where = " AND ".join(f"{key} = ?" for key in keys)
+            self.connection.executemany(
+                f"UPDATE {table} SET count = count + ? "
+                f"WHERE course = ? AND quiz = ? AND {where}",
+                (
+                    (sign * int(count), course, quiz) + key
+                    for count, key in zip(frame["count"], key_values)
+                ),
+            )
+            self.connection.execute(
+                f"DELETE FROM {table} WHERE course = ? AND quiz = ? AND count <= 0",
+                (course, quiz),
+            )
+
+        totals = tally["totals"]
+        self.connection.execute(
+            "INSERT OR IGNORE INTO quiz_totals VALUES (?, ?, 0, 0)", (course, quiz)
+        )
+        self.connection.execute(
+            "UPDATE quiz_totals SET students = students + ?, "
+            "multi_section = multi_section + ? WHERE course = ? AND quiz = ?",
+            (
+                sign * totals["students"],
+                sign * totals["multi_section"],
+                course,
+                quiz,
+            ),
+        )
+
+    def _sum_table(self, table: str, course: str, quiz: int) -> pd.DataFrame:
+        columns = ", ".join(SUM_TABLES[table] + ["count"])
+        return pd.read_sql_query(
+            f"SELECT {columns} FROM {table} WHERE course = ? AND quiz = ?",
+            self.connection,
+            params=(course, quiz),
+        )
+
+    def _summarize(self, course: str, quiz: int) -> None:
+        """Compute a quiz's per-section summary from its stored sums.
+
+        :param course: Name of the course.
+        :param quiz: Which Muddy Points survey.
+        :return: None
+        """
+        levels = self._sum_table("confusion_levels", course, quiz)
+        summary = section_summary(level_table(levels))
+        self.connection.executemany(
+            "INSERT INTO confusion_summary VALUES (?, ?, ?, ?, ?, ?)",
+            (
+                (course, quiz) + tuple(_sql_value(value) for value in row)
+                for row in summary[["section", "count", "mean", "median"]].values
+            ),
+        )
+
+    def aggregates(self, course: str, quiz: int) -> QuizAggregates:
+        """Get a quiz's aggregates from its stored sums.
+
+        :param course: Name of the course, e.g. "CHE 334".
+        :param quiz: Which Muddy Points survey.
+        :return: The quiz's aggregates.
+        """
+        totals = self.connection.execute(
+            "SELECT students, multi_section FROM quiz_totals "
+            "WHERE course = ? AND quiz = ?",
+            (course, quiz),
+        ).fetchone() or (0, 0)
+        sections = self._sum_table("section_counts", course, quiz)
+        confused = {}
+        for section in sections["section"]:
+            rows = self.connection.execute(
+                "SELECT short_response, confusion FROM responses "
+                "WHERE course = ? AND quiz = ? AND section = ? "
+                "AND confusion IS NOT NULL AND short_response IS NOT NULL "
+                "ORDER BY confusion DESC, student LIMIT ?",
+                (course, quiz, section, MOST_CONFUSED),
+            )
+            confused[section] = [{text: int(confusion)} for text, confusion in rows]
+        return build_aggregates(
+            {"students": totals[0], "multi_section": totals[1]},
+            sections,
+            self._sum_table("confusion_levels", course, quiz),
+            self._sum_table("word_counts", course, quiz),
+            confused,
+        )
+
+    def confusion_summary(self, course: str) -> pd.DataFrame:
+        """Get the per-section confusion summary of every stored quiz.
+
+        :param course: Name of the course, e.g. "CHE 334".
+        :return: DataFrame with quiz, section, count, mean and median columns.
+        """
+        return pd.read_sql_query(
+            "SELECT quiz, section, count, mean, median FROM confusion_summary "
+            "WHERE course = ? ORDER BY quiz, section",
+            self.connection,
+            params=(course,),
+        )
+
+    def responses(self, course: str) -> pd.DataFrame:
+        """Get every stored response of a course.
+
+        :param course: Name of the course, e.g. "CHE 334".
+        :return: DataFrame with quiz, section, student and confusion columns.
+        """
+        return pd.read_sql_query(
+            "SELECT quiz, section, student, confusion FROM responses "
+            "WHERE course = ? ORDER BY quiz, section, student",
+            self.connection,
+            params=(course,),
+        )
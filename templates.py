@@ -0,0 +1,216 @@
+from collections import namedtuple
+from functools import lru_cache
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional
+import os
+
+from instrumentation import count, span
+
+"""Rendering report contents with the LaTeX/Jinja2 template.
+
+A template is parsed and compiled once per process: its Environment is kept
+for every ReportTemplate of the same directory, and Jinja2 keeps the compiled
+template in memory. The compiled bytecode is also saved to a directory, so a
+new process (every run, every batch worker) loads it instead of compiling the
+template again; it is recompiled only once the template changes.
+
+The template is given a ReportContext, which holds everything it shows already
+looked up and formatted, so that rendering is only interpolation. The raw
+contents are still passed as `contents`, for templates written against them.
+"""
+
+# Confusion averages are shown with this many decimals.
+CONFUSION_FORMAT = "{:.2f}"
+
+Attendance = namedtuple("Attendance", ["count", "notes", "title", "filename"])
+Figure = namedtuple("Figure", ["title", "filename"])
+Quote = namedtuple("Quote", ["confusion", "response"])
+Section = namedtuple(
+    "Section",
+    [
+        "name",
+        "confusion_question",
+        "responses",
+        "mean_confusion",
+        "median_confusion",
+        "histogram",
+        "short_response_question",
+        "most_confused",
+        "wordcloud",
+    ],
+)
+ReportContext = namedtuple(
+    "ReportContext",
+    ["quiz_number", "timestamp", "attendance", "stacked", "trend", "sections"],
+)
+
+
+def format_confusion(value: float) -> str:
+    """Format a mean or median confusion for the report.
+
+    :param value: The confusion.
+    :return: The confusion, rounded, as text.
+    """
+    return CONFUSION_FORMAT.format(value)
+
+
+def figure_context(figure: Optional[Dict]) -> Optional[Figure]:
+    """Get the title and file of a combined figure.
+
+    :param figure: The figure's entry in the contents, if it has one.
+    :return: The figure, or None if the report does not have it.
+    """
+    if not figure:
+        return None
+    return Figure(figure["title"], figure["filename"])
+
+
+def section_context(name: str, section: Dict) -> Section:
+    """Look up and format everything the report shows about one section.
+
+    :param name: Name of the section (its instructor).
+    :param section: The section's entry in the contents.
+    :return: The section.
+    """
+    confusion = section["ranked_confusion"]
+    short_response = section["short_response"]
+    quotes = [
+        Quote(level, response)
+        for quote in section.get("most_confused", [])
+        for response, level in quote.items()
+    ]
+    return Section(
+        name,
+        confusion["title"].strip(),
+        confusion["count"],
+        format_confusion(confusion["mean_confusion"]),
+        format_confusion(confusion["median_confusion"]),
+        confusion["filename"],
+        short_response["title"].strip(),
+        quotes,
+        short_response["filename"],
+    )
+
+
+def report_context(contents: Dict) -> ReportContext:
+    """Shape report contents into what the template shows.
+
+    :param contents: Report contents from data_processing.generate_report_contents.
+    :return: The template's context. Sections that could not be plotted are
+        left out.
+    """
+    combined = contents["combined"]
+    attendance = combined["attendance"]
+    sections = [
+        section_context(name, section)
+        for name, section in contents["instructors"].items()
+        if section
+    ]
+    return ReportContext(
+        contents["quiz_number"],
+        contents["timestamp"],
+        Attendance(
+            attendance["count"],
+            attendance.get("notes"),
+            attendance["title"],
+            attendance["filename"],
+        ),
+        figure_context(combined.get("stacked")),
+        figure_context(combined.get("trend")),
+        sections,
+    )
+
+
+def _bytecode_cache(bytecode_dir: Path):
+    """Create a bytecode cache that several processes can share.
+
+    Jinja2's FileSystemBytecodeCache writes its files in place, so a process
+    could load another's half-written bytecode; this one writes each file
+    under a temporary name and renames it into place.
+
+    :param bytecode_dir: Directory to keep the bytecode in.
+    :return: The bytecode cache.
+    """
+    from jinja2 import FileSystemBytecodeCache
+
+    class AtomicBytecodeCache(FileSystemBytecodeCache):
+        def dump_bytecode(self, bucket) -> None:
+            filename = self._get_cache_filename(bucket)
+            tmp_file = f"{filename}.{os.getpid()}.tmp"
+            with open(tmp_file, "wb") as f:
+                bucket.write_bytecode(f)
+            os.replace(tmp_file, filename)
+            count("templates.compiled")
+
+    bytecode_dir.mkdir(parents=True, exist_ok=True)
+    return AtomicBytecodeCache(str(bytecode_dir))
+
+
+@lru_cache(maxsize=8)
+def template_env(template_dir: Path, bytecode_dir: Optional[Path] = None):
+    """Create the Jinja2 environment for the templates of a directory, once.
+
+    :param template_dir: Directory the templates are in.
+    :param bytecode_dir: Directory to keep compiled templates in, if any.
+    :return: LaTeX-flavoured jinja2 Environment.
+    """
+    from jinja2 import FileSystemLoader
+    from latex.jinja2 import make_env
+
+    bytecode_cache = None
+    if bytecode_dir is not None:
+        bytecode_cache = _bytecode_cache(bytecode_dir)
+    return make_env(
+        loader=FileSystemLoader(str(template_dir)), bytecode_cache=bytecode_cache
+    )
+
+
+class ReportTemplate:
+    """A compiled report template."""
+
+    def __init__(self, template_file: Path, bytecode_dir: Path = None) -> None:
+        """Load the template, compiling it only if it is not cached.
+
+        :param template_file: LaTeX/Jinja2 template.
+        :param bytecode_dir: Directory to keep compiled templates in, if any.
+        :return: None
+        """
+        env = template_env(Path(template_file).parent, bytecode_dir)
+        with span("template.load", template=Path(template_file).name):
+            self.template = env.get_template(Path(template_file).name)
+
+    def render(self, contents: Dict) -> str:
+        """Render one report.
+
+        :param contents: Report contents from data_processing.generate_report_contents.
+        :return: The rendered LaTeX.
+        """
+        return self.template.render(contents=contents, report=report_context(contents))
+
+    def render_many(self, contents: Iterable[Dict]) -> Iterator[str]:
+        """Render reports one after another, with the same compiled template.
+
+        :param contents: Contents of each report.
+        :return: The rendered LaTeX of each report, in order.
+        """
+        for report_contents in contents:
+            yield self.render(report_contents)
+
+    def render_files(self, contents_files: List[Path]) -> List[Path]:
+        """Render saved report contents, each to a .tex file next to it.
+
+        :param contents_files: contents.json files, as written by generate.
+        :return: The .tex files written, in the same order.
+        """
+        import json
+        import export
+
+        tex_files = []
+        for contents_file in contents_files:
+            with contents_file.open("r") as f:
+                contents = json.load(f)
+            quiz_number = contents["quiz_number"]
+            tex_file = Path(contents_file.parent / f"muddy_points_{quiz_number}.tex")
+            export.make_texfile(self.render(contents), tex_file)
+            tex_files.append(tex_file)
+        return tex_files
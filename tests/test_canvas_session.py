@@ -0,0 +1,128 @@
+import json
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from pathlib import Path
+from socketserver import ThreadingMixIn
+
+import pytest
+
+pytest.importorskip("requests")
+pytest.importorskip("pandas")
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from Canvas import Canvas  # noqa: E402
+
+"""Canvas' pooled session, against a local stub server that counts connections.
+
+Every accepted socket is a new connection, and over TLS a new handshake, so a
+pooled session should open one per connection in its pool however many
+requests it makes.
+"""
+
+
+class StubServer(ThreadingMixIn, HTTPServer):
+    """Answers every GET with an empty JSON list, counting the connections."""
+
+    daemon_threads = True
+
+    def __init__(self, statuses=None) -> None:
+        super().__init__(("127.0.0.1", 0), StubHandler)
+        self.connections = 0
+        self.requests = []
+        # Statuses to answer with first, before 200.
+        self.statuses = list(statuses or [])
+        self._lock = threading.Lock()
+
+    def get_request(self):
+        request = super().get_request()
+        with self._lock:
+            self.connections = self.connections + 1
+        return request
+
+    @property
+    def api_base(self) -> str:
+        host, port = self.server_address
+        return f"http://{host}:{port}/api/v1"
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args) -> None:
+        pass
+
+    def do_GET(self) -> None:
+        with self.server._lock:
+            self.server.requests.append(dict(self.headers))
+            status = self.server.statuses.pop(0) if self.server.statuses else 200
+        body = json.dumps([]).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("X-Rate-Limit-Remaining", "700.0")
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def serve():
+    servers = []
+
+    def start(statuses=None) -> StubServer:
+        server = StubServer(statuses)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def make_canvas(server: StubServer, pool_size: int = 10) -> Canvas:
+    c = Canvas("canvas.test", "v1", "token\n", pool_size=pool_size, backoff_factor=0)
+    c.api_base = server.api_base
+    return c
+
+
+def test_sequential_requests_share_one_connection(serve):
+    server = serve()
+    with make_canvas(server) as c:
+        for _ in range(20):
+            assert c._get_with_token(c.api_base + "/courses").status_code == 200
+    assert len(server.requests) == 20
+    assert server.connections == 1
+
+
+@pytest.mark.parametrize("pool_size", [1, 2, 4])
+def test_concurrent_requests_open_at_most_one_connection_per_pool_slot(
+        serve, pool_size
+):
+    server = serve()
+    with make_canvas(server, pool_size=pool_size) as c:
+        def fetch(_) -> int:
+            return c._get_with_token(c.api_base + "/courses").status_code
+
+        with ThreadPoolExecutor(max_workers=pool_size) as pool:
+            statuses = list(pool.map(fetch, range(40)))
+    assert statuses == [200] * 40
+    assert 1 <= server.connections <= pool_size
+
+
+def test_token_is_sent_as_a_header(serve):
+    server = serve()
+    with make_canvas(server) as c:
+        c._get_with_token(c.api_base + "/courses")
+    assert server.requests[0]["Authorization"] == "Bearer token"
+
+
+def test_throttled_and_failed_requests_are_retried_on_the_same_connection(serve):
+    server = serve(statuses=[429, 503])
+    with make_canvas(server) as c:
+        assert c._get_with_token(c.api_base + "/courses").status_code == 200
+    assert len(server.requests) == 3
+    assert server.connections == 1
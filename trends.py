@@ -0,0 +1,37 @@
+import numpy as np
+import pandas as pd
+
+"""Confusion trends across the quizzes of a course.
+
+Each quiz is summarised once, when its responses are added to the
+ResponseStore, into a row per section, from the counts of each rating. The
+trend over the semester is then a reshaping of those few rows, however many
+responses each quiz had.
+"""
+
+
+def section_summary(confusion: pd.DataFrame) -> pd.DataFrame:
+    """Summarise one quiz's confusion ratings per section.
+
+    :param confusion: How many students gave each rating, a row per section and
+        a column per rating, e.g. QuizAggregates.confusion.
+    :return: DataFrame with section, count, mean and median columns.
+    """
+    rows = []
+    for section, levels in confusion.iterrows():
+        levels = levels[levels > 0]
+        ratings = np.repeat(levels.index.values.astype(float), levels.values)
+        rows.append((str(section), len(ratings), ratings.mean(), np.median(ratings)))
+    return pd.DataFrame(rows, columns=["section", "count", "mean", "median"])
+
+
+def confusion_trend(summary: pd.DataFrame) -> pd.DataFrame:
+    """Arrange per-quiz section summaries for plotting.
+
+    :param summary: DataFrame with quiz, section, count, mean and median
+        columns, e.g. from ResponseStore.confusion_summary.
+    :return: DataFrame indexed by quiz, with (statistic, section) columns.
+    """
+    return summary.pivot(
+        index="quiz", columns="section", values=["mean", "median"]
+    ).sort_index()
@@ -0,0 +1,229 @@
+from pathlib import Path
+from typing import Iterable, List
+import hashlib
+import os
+import shutil
+import subprocess
+
+from latex.exc import LatexBuildError
+
+"""Typesetting with a persistent build directory.
+
+latex.build_pdf typesets every report from scratch, in a new temporary
+directory. A Typesetter instead keeps one build directory per template, so
+that:
+    - a report whose rendered LaTeX is unchanged is not typeset again,
+    - aux files survive between builds, so a rebuild usually needs one pass,
+    - the static part of the preamble is compiled once into a format file
+      with mylatexformat, and every build starts from it.
+
+The static preamble is everything before "\\csname endofdump\\endcsname" in
+the template. Outside of a format dump that line does nothing.
+"""
+
+BACKENDS = ["pdflatex", "latexmk"]
+
+JOBNAME = "report"
+FORMAT_NAME = "preamble"
+END_OF_DUMP = r"\csname endofdump\endcsname"
+
+LATEX_FLAGS = [
+    "-interaction=batchmode",
+    "-halt-on-error",
+    "-no-shell-escape",
+    "-file-line-error",
+]
+
+
+def file_digest(path: Path) -> str:
+    """Hash a file's contents.
+
+    :param path: File to hash.
+    :return: Hex SHA-256 digest.
+    """
+    with path.open("rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+class Typesetter:
+    """Typesets reports in a build directory kept for their template."""
+
+    def __init__(
+            self,
+            build_root: Path,
+            template_file: Path,
+            backend: str = "pdflatex",
+            texinputs: List[str] = None,
+            pdflatex: str = "pdflatex",
+            latexmk: str = "latexmk",
+            max_runs: int = 5,
+    ) -> None:
+        """Set up (or reuse) the build directory for a template.
+
+        :param build_root: Directory holding one build directory per template.
+        :param template_file: LaTeX/Jinja2 template the reports come from.
+        :param backend: "pdflatex", rerun until the aux file settles, or
+            "latexmk", which decides for itself which passes are needed.
+        :param texinputs: Include paths for TeX, "" adds the default path.
+        :param pdflatex: The pdflatex binary.
+        :param latexmk: The latexmk binary.
+        :param max_runs: Most pdflatex passes before giving up.
+        :return: None
+        """
+        if backend not in BACKENDS:
+            raise ValueError(f"Invalid LaTeX backend: {backend}")
+        self.backend = backend
+        self.texinputs = texinputs if texinputs is not None else [str(Path.cwd()), ""]
+        self.pdflatex = pdflatex
+        self.latexmk = latexmk
+        self.max_runs = max_runs
+
+        self.build_dir = Path(build_root / file_digest(template_file)[:16])
+        self.build_dir.mkdir(parents=True, exist_ok=True)
+        self.tex_file = Path(self.build_dir / f"{JOBNAME}.tex")
+        self.pdf_file = Path(self.build_dir / f"{JOBNAME}.pdf")
+        self.aux_file = Path(self.build_dir / f"{JOBNAME}.aux")
+        self.log_file = Path(self.build_dir / f"{JOBNAME}.log")
+        self.digest_file = Path(self.build_dir / f"{JOBNAME}.sha256")
+        self.format_file = Path(self.build_dir / f"{FORMAT_NAME}.fmt")
+
+    def _run(self, args: List[str]) -> None:
+        """Run a TeX program in the build directory.
+
+        :param args: Command line.
+        :return: None
+        """
+        env = os.environ.copy()
+        env["TEXINPUTS"] = os.pathsep.join(self.texinputs) + os.pathsep
+        try:
+            subprocess.run(
+                args,
+                cwd=str(self.build_dir),
+                env=env,
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+                check=True,
+            )
+        except subprocess.CalledProcessError as e:
+            raise LatexBuildError(str(self.log_file)) from e
+
+    def _build_format(self, preamble: str) -> bool:
+        """Compile the static preamble into a format file, if it changed.
+
+        :param preamble: LaTeX up to END_OF_DUMP.
+        :return: True if the format file can be used.
+        """
+        digest = hashlib.sha256(preamble.encode()).hexdigest()
+        digest_file = self.format_file.with_suffix(".sha256")
+        failed_file = self.format_file.with_suffix(".failed")
+        if self.format_file.exists() and digest_file.exists():
+            if digest_file.read_text() == digest:
+                return True
+        # Do not retry on every build a preamble that could not be dumped.
+        if failed_file.exists() and failed_file.read_text() == digest:
+            return False
+
+        try:
+            self._run(
+                [self.pdflatex, "-ini", f"-jobname={FORMAT_NAME}"]
+                + LATEX_FLAGS
+                + ["&pdflatex", "mylatexformat.ltx", self.tex_file.name]
+            )
+        except (LatexBuildError, OSError):
+            # e.g. mylatexformat is not installed: build without a format.
+            print("Could not precompile the preamble, typesetting without it.")
+            if digest_file.exists():
+                digest_file.unlink()
+            failed_file.write_text(digest)
+            return False
+        digest_file.write_text(digest)
+        return True
+
+    def _latex_command(self, use_format: bool) -> List[str]:
+        """Get the pdflatex command line, without the file to typeset.
+
+        :param use_format: Start from the precompiled preamble.
+        :return: Command line.
+        """
+        fmt = [f"-fmt={FORMAT_NAME}"] if use_format else []
+        return [self.pdflatex] + fmt + LATEX_FLAGS
+
+    def _build_pdflatex(self, use_format: bool) -> None:
+        """Run pdflatex until the aux file stops changing.
+
+        The aux file of the previous build is kept, so an unchanged document
+        structure settles after a single pass.
+
+        :param use_format: Start from the precompiled preamble.
+        :return: None
+        """
+        previous_aux = self.aux_file.read_bytes() if self.aux_file.exists() else None
+        for _ in range(self.max_runs):
+            self._run(self._latex_command(use_format) + [self.tex_file.name])
+            aux = self.aux_file.read_bytes()
+            if aux == previous_aux:
+                return
+            previous_aux = aux
+        raise RuntimeError(
+            f"Maximum number of runs ({self.max_runs}) without a stable .aux file"
+        )
+
+    def _build_latexmk(self, use_format: bool) -> None:
+        """Let latexmk decide which passes to run, from its own records.
+
+        :param use_format: Start from the precompiled preamble.
+        :return: None
+        """
+        latex_command = " ".join(self._latex_command(use_format) + ["%O", "%S"])
+        self._run(
+            [self.latexmk, "-pdf", f"-pdflatex={latex_command}", self.tex_file.name]
+        )
+
+    def build_pdf(
+            self, rendered_latex: str, pdf_filename: Path, inputs: Iterable[Path] = ()
+    ) -> bool:
+        """Typeset a report, unless it is identical to the last one built.
+
+        :param rendered_latex: The report's LaTeX source.
+        :param pdf_filename: Path to write the PDF to.
+        :param inputs: Files the source includes, e.g. figures. The report is
+            also typeset again when one of these changes.
+        :return: True if the report was typeset, False if it was reused.
+        """
+        sha = hashlib.sha256(rendered_latex.encode())
+        for path in sorted(inputs):
+            sha.update(f"{path}:{file_digest(path)}".encode())
+        digest = sha.hexdigest()
+        if (
+                self.pdf_file.exists()
+                and self.digest_file.exists()
+                and self.digest_file.read_text() == digest
+        ):
+            shutil.copyfile(str(self.pdf_file), str(pdf_filename))
+            return False
+
+        # Until this build succeeds, the PDF in the build directory is stale.
+        if self.digest_file.exists():
+            self.digest_file.unlink()
+        self.tex_file.write_text(rendered_latex)
+
+        use_format = False
+        if END_OF_DUMP in rendered_latex:
+            use_format = self._build_format(rendered_latex.split(END_OF_DUMP)[0])
+        if self.backend == "latexmk":
+            build = self._build_latexmk
+        else:
+            build = self._build_pdflatex
+        try:
+            build(use_format)
+        except LatexBuildError:
+            if not use_format:
+                raise
+            # Some packages do not survive being dumped into a format.
+            print("Typesetting with the precompiled preamble failed, trying without.")
+            build(False)
+
+        shutil.copyfile(str(self.pdf_file), str(pdf_filename))
+        self.digest_file.write_text(digest)
+        return True
@@ -0,0 +1,206 @@
+from contextlib import contextmanager
+from typing import Dict, Iterator
+from pathlib import Path
+import io
+import json
+import mimetypes
+import os
+import threading
+import uuid
+
+# File locks keep processes sharing a ledger (generate and generate-all runs)
+# from losing each other's uploads; where there are none, only threads are
+# kept apart.
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+"""Pieces of the Canvas file upload flow that make no requests themselves.
+
+Canvas uploads a file in three steps: ask Canvas for an upload ticket, POST the
+file to the storage URL in the ticket, then confirm by following the Location
+the storage backend answers with. The file is sent as a MultipartStream, which
+reads it from disk as the request goes out rather than loading it first, and
+finished uploads are written to an UploadLedger so that an interrupted batch
+only re-sends the files that did not make it. Several processes can share a
+ledger: each update is made under a file lock, to the ledger as it is on disk.
+"""
+
+# Bytes read from disk at a time while a file is being uploaded.
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
+
+def content_type(path: Path) -> str:
+    """Guess the MIME type Canvas should store a file with.
+
+    :param path: File to upload.
+    :return: e.g. "application/pdf", or "application/octet-stream".
+    """
+    guessed, _ = mimetypes.guess_type(path.name)
+    return guessed or "application/octet-stream"
+
+
+class MultipartStream:
+    """A multipart/form-data body whose file part is read from disk as it is sent.
+
+    Its length is known up front, so requests sends a Content-Length rather
+    than a chunked body, which storage backends such as S3 require.
+    """
+
+    def __init__(self, fields: Dict[str, str], file_field: str, path: Path) -> None:
+        """Lay out the body around the file.
+
+        :param fields: Form fields to send before the file, e.g. upload_params.
+        :param file_field: Name of the file's form field.
+        :param path: File to send, last, as the storage backend requires.
+        :return: None
+        """
+        self.boundary = uuid.uuid4().hex
+        head = io.BytesIO()
+        for name, value in fields.items():
+            head.write(
+                f"--{self.boundary}\r\n"
+                f'Content-Disposition: form-data; name="{name}"\r\n\r\n'
+                f"{value}\r\n".encode()
+            )
+        head.write(
+            f"--{self.boundary}\r\n"
+            f'Content-Disposition: form-data; name="{file_field}"; '
+            f'filename="{path.name}"\r\n'
+            f"Content-Type: {content_type(path)}\r\n\r\n".encode()
+        )
+        tail = f"\r\n--{self.boundary}--\r\n".encode()
+
+        self.len = head.tell() + os.path.getsize(str(path)) + len(tail)
+        head.seek(0)
+        self._parts = [head, path.open("rb"), io.BytesIO(tail)]
+
+    @property
+    def content_type(self) -> str:
+        """The Content-Type header to send the body with."""
+        return f"multipart/form-data; boundary={self.boundary}"
+
+    def __len__(self) -> int:
+        return self.len
+
+    def __enter__(self) -> "MultipartStream":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def __iter__(self) -> Iterator[bytes]:
+        return iter(lambda: self.read(UPLOAD_CHUNK_SIZE), b"")
+
+    def read(self, size: int = -1) -> bytes:
+        """Read the next bytes of the body.
+
+        :param size: Most bytes to read, -1 for everything left.
+        :return: The bytes, empty once the body has been sent.
+        """
+        chunks = []
+        while self._parts and size != 0:
+            chunk = self._parts[0].read(size)
+            if not chunk:
+                self._parts.pop(0).close()
+                continue
+            chunks.append(chunk)
+            if size > 0:
+                size = size - len(chunk)
+        return b"".join(chunks)
+
+    def close(self) -> None:
+        """Close the file being sent.
+
+        :return: None
+        """
+        for part in self._parts:
+            part.close()
+        self._parts = []
+
+
+class UploadLedger:
+    """Record of the files already uploaded, so a batch can be resumed."""
+
+    def __init__(self, ledger_file: Path) -> None:
+        """Load the ledger, starting fresh if it is missing or corrupt.
+
+        :param ledger_file: JSON file of finished uploads.
+        :return: None
+        """
+        self.ledger_file = ledger_file
+        self.lock_file = ledger_file.with_suffix(".lock")
+        self._lock = threading.Lock()
+        self.entries = self._load()
+
+    def _load(self) -> Dict:
+        """Read the ledger file, starting fresh if it is missing or corrupt.
+
+        :return: Finished uploads, by key.
+        """
+        try:
+            with self.ledger_file.open("r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    @contextmanager
+    def _ledger_lock(self) -> Iterator[None]:
+        """Hold the ledger, against other threads and other processes.
+
+        :return: Context manager holding the lock.
+        """
+        with self._lock, self.lock_file.open("a") as f:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+    @staticmethod
+    def _key(path: Path, parent_folder: str) -> str:
+        return f"{parent_folder}|{path.resolve()}"
+
+    @staticmethod
+    def _signature(path: Path) -> Dict:
+        stat = path.stat()
+        return {"size": stat.st_size, "mtime": stat.st_mtime}
+
+    def is_uploaded(self, path: Path, parent_folder: str) -> bool:
+        """Check whether this version of a file has already been uploaded.
+
+        :param path: File to upload.
+        :param parent_folder: Canvas-side file tree destination.
+        :return: True if the file is unchanged since it was uploaded.
+        """
+        entry = self.entries.get(self._key(path, parent_folder))
+        return entry is not None and entry.get("file") == self._signature(path)
+
+    def record(self, path: Path, parent_folder: str, canvas_file: Dict) -> None:
+        """Remember a finished upload, and save the ledger.
+
+        Safe to call from several upload threads, or processes, at once: the
+        upload is added to the ledger as it is on disk, which may hold other
+        processes' uploads since it was loaded.
+
+        :param path: The uploaded file.
+        :param parent_folder: Canvas-side file tree destination.
+        :param canvas_file: Canvas' JSON representation of the uploaded file.
+        :return: None
+        """
+        with self._ledger_lock():
+            entries = self._load()
+            entries[self._key(path, parent_folder)] = {
+                "file": self._signature(path),
+                "canvas_id": canvas_file.get("id"),
+            }
+            tmp_file = self.ledger_file.with_name(
+                f"{self.ledger_file.name}.{os.getpid()}-{uuid.uuid4().hex}.tmp"
+            )
+            with tmp_file.open("w") as f:
+                json.dump(entries, f, indent=1, sort_keys=True)
+            os.replace(str(tmp_file), str(self.ledger_file))
+            self.entries = entries
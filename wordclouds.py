@@ -0,0 +1,129 @@
+from functools import lru_cache
+from pathlib import Path
+from random import Random
+from typing import Dict, Hashable, Tuple
+import pandas as pd
+from wordcloud import STOPWORDS, WordCloud
+
+"""Word clouds of the short-answer responses.
+
+The responses are tokenized and counted once per report, with pandas string
+methods, and every word cloud is then laid out from those counts with
+WordCloud.generate_from_frequencies. The WordCloud itself (its canvas, font and
+colour settings) is created once per process and every layout is cached, so
+drawing a cloud is mostly just rasterizing the words.
+"""
+
+# The words WordCloud.process_text would find: two or more word characters,
+# possibly with apostrophes.
+WORD = r"\w[\w']+"
+
+MAX_WORDS = 200
+
+# Drawn instead when there are no words to draw; bundled so that a report
+# never has to wait on the network.
+FALLBACK_CORPUS = Path(Path(__file__).parent / "wordcloud_fallback.txt")
+
+# Layout canvas in pixels. The image is rendered at SCALE times this and
+# RESOLUTION dpi, so it has the 7.5 x 3 inch size of the other figures.
+WIDTH = 750
+HEIGHT = 300
+SCALE = 2
+RESOLUTION = 200.0
+
+
+def count_words(responses: pd.DataFrame, by: str = "instructor") -> pd.Series:
+    """Tokenize every short response once and count the words in each group.
+
+    Words are lowercased, a trailing "'s" is dropped, and stopwords and numbers
+    are left out.
+
+    :param responses: DataFrame from normalize_responses.
+    :param by: Column to count separately for, e.g. "instructor".
+    :return: Series of word counts, indexed by (group, word).
+    """
+    # A student in several sections has a row, sharing one index, in each.
+    responses = responses.reset_index(drop=True)
+    words = (
+        responses["short_response"]
+        .dropna()
+        .astype(str)
+        .str.lower()
+        .str.findall(WORD)
+        .explode()
+        .dropna()
+        .str.replace(r"'s$", "", regex=True)
+    )
+    words = words[~words.isin(STOPWORDS) & ~words.str.isdigit()]
+    tokens = pd.DataFrame({by: responses[by].reindex(words.index), "word": words})
+    return tokens.groupby([by, "word"], observed=True).size()
+
+
+def word_frequencies(counts: pd.Series, group: Hashable) -> Dict[str, int]:
+    """Get the most frequent words of one group.
+
+    :param counts: Word counts from count_words.
+    :param group: Which group's words to get, e.g. an instructor.
+    :return: Up to MAX_WORDS words and their counts, most frequent first.
+    """
+    if group not in counts.index.get_level_values(0):
+        return {}
+    items = counts.xs(group, level=0).items()
+    ranked = sorted(items, key=lambda item: (-item[1], item[0]))[:MAX_WORDS]
+    return {word: int(count) for word, count in ranked}
+
+
+@lru_cache(maxsize=1)
+def fallback_frequencies() -> Dict[str, int]:
+    """Count the words of the bundled fallback corpus, once per process.
+
+    :return: Words and their counts, most frequent first.
+    """
+    with FALLBACK_CORPUS.open("r") as f:
+        corpus = pd.DataFrame({"short_response": [f.read()], "group": [0]})
+    return word_frequencies(count_words(corpus, by="group"), 0)
+
+
+@lru_cache(maxsize=1)
+def _wordcloud() -> WordCloud:
+    """Create the WordCloud that lays out and draws every cloud in this process.
+
+    :return: The WordCloud.
+    """
+    return WordCloud(
+        width=WIDTH,
+        height=HEIGHT,
+        scale=SCALE,
+        max_words=MAX_WORDS,
+        background_color="white",
+    )
+
+
+@lru_cache(maxsize=32)
+def _layout(frequencies: Tuple[Tuple[str, int], ...]) -> list:
+    """Place the words on the canvas.
+
+    The layout is seeded, so the same words always give the same picture.
+
+    :param frequencies: (word, count) pairs, most frequent first.
+    :return: WordCloud.layout_ for the words.
+    """
+    wc = _wordcloud()
+    wc.random_state = Random(0)
+    wc.generate_from_frequencies(dict(frequencies))
+    return wc.layout_
+
+
+def wordcloud_image(frequencies: Dict[str, int]):
+    """Draw a word cloud.
+
+    :param frequencies: Words and their counts, from word_frequencies. If there
+        are none, the fallback corpus is drawn instead.
+    :return: The word cloud, as a PIL Image.
+    """
+    if not frequencies:
+        print("Using the fallback corpus, not enough responses.")
+        frequencies = fallback_frequencies()
+    wc = _wordcloud()
+    wc.layout_ = _layout(tuple(frequencies.items()))
+    return wc.to_image()